@@ -2,12 +2,15 @@ from .linear        import Linear
 from .conv          import Conv2d
 from .sequential    import Sequential
 from .maxpool       import MaxPool2d
+from .bayesian      import BayesianLinear, BayesianConv2d
 from .converter     import convert_vgg
 
 __all__ = [
         "Linear",
         "MaxPool2d",
         "Conv2d", 
+        "BayesianLinear",
+        "BayesianConv2d",
         "Sequential",
         "convert_vgg"
     ]
@@ -0,0 +1,86 @@
+import torch
+import torch.nn.functional as F
+from .linear import Linear
+from .conv import Conv2d
+from .functional.bayesian import bayesian_linear, bayesian_conv2d
+
+softplus = torch.nn.Softplus()
+
+class _LocalReparameterization:
+    """
+        Factorized Gaussian weights: `weight` and `bias` hold the means, `weight_scale` and `bias_scale`
+        the unconstrained scales, with standard deviation `softplus(scale)`. When `sample` is False the
+        layer behaves as its deterministic parent on the mean weights.
+    """
+    def _init_scales(self, init_scale):
+        self.sample = True
+        self.weight_scale = torch.nn.Parameter(torch.full_like(self.weight, init_scale))
+        if self.bias is not None:
+            self.bias_scale = torch.nn.Parameter(torch.full_like(self.bias, init_scale))
+        else:
+            self.register_parameter("bias_scale", None)
+
+    def variances(self):
+        bias_var = None if self.bias_scale is None else softplus(self.bias_scale)**2
+        return softplus(self.weight_scale)**2, bias_var
+
+    def kl_divergence(self, prior_scale=1.):
+        """ KL divergence from the posterior to a zero mean Gaussian prior. """
+        kl = 0.
+        for loc, scale in [(self.weight, self.weight_scale), (self.bias, self.bias_scale)]:
+            if loc is not None:
+                scale = softplus(scale)
+                kl += (torch.log(prior_scale/scale) + (scale**2 + loc**2)/(2*prior_scale**2) - 0.5).sum()
+        return kl
+
+    def _rule(self, functions, explain, rule):
+        if not explain: return functions["gradient"]
+
+        if rule not in functions:
+            raise NotImplementedError(f"Local reparameterization layers support rules {list(functions.keys())}.")
+        return functions[rule]
+
+class BayesianLinear(_LocalReparameterization, Linear):
+    def __init__(self, in_features, out_features, bias=True, init_scale=-5.):
+        super(BayesianLinear, self).__init__(in_features, out_features, bias=bias)
+        self._init_scales(init_scale)
+
+    def forward(self, input, explain=False, rule="epsilon", **kwargs):
+        if not self.sample: return super(BayesianLinear, self).forward(input, explain, rule, **kwargs)
+
+        weight_var, bias_var = self.variances()
+        return self._rule(bayesian_linear, explain, rule)(input, self.weight, self.bias, weight_var, bias_var)
+
+    @classmethod
+    def from_torch(cls, lin, init_scale=-5.):
+        bias = lin.bias is not None
+        module = cls(in_features=lin.in_features, out_features=lin.out_features, bias=bias, init_scale=init_scale)
+        module.load_state_dict(lin.state_dict(), strict=False)
+
+        return module
+
+class BayesianConv2d(_LocalReparameterization, Conv2d):
+    def __init__(self, *args, init_scale=-5., **kwargs):
+        super(BayesianConv2d, self).__init__(*args, **kwargs)
+        self._init_scales(init_scale)
+
+    def forward(self, input, explain=False, rule="epsilon", **kwargs):
+        if not self.sample: return super(BayesianConv2d, self).forward(input, explain, rule, **kwargs)
+
+        if self.padding_mode != 'zeros':
+            raise NotImplementedError("Local reparameterization layers only support zero padding.")
+
+        weight_var, bias_var = self.variances()
+        return self._rule(bayesian_conv2d, explain, rule)(input, self.weight, self.bias, weight_var, bias_var, None,
+                                                           self.stride, self.padding, self.dilation, self.groups)
+
+    @classmethod
+    def from_torch(cls, conv, init_scale=-5.):
+        in_channels = conv.weight.shape[1] * conv.groups
+        bias = conv.bias is not None
+
+        module = cls(in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                     conv.groups, bias=bias, padding_mode=conv.padding_mode, init_scale=init_scale)
+        module.load_state_dict(conv.state_dict(), strict=False)
+
+        return module
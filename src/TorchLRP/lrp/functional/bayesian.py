@@ -0,0 +1,94 @@
+"""
+    Local reparameterization of layers with factorized Gaussian weights. Pre-activations are sampled
+    from their Gaussian marginals, with mean `x w_mu + b_mu` and variance `x^2 w_var + b_var`, so
+    that every input gets its own noise at the cost of one mean and one variance product per layer.
+
+    Given the noise, the sampled output is a differentiable function of the input with Jacobian
+    `w_mu + noise/std * x w_var`. The epsilon rule redistributes relevance with this per-input
+    weight, which only needs one transposed product for the mean and one for the variance.
+"""
+
+import torch
+import torch.nn.functional as F
+from torch.autograd import Function
+
+from .utils import add_epsilon_fn, float32, float32_backward
+from .. import trace
+
+VAR_EPS = 1e-16
+
+def _local_reparameterization(mean_fn, var_fn, input, noise):
+    mean = mean_fn(input)
+    std = torch.sqrt(var_fn(input**2) + VAR_EPS)
+    noise = torch.randn_like(mean) if noise is None else noise
+    return mean + noise * std, noise / std
+
+def _forward_epsilon(incr, ctx, mean_fn, var_fn, input, weight, weight_var, noise):
+    Z, noise_std = _local_reparameterization(mean_fn, var_fn, input, noise)
+    ctx.save_for_backward(input, weight, weight_var, Z, noise_std)
+    ctx.incr = incr
+    return Z
+
+@float32_backward
+def _backward_epsilon(ctx, transpose_fn, relevance_output):
+    input, weight, weight_var, Z, noise_std = float32(*ctx.saved_tensors)
+
+    relevance_output = relevance_output / ctx.incr(Z)
+    relevance_input  = transpose_fn(relevance_output, weight) \
+                     + input * transpose_fn(relevance_output * noise_std, weight_var)
+    relevance_input  = relevance_input * input
+
+    trace.do_trace(relevance_input)
+    return relevance_input
+
+
+def linear_local_reparameterization(input, weight, bias, weight_var, bias_var, noise=None):
+    mean_fn = lambda x: F.linear(x, weight, bias)
+    var_fn  = lambda x: F.linear(x, weight_var, bias_var)
+    return _local_reparameterization(mean_fn, var_fn, input, noise)[0]
+
+class LinearEpsilon(Function):
+    @staticmethod
+    def forward(ctx, input, weight, bias, weight_var, bias_var, noise=None):
+        mean_fn = lambda x: F.linear(x, weight, bias)
+        var_fn  = lambda x: F.linear(x, weight_var, bias_var)
+        return _forward_epsilon(add_epsilon_fn(1e-1), ctx, mean_fn, var_fn, input, weight, weight_var, noise)
+
+    @staticmethod
+    def backward(ctx, relevance_output):
+        transpose_fn = lambda r, w: F.linear(r, w.t())
+        relevance_input = _backward_epsilon(ctx, transpose_fn, relevance_output)
+        return relevance_input, None, None, None, None, None
+
+
+def conv2d_local_reparameterization(input, weight, bias, weight_var, bias_var, noise=None,
+                                    stride=1, padding=0, dilation=1, groups=1):
+    mean_fn = lambda x: F.conv2d(x, weight, bias, stride, padding, dilation, groups)
+    var_fn  = lambda x: F.conv2d(x, weight_var, bias_var, stride, padding, dilation, groups)
+    return _local_reparameterization(mean_fn, var_fn, input, noise)[0]
+
+class Conv2DEpsilon(Function):
+    @staticmethod
+    def forward(ctx, input, weight, bias, weight_var, bias_var, noise=None, stride=1, padding=0, dilation=1, groups=1):
+        ctx.geometry = (stride, padding, dilation, groups)
+        mean_fn = lambda x: F.conv2d(x, weight, bias, stride, padding, dilation, groups)
+        var_fn  = lambda x: F.conv2d(x, weight_var, bias_var, stride, padding, dilation, groups)
+        return _forward_epsilon(add_epsilon_fn(1e-1), ctx, mean_fn, var_fn, input, weight, weight_var, noise)
+
+    @staticmethod
+    def backward(ctx, relevance_output):
+        input_shape = ctx.saved_tensors[0].shape
+        transpose_fn = lambda r, w: torch.nn.grad.conv2d_input(input_shape, w, r, *ctx.geometry)
+        relevance_input = _backward_epsilon(ctx, transpose_fn, relevance_output)
+        return relevance_input, None, None, None, None, None, None, None, None, None
+
+
+bayesian_linear = {
+        "gradient":             linear_local_reparameterization,
+        "epsilon":              LinearEpsilon.apply,
+}
+
+bayesian_conv2d = {
+        "gradient":             conv2d_local_reparameterization,
+        "epsilon":              Conv2DEpsilon.apply,
+}
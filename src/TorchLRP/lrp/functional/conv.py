@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch.autograd import Function
 
-from .utils import identity_fn, gamma_fn, add_epsilon_fn, normalize
+from .utils import identity_fn, gamma_fn, add_epsilon_fn, normalize, float32, float32_backward
 from .. import trace
 
 def _forward_rho(rho, incr, ctx, input, weight, bias, stride, padding, dilation, groups):
@@ -17,8 +17,9 @@ def _forward_rho(rho, incr, ctx, input, weight, bias, stride, padding, dilation,
         Z = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
         return Z
 
+@float32_backward
 def _backward_rho(ctx, relevance_output):
-    input, weight, bias    = ctx.saved_tensors
+    input, weight, bias    = float32(*ctx.saved_tensors)
 
     weight, bias     = ctx.rho(weight, bias)
     Z                = ctx.incr(F.conv2d(input, weight, bias, ctx.stride, ctx.padding, ctx.dilation, ctx.groups))
@@ -62,10 +63,41 @@ class Conv2DGammaEpsilon(Function):
 def _conv_alpha_beta_forward(ctx, input, weight, bias, stride, padding, dilation, groups, **kwargs): 
     Z = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
     ctx.save_for_backward(input, weight, Z,  bias)
+    ctx.stride = stride
+    ctx.padding = padding
+    ctx.dilation = dilation
+    ctx.groups = groups
     return Z
 
+def _group_cat(tensors, dim, groups):
+    """
+        Concatenates `tensors` along `dim` so that each of the `groups` convolution groups receives 
+        its own slice of every tensor, in order.
+    """
+    shape = tensors[0].shape
+    tensors = [t.reshape(*shape[:dim], groups, shape[dim] // groups, *shape[dim+1:]) for t in tensors]
+    return torch.stack(tensors, dim+1).view(*shape[:dim], len(tensors) * shape[dim], *shape[dim+1:])
+
+def _group_split(tensor, n, dim, groups):
+    """
+        Inverse of `_group_cat` for `n` tensors of equal size.
+    """
+    shape = tensor.shape
+    tensor = tensor.view(*shape[:dim], groups, n, shape[dim] // (groups * n), *shape[dim+1:])
+    return [t.reshape(*shape[:dim], shape[dim] // n, *shape[dim+1:]) for t in tensor.unbind(dim+1)]
+
+@float32_backward
 def _conv_alpha_beta_backward(alpha, beta, ctx, relevance_output):
-        input, weights, Z, bias = ctx.saved_tensors
+        """
+            Positive and negative inputs are concatenated along the input channels, so that 
+            x+ w+ + x- w- (and x+ w- + x- w+) is a single convolution. When beta != 0 the two 
+            weight stacks are also concatenated along the output channels. The whole rule costs 
+            one `conv2d` and one transposed convolution, using the stride, padding, dilation and 
+            groups of the layer.
+        """
+        input, weights, Z, bias = float32(*ctx.saved_tensors)
+        groups = ctx.groups
+
         sel = weights > 0
         zeros = torch.zeros_like(weights)
 
@@ -75,24 +107,27 @@ def _conv_alpha_beta_backward(alpha, beta, ctx, relevance_output):
         input_pos         = torch.where(input >  0, input, torch.zeros_like(input))
         input_neg         = torch.where(input <= 0, input, torch.zeros_like(input))
 
-        def f(X1, X2, W1, W2): 
-
-            Z1  = F.conv2d(X1, W1, bias=None, stride=1, padding=1) 
-            Z2  = F.conv2d(X2, W2, bias=None, stride=1, padding=1)
-            Z   = Z1 + Z2
+        X     = _group_cat([input_pos, input_neg], 1, groups)   # [bs, 2*in_c, h, w]
+        W_pos = torch.cat([weights_pos, weights_neg], 1)        # x+ w+  +  x- w-
+        W_neg = torch.cat([weights_neg, weights_pos], 1)        # x+ w-  +  x- w+
 
-            rel_out = relevance_output / (Z + (Z==0).float()* 1e-6)
+        stabilize = lambda Z: Z + (Z==0).float()* 1e-6
 
-            t1 = F.conv_transpose2d(rel_out, W1, bias=None, padding=1) 
-            t2 = F.conv_transpose2d(rel_out, W2, bias=None, padding=1)
+        if beta == 0:
+            W       = W_pos
+            Z_pos   = F.conv2d(X, W, None, ctx.stride, ctx.padding, ctx.dilation, groups)
+            rel_out = relevance_output / stabilize(Z_pos) * alpha 
 
-            r1  = t1 * X1
-            r2  = t2 * X2
+        else:
+            W            = _group_cat([W_pos, W_neg], 0, groups)
+            Z            = F.conv2d(X, W, None, ctx.stride, ctx.padding, ctx.dilation, groups)
+            Z_pos, Z_neg = _group_split(Z, 2, 1, groups)
+            rel_out      = _group_cat([relevance_output / stabilize(Z_pos) * alpha, 
+                                       relevance_output / stabilize(Z_neg) * (-beta)], 1, groups)
 
-            return r1 + r2
-        pos_rel         = f(input_pos, input_neg, weights_pos, weights_neg)
-        neg_rel         = f(input_neg, input_pos, weights_pos, weights_neg)
-        relevance_input = pos_rel * alpha - neg_rel * beta
+        t = torch.nn.grad.conv2d_input(X.shape, W, rel_out, ctx.stride, ctx.padding, ctx.dilation, groups)
+        r_pos, r_neg = _group_split(t * X, 2, 1, groups)
+        relevance_input = r_pos + r_neg
 
         trace.do_trace(relevance_input) 
         return relevance_input, None, None, None, None, None, None
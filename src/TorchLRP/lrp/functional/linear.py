@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch.autograd import Function
 
-from .utils import identity_fn, gamma_fn, add_epsilon_fn, normalize
+from .utils import identity_fn, gamma_fn, add_epsilon_fn, normalize, float32, float32_backward
 from .. import trace
 
 def _forward_rho(rho, incr, ctx, input, weight, bias):
@@ -11,8 +11,9 @@ def _forward_rho(rho, incr, ctx, input, weight, bias):
     ctx.incr = incr
     return F.linear(input, weight, bias)
 
+@float32_backward
 def _backward_rho(ctx, relevance_output):
-    input, weight, bias = ctx.saved_tensors
+    input, weight, bias = float32(*ctx.saved_tensors)
     rho                 = ctx.rho
     incr                = ctx.incr
 
@@ -59,11 +60,12 @@ def _forward_alpha_beta(ctx, input, weight, bias):
     ctx.save_for_backward(input, weight, bias)
     return Z
 
+@float32_backward
 def _backward_alpha_beta(alpha, beta, ctx, relevance_output):
     """
         Inspired by https://github.com/albermax/innvestigate/blob/1ed38a377262236981090bb0989d2e1a6892a0b1/innvestigate/analyzer/relevance_based/relevance_rule.py#L270
     """
-    input, weights, bias = ctx.saved_tensors
+    input, weights, bias = float32(*ctx.saved_tensors)
     sel = weights > 0
     zeros = torch.zeros_like(weights)
 
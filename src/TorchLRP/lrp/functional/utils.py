@@ -1,4 +1,6 @@
 import torch
+import functools
+import contextlib
 
 # # # rhos
 identity_fn    = lambda w, b: (w, b)
@@ -17,6 +19,31 @@ add_epsilon_fn = lambda e: lambda x:   x + ((x > 0).float()*2-1) * e
 
 
 # # # Other stuff
+def float32(*tensors):
+    """ Upcasts half precision tensors to float32, leaves float32 and float64 ones untouched. """
+    return [t.float() if t is not None and t.dtype in (torch.float16, torch.bfloat16) else t for t in tensors]
+
+def float32_backward(backward):
+    """
+        Runs a relevance backward pass in at least float32, also under autocast. Relevances are 
+        divided by the pre-activations Z, whose small values are lost in half precision. Saved 
+        tensors should be read through `float32`, float64 passes stay in float64.
+    """
+    @functools.wraps(backward)
+    def _backward(*args):
+        *args, relevance_output = args
+        if hasattr(torch, "autocast"):
+            no_autocast = torch.autocast(relevance_output.device.type, enabled=False)
+        elif torch.is_autocast_enabled():
+            # torch < 1.10 only has cuda autocast
+            no_autocast = torch.cuda.amp.autocast(enabled=False)
+        else:
+            no_autocast = contextlib.nullcontext()
+
+        with no_autocast:
+            return backward(*args, *float32(relevance_output))
+    return _backward
+
 def safe_divide(a, b):
     return a / (b + (b == 0).float())
 
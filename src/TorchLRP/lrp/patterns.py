@@ -7,6 +7,7 @@ from tqdm import tqdm
 __all__  = [
     'fit_patternnet',
     'fit_patternnet_positive',
+    'PatternStatistics',
 ]
 
 """
@@ -15,29 +16,81 @@ __all__  = [
     https://github.com/albermax/innvestigate/blob/master/innvestigate/analyzer/pattern_based.py
 
 """
-class RunningMean:
-    def __init__(self, shape, device):
-        self.value = torch.zeros(shape, device=device)
-        self.count = 0
-
-    def update(self, mean, cnt):
-        total       = self.count + cnt
-        new_factor  = safe_divide(cnt, total)
-        old_factor  = 1 - new_factor
-        self.value  = self.value * old_factor + mean * (new_factor)
-        self.count += cnt
-
+class PatternStatistics:
+    """
+        Streaming sums needed by the pattern estimator, one entry per kernel layer. Sums are 
+        accumulated in float64, so that their size (and the memory) does not depend on the number 
+        of processed inputs. Statistics can be checkpointed with `save` and resumed with `load`.
+    """
+    def __init__(self):
+        self.sum_x      = []
+        self.sum_y      = []
+        self.sum_xy     = []
+        self.cnt        = []
+        self.cnt_all    = []
+        self.n_batches  = 0
+
+    def update(self, layer, x, y, y_masked, mask):
+        x, y, y_masked, mask = x.double(), y.double(), y_masked.double(), mask.double()
+
+        stats = (x.t() @ mask, y.sum(0), x.t() @ y_masked, 
+                 mask.sum(axis=0, keepdims=True), torch.ones_like(mask).sum(axis=0, keepdims=True))
+
+        if layer == len(self.sum_x):
+            for values, stat in zip(self._values(), stats):
+                values.append(stat)
+        else:
+            for values, stat in zip(self._values(), stats):
+                values[layer] += stat
+
+    def _values(self):
+        return self.sum_x, self.sum_y, self.sum_xy, self.cnt, self.cnt_all
+
+    def means(self, layer):
+        x_mean  = safe_divide(self.sum_x[layer], self.cnt[layer])
+        y_mean  = safe_divide(self.sum_y[layer], self.cnt_all[layer])
+        xy_mean = safe_divide(self.sum_xy[layer], self.cnt[layer])
+        return x_mean, y_mean, xy_mean
+
+    def state_dict(self):
+        return {'sum_x': self.sum_x, 'sum_y': self.sum_y, 'sum_xy': self.sum_xy, 
+                'cnt': self.cnt, 'cnt_all': self.cnt_all, 'n_batches': self.n_batches}
+
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value)
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        stats = cls()
+        stats.load_state_dict(torch.load(path, map_location=device))
+        return stats
+
+
+def _sequential_layers(model):
+    """
+        Layers of `model`, which is either a `torch.nn.Sequential` or a module wrapping one 
+        (e.g. `baseNN.model`).
+    """
+    if isinstance(model, torch.nn.Sequential): 
+        return list(model)
+
+    for child in model.children():
+        if isinstance(child, torch.nn.Sequential): 
+            return list(child)
+
+    raise NotImplementedError("Patterns can only be fitted on sequential models.")
+
+def _is_kernel_layer(module):
+    return isinstance(module, torch.nn.Linear) or isinstance(module, torch.nn.Conv2d)
 
 def _prod(module, x, y, mask):
     y_masked = y * mask
 
-    x_copy = x * 1. #  [bs , h]
-
-    if isinstance(module, torch.nn.Linear):
-        W       = module.weight     # only for linear layers
-        W_fn    = lambda w: w.t()   # only for linear layers
-
-    elif isinstance(module, torch.nn.Conv2d): 
+    if isinstance(module, torch.nn.Conv2d): 
         p1, p2 = module.padding
         s1, s2 = module.stride
         k1, k2 = module.kernel_size
@@ -46,7 +99,6 @@ def _prod(module, x, y, mask):
         bs, c, h, w, *_ = x.shape # [bs, c, h, w, kh, kw]
 
         x = x.permute(0, 2, 3, 1, 4, 5).contiguous() 
-        # [ bs, h ]
         x = x.view( -1, c*k1*k2, ) # [ bs*h*w, c*kh*kw ]
 
         def reshape_output(o):
@@ -57,92 +109,92 @@ def _prod(module, x, y, mask):
         y           = reshape_output(y)         # [ bs, h, w, c ] -> [ bs*h*w, out_c ]
         mask        = reshape_output(mask)      # [ bs, h, w, c ] -> [ bs*h*w, out_c ]
 
+    elif not isinstance(module, torch.nn.Linear):
+        raise NotImplementedError()
+
+    return x, y, y_masked, mask
+
+def _weights(module):
+    if isinstance(module, torch.nn.Linear):
+        W       = module.weight     # only for linear layers
+        W_fn    = lambda w: w.t()   # only for linear layers
+
+    elif isinstance(module, torch.nn.Conv2d): 
         W       = module.weight.view(module.out_channels, -1) 
         def W_fn(w):
             w = w.view(W.t().shape)
             w = w.t().contiguous()
             return w.view(module.weight.shape)
     else:
-        raise NotImplmentedError()
+        raise NotImplementedError()
 
-    cnt     = mask.sum(axis=0, keepdims=True)
-    cnt_all = torch.ones_like(mask).sum(axis=0, keepdims=True)
+    return W, W_fn
 
-    x_mean  = safe_divide(x.t() @ mask, cnt)
-    xy_mean = safe_divide(x.t() @ y_masked, cnt)
-    y_mean  = safe_divide(y.sum(0), cnt_all)
+def _fit_pattern(model, train_loader, max_iter, device, mask_fn = lambda y: torch.ones_like(y), 
+                 chunk_size=32, stats=None, checkpoint=None, checkpoint_every=100):
+    """
+        Single streaming pass over `train_loader`. Each batch is unfolded `chunk_size` inputs at a 
+        time, which bounds the memory of the [chunk_size*h*w, c*kh*kw] conv matrices. 
+        When `stats` is given, the batches it has already seen are skipped (this requires a loader 
+        without shuffling). If `checkpoint` is a path, statistics are saved there every 
+        `checkpoint_every` batches.
+    """
+    layers = _sequential_layers(model)
+    stats = PatternStatistics() if stats is None else stats
 
-    return cnt, cnt_all, x_mean, y_mean, xy_mean, W, W_fn
+    for b, (x, *_) in enumerate(tqdm(train_loader)): 
 
-def _fit_pattern(model, train_loader, max_iter, device, mask_fn = lambda y: torch.ones_like(y)):
-    stats_x     = [] 
-    stats_y     = []
-    stats_xy    = []
-    weights     = []
-    cnt         = []
-    cnt_all     = []
+        if max_iter is not None and b == max_iter: break
+        if b < stats.n_batches: continue
 
-    first = True
-    for b, (x, _) in enumerate(tqdm(train_loader)): 
         x = x.to(device)
 
         i = 0
-        for m in model:
+        for m in layers:
             y = m(x) # Note, this includes bias.
-            if not (isinstance(m, torch.nn.Linear) or isinstance(m, torch.nn.Conv2d)): 
-                x = y.clone()
+            if not _is_kernel_layer(m): 
+                x = y
                 continue
             
             mask = mask_fn(y).float().to(device)
             if isinstance(m, torch.nn.Conv2d): y_wo_bias = y - m.bias.view(-1, 1, 1) 
             else:                              y_wo_bias = y - m.bias
 
-            cnt_, cnt_all_, x_, y_, xy_, w, w_fn = _prod(m, x, y_wo_bias, mask)
-
-            if first:
-                stats_x.append(RunningMean(x_.shape, device))
-                stats_y.append(RunningMean(y_.shape, device)) # Use all y
-                stats_xy.append(RunningMean(xy_.shape, device))
-                weights.append((w, w_fn))
+            for start in range(0, len(x), chunk_size):
+                chunk = slice(start, start+chunk_size)
+                stats.update(i, *_prod(m, x[chunk], y_wo_bias[chunk], mask[chunk]))
 
-            stats_x[i].update(x_, cnt_)
-            stats_y[i].update(y_.sum(0), cnt_all_)
-            stats_xy[i].update(xy_, cnt_)
-
-            x = y.clone()
+            x = y
             i += 1
 
-            
-        first = False
+        stats.n_batches += 1
+        if checkpoint is not None and stats.n_batches % checkpoint_every == 0:
+            stats.save(checkpoint)
 
-        if max_iter is not None and b+1 == max_iter: break
+    if checkpoint is not None:
+        stats.save(checkpoint)
 
     def pattern(x_mean, y_mean, xy_mean, W2d):
-        x_  = x_mean.value
-        y_  = y_mean.value
-        xy_ = xy_mean.value
-
         W, w_fn = W2d
-        ExEy = x_ * y_
-        cov_xy = xy_ - ExEy # [in, out]
+        ExEy = x_mean * y_mean
+        cov_xy = xy_mean - ExEy # [in, out]
 
-        w_cov_xy = torch.diag(W @ cov_xy) # [out,]
+        w_cov_xy = torch.diag(W.double() @ cov_xy) # [out,]
 
         A = safe_divide(cov_xy, w_cov_xy[None, :])
-        A = w_fn(A) # Reshape to original kernel size
+        A = w_fn(A.to(W.dtype)) # Reshape to original kernel size
 
         return A
 
-    patterns = [pattern(*vars) for vars in zip(stats_x, stats_y, stats_xy, weights)]
+    weights = [_weights(m) for m in layers if _is_kernel_layer(m)]
+    patterns = [pattern(*stats.means(i), W2d) for i, W2d in enumerate(weights)]
     return patterns
 
 
 @torch.no_grad()
-def fit_patternnet(model, train_loader, max_iter=None, device='cpu'):
-    return _fit_pattern(model, train_loader, max_iter, device)
+def fit_patternnet(model, train_loader, max_iter=None, device='cpu', **kwargs):
+    return _fit_pattern(model, train_loader, max_iter, device, **kwargs)
 
 @torch.no_grad()
-def fit_patternnet_positive(model, train_loader, max_iter=None, device='cpu'):
-    return _fit_pattern(model, train_loader, max_iter, device, lambda y: y >= 0)
-
-
+def fit_patternnet_positive(model, train_loader, max_iter=None, device='cpu', **kwargs):
+    return _fit_pattern(model, train_loader, max_iter, device, lambda y: y >= 0, **kwargs)
@@ -5,6 +5,8 @@ import numpy as np
 from utils.data import *
 from utils import savedir
 from utils.seeding import *
+from utils.networks import load_model
+from utils.profiling import stage, save_report
 from attacks.gradient_based import evaluate_attack
 from attacks.run_attacks import *
 from networks.baseNN import *
@@ -39,18 +41,15 @@ if args.model=="baseNN":
 
     x_test, y_test, inp_shape, out_size = load_dataset(dataset_name=model["dataset"], n_inputs=n_inputs)[2:]
 
-    savedir = get_model_savedir(model=args.model, dataset=model["dataset"], architecture=model["architecture"], 
-                                debug=args.debug, model_idx=args.model_idx)
-    
-    net = baseNN(inp_shape, out_size, *list(model.values()))
-    net.load(savedir=savedir, device=args.device)
+    net, savedir = load_model("baseNN", args.model_idx, inp_shape, out_size, device=args.device, debug=args.debug)
 
     if args.load:
         x_attack = load_attack(method=args.attack_method, model_savedir=savedir)
     
     else:
-        x_attack = attack(net=net, x_test=x_test, y_test=y_test,
-                          device=args.device, method=args.attack_method)
+        with stage("attack"):
+            x_attack = attack(net=net, x_test=x_test, y_test=y_test,
+                              device=args.device, method=args.attack_method)
         save_attack(x_test, x_attack, method=args.attack_method, model_savedir=savedir)
 
     evaluate_attack(net=net, x_test=x_test, x_attack=x_attack, y_test=y_test, device=args.device)
@@ -63,35 +62,17 @@ else:
 
         x_test, y_test, inp_shape, out_size = load_dataset(dataset_name=m["dataset"], n_inputs=n_inputs)[2:]
 
-        savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-                              debug=args.debug, model_idx=args.model_idx)
-
-        net = BNN(m["dataset"], *list(m.values())[1:], inp_shape, out_size)
-
     elif args.model=="redBNN":
         
         m = redBNN_settings["model_"+str(args.model_idx)]
-        base_m = baseNN_settings["model_"+str(m["baseNN_idx"])]
 
         x_test, y_test, inp_shape, out_size = load_dataset(dataset_name=m["dataset"], n_inputs=n_inputs)[2:]
 
-        layer_idx=args.redBNN_layer_idx+basenet.n_learnable_layers+1 if args.redBNN_layer_idx<0 else args.redBNN_layer_idx
-        savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-                              debug=args.debug, model_idx=args.model_idx, layer_idx=layer_idx)
-        basenet = baseNN(inp_shape, out_size, *list(base_m.values()))
-        basenet_savedir = get_model_savedir(model="baseNN", dataset=m["dataset"], 
-                          architecture=m["architecture"], debug=args.debug, model_idx=m["baseNN_idx"])
-        basenet.load(savedir=basenet_savedir, device=args.device)
-
-        hyp = get_hyperparams(m)
-
-        net = redBNN(dataset_name=m["dataset"], inference=m["inference"], base_net=basenet, hyperparams=hyp,
-                     layer_idx=layer_idx)
-
     else:
         raise NotImplementedError
 
-    net.load(savedir=savedir, device=args.device)
+    net, savedir = load_model(args.model, args.model_idx, inp_shape, out_size, layer_idx=args.redBNN_layer_idx, 
+                              device=args.device, debug=args.debug)
 
     if args.load:
 
@@ -99,7 +80,7 @@ else:
 
             x_attack = load_attack(method=args.attack_method, model_savedir=savedir, n_samples=n_samples)
             evaluate_attack(net=net, x_test=x_test, x_attack=x_attack, y_test=y_test, 
-                              device=args.device, n_samples=n_samples)
+                              device=args.device, n_samples=n_samples, return_uncertainty=True)
 
         if m["inference"]=="svi":
             mode_attack = load_attack(method=args.attack_method, model_savedir=savedir, 
@@ -112,17 +93,22 @@ else:
         num_workers = 0 if args.device=="cuda" else 4
 
         for n_samples in bayesian_attack_samples:
-            x_attack = attack(net=net, x_test=x_test, y_test=y_test, device=args.device,
-                              method=args.attack_method, n_samples=n_samples)
+            with stage("attack"), stage("samp="+str(n_samples)):
+                x_attack = attack(net=net, x_test=x_test, y_test=y_test, device=args.device,
+                                  method=args.attack_method, n_samples=n_samples)
             save_attack(x_test, x_attack, method=args.attack_method, 
                              model_savedir=savedir, n_samples=n_samples)
             evaluate_attack(net=net, x_test=x_test, x_attack=x_attack, y_test=y_test, 
-                              device=args.device, n_samples=n_samples)
+                              device=args.device, n_samples=n_samples, return_uncertainty=True)
 
         if m["inference"]=="svi":
-            mode_attack = attack(net=net, x_test=x_test, y_test=y_test, device=args.device,
-                              method=args.attack_method, n_samples=n_samples, avg_posterior=True)
+            with stage("attack"), stage("avg_post"):
+                mode_attack = attack(net=net, x_test=x_test, y_test=y_test, device=args.device,
+                                  method=args.attack_method, n_samples=n_samples, avg_posterior=True)
             save_attack(x_test, mode_attack, method=args.attack_method,   
                              model_savedir=savedir, n_samples=n_samples, atk_mode=True)
             evaluate_attack(net=net, x_test=x_test, x_attack=mode_attack, y_test=y_test, 
                               device=args.device, n_samples=n_samples, avg_posterior=True)
+
+if not args.load:
+    save_report()
@@ -15,6 +15,9 @@ from utils.data import *
 from utils.seeding import *
 from utils.savedir import *
 from utils.networks import *
+from utils.precision import autocast, precision_forward
+from utils.profiling import profile_stage
+from utils.uncertainty import uncertainty_measures, UNCERTAINTY_MEASURES
 from attacks.robustness_measures import *
 from plot.attacks import plot_grid_attacks
 
@@ -91,6 +94,7 @@ def pgd_attack(net, image, label, hyperparams=None, n_samples=None, sample_idxs=
 	perturbed_image = image.detach()
 	return perturbed_image
 
+@profile_stage("attack")
 def attack(net, x_test, y_test, device, method,
 		   hyperparams=None, n_samples=None, sample_idxs=None, avg_posterior=False):
 
@@ -143,25 +147,50 @@ def load_attack(method, model_savedir, atk_mode=False, n_samples=None):
 	return load_from_pickle(path=savedir, filename=filename)
 
 def evaluate_attack(net, x_test, x_attack, y_test, device, n_samples=None, sample_idxs=None, 
-					 avg_posterior=False, return_classification_idxs=False):
+					 avg_posterior=False, return_classification_idxs=False, closed_form=False, precision="float32",
+					 return_uncertainty=False, tolerance=None, min_samples=10):
 	""" Evaluates the network on the original data and its adversarially perturbed version. 
 	When using a Bayesian network `n_samples` should be specified for the evaluation.     
+	With `closed_form` redBNNs with a Bayesian last layer use the sample-free predictive.
+	`precision` is one of `utils.precision.PRECISIONS`, outputs are always float32.
+	With `return_uncertainty` the `utils.uncertainty.UNCERTAINTY_MEASURES` of the original and adversarial 
+	predictions are also returned, computed from the same posterior samples as the outputs. Predictions without
+	sampling count as a single sample.
+	With a `tolerance` Bayesian networks draw at most `n_samples` samples for each image, stopping when the mean 
+	prediction converges (see `BNN.forward`), and the samples used on the original and adversarial images are
+	returned last.
 	"""
 	print(f"\nEvaluating against the attacks", end="")
 	if avg_posterior:
 		print(" with the posterior mode")
+	elif closed_form:
+		print(" with the closed form predictive")
 	else:
 		if n_samples:
-			print(f" with {n_samples} defense samples")
+			print(f" with {'at most ' if tolerance else ''}{n_samples} defense samples")
+
+	forward_kwargs = {"closed_form":True} if closed_form else {}
+	sampling = n_samples is not None and not avg_posterior and not closed_form
+	adaptive = sampling and tolerance is not None
+	sample_outputs = sampling and return_uncertainty and not adaptive
+
+	if adaptive:
+		forward_kwargs.update({"tolerance":tolerance, "min_samples":min_samples, "entropy":return_uncertainty})
+	elif sample_outputs:
+		forward_kwargs["expected_out"] = False
+
+	net, device = precision_forward(net, precision, device)
 	
 	x_test, x_attack, y_test = x_test.to(device), x_attack.to(device), y_test.to(device)
 
 	test_loader = DataLoader(dataset=list(zip(x_test, y_test)), batch_size=128, shuffle=False)
 	attack_loader = DataLoader(dataset=list(zip(x_attack, y_test)), batch_size=128, shuffle=False)
 
-	with torch.no_grad():
+	with torch.no_grad(), autocast(precision, device):
 
 		original_outputs = []
+		original_uncertainty = []
+		original_n_samples = []
 		original_correct = 0.0
 		correct_class_idxs = []
 		batch_size=0
@@ -169,7 +198,8 @@ def evaluate_attack(net, x_test, x_attack, y_test, device, n_samples=None, sampl
 		for batch_idx, (images, labels) in enumerate(test_loader):
 
 			out = net.forward(images, n_samples=n_samples, sample_idxs=sample_idxs, avg_posterior=avg_posterior,
-								softmax=True)
+								softmax=True, **forward_kwargs)
+			out = _expected_outputs(out, sample_outputs, return_uncertainty, original_uncertainty, original_n_samples)
 			original_correct += ((out.argmax(-1) == labels.argmax(-1)).sum().item())
 			original_outputs.append(out)
 
@@ -183,6 +213,8 @@ def evaluate_attack(net, x_test, x_attack, y_test, device, n_samples=None, sampl
 			print("correct_class_idxs", correct_class_idxs)
 
 		adversarial_outputs = []
+		adversarial_uncertainty = []
+		adversarial_n_samples = []
 		adversarial_correct = 0.0
 		wrong_atk_class_idxs = []
 		correct_atk_class_idxs = []
@@ -190,7 +222,9 @@ def evaluate_attack(net, x_test, x_attack, y_test, device, n_samples=None, sampl
 
 		for batch_idx, (attacks, labels) in enumerate(attack_loader):
 			out = net.forward(attacks, n_samples=n_samples, sample_idxs=sample_idxs, avg_posterior=avg_posterior,
-								softmax=True)
+								softmax=True, **forward_kwargs)
+			out = _expected_outputs(out, sample_outputs, return_uncertainty, adversarial_uncertainty, 
+									adversarial_n_samples)
 			adversarial_correct += ((out.argmax(-1) == labels.argmax(-1)).sum().item())
 			adversarial_outputs.append(out)
 
@@ -217,7 +251,42 @@ def evaluate_attack(net, x_test, x_attack, y_test, device, n_samples=None, sampl
 		adversarial_outputs = torch.cat(adversarial_outputs)
 		softmax_rob = softmax_robustness(original_outputs, adversarial_outputs)
 
+	outputs = [original_outputs, adversarial_outputs, softmax_rob]
+
 	if return_classification_idxs:
-		return original_outputs, adversarial_outputs, softmax_rob, successful_atk_idxs, failed_atk_idxs
-	else:
-		return original_outputs, adversarial_outputs, softmax_rob
+		outputs.extend([successful_atk_idxs, failed_atk_idxs])
+
+	if return_uncertainty:
+		uncertainty = {"original":_cat_measures(original_uncertainty), 
+					   "adversarial":_cat_measures(adversarial_uncertainty)}
+		for measure in UNCERTAINTY_MEASURES:
+			print(f"\n{measure} = {uncertainty['original'][measure].mean().item():.4f}\t"
+				  f"adversarial {measure} = {uncertainty['adversarial'][measure].mean().item():.4f}", end="")
+		outputs.append(uncertainty)
+
+	if adaptive:
+		used_samples = {"original":torch.cat(original_n_samples), "adversarial":torch.cat(adversarial_n_samples)}
+		print(f"\navg. samples = {used_samples['original'].float().mean().item():.2f}\t"
+			  f"adversarial avg. samples = {used_samples['adversarial'].float().mean().item():.2f}", end="")
+		outputs.append(used_samples)
+
+	return tuple(outputs)
+
+def _expected_outputs(out, sample_outputs, return_uncertainty, uncertainty, used_samples):
+	""" 
+	Expected outputs of a batch, from the stacked sample outputs, the adaptive moments or the expected outputs. 
+	Uncertainty measures and the samples used by adaptive sampling are appended to `uncertainty` and `used_samples`.
+	"""
+	if isinstance(out, dict):
+		used_samples.append(out["n_samples"])
+		if return_uncertainty:
+			uncertainty.append({measure:out[measure].float() for measure in UNCERTAINTY_MEASURES})
+		return out["mean"].float()
+
+	samples = out.float() if sample_outputs else out.float().unsqueeze(0)
+	if return_uncertainty:
+		uncertainty.append(uncertainty_measures(samples))
+	return samples.mean(0)
+
+def _cat_measures(batch_measures):
+	return {measure:torch.cat([measures[measure] for measures in batch_measures]) for measure in UNCERTAINTY_MEASURES}
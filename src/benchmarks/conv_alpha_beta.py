@@ -0,0 +1,105 @@
+"""
+Benchmark of the alpha-beta LRP rule on convolutional layers: batched implementation in 
+`lrp.functional.conv` vs. the previous four-convolutions-per-pass formulation. The float64 parity check 
+ensures that double precision relevances are not rounded to float32.
+
+Run from `src/`:
+python benchmarks/conv_alpha_beta.py --batch_size=128 --device=cpu
+"""
+
+import os
+import sys
+import time
+import pathlib
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+base_path = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, base_path.as_posix())
+
+from TorchLRP import lrp
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", default=128, type=int)
+parser.add_argument("--in_channels", default=16, type=int)
+parser.add_argument("--out_channels", default=32, type=int)
+parser.add_argument("--image_size", default=28, type=int)
+parser.add_argument("--n_iters", default=20, type=int)
+parser.add_argument("--device", default='cpu', type=str, help="cpu, cuda")
+args = parser.parse_args()
+
+
+def reference_alpha_beta_backward(alpha, beta, input, weights, relevance_output):
+    """ Previous implementation, only valid for stride=1 and padding=1. """
+    Z = F.conv2d(input, weights, None, 1, 1) # forward pass of `_conv_alpha_beta_forward`
+
+    sel = weights > 0
+    zeros = torch.zeros_like(weights)
+
+    weights_pos       = torch.where(sel,  weights, zeros)
+    weights_neg       = torch.where(~sel, weights, zeros)
+
+    input_pos         = torch.where(input >  0, input, torch.zeros_like(input))
+    input_neg         = torch.where(input <= 0, input, torch.zeros_like(input))
+
+    def f(X1, X2, W1, W2): 
+
+        Z1  = F.conv2d(X1, W1, bias=None, stride=1, padding=1) 
+        Z2  = F.conv2d(X2, W2, bias=None, stride=1, padding=1)
+        Z   = Z1 + Z2
+
+        rel_out = relevance_output / (Z + (Z==0).float()* 1e-6)
+
+        t1 = F.conv_transpose2d(rel_out, W1, bias=None, padding=1) 
+        t2 = F.conv_transpose2d(rel_out, W2, bias=None, padding=1)
+
+        return t1 * X1 + t2 * X2
+
+    pos_rel = f(input_pos, input_neg, weights_pos, weights_neg)
+    neg_rel = f(input_neg, input_pos, weights_pos, weights_neg)
+    return pos_rel * alpha - neg_rel * beta
+
+def batched_alpha_beta_backward(alpha, beta, input, weights, relevance_output):
+    x = input.detach().requires_grad_(True)
+    Z = lrp.functional.conv2d["alpha%dbeta%d" % (alpha, beta)](x, weights, None, 1, 1)
+    Z.backward(relevance_output)
+    return x.grad
+
+def timeit(fn, n_iters, device):
+    fn()
+    if device=="cuda":
+        torch.cuda.synchronize()
+
+    start = time.time()
+    for _ in range(n_iters):
+        fn()
+    if device=="cuda":
+        torch.cuda.synchronize()
+
+    return (time.time()-start)/n_iters
+
+
+torch.manual_seed(0)
+x = torch.randn(args.batch_size, args.in_channels, args.image_size, args.image_size, device=args.device)
+w = torch.randn(args.out_channels, args.in_channels, 3, 3, device=args.device)
+relevance = torch.rand(args.batch_size, args.out_channels, args.image_size, args.image_size, device=args.device)
+
+for alpha, beta in [(1, 0), (2, 1)]:
+
+    ref = reference_alpha_beta_backward(alpha, beta, x, w, relevance)
+    new = batched_alpha_beta_backward(alpha, beta, x, w, relevance)
+    max_err = (ref-new).abs().max().item()
+
+    ref_time = timeit(lambda: reference_alpha_beta_backward(alpha, beta, x, w, relevance), args.n_iters, args.device)
+    new_time = timeit(lambda: batched_alpha_beta_backward(alpha, beta, x, w, relevance), args.n_iters, args.device)
+
+    print(f"\nalpha{alpha}beta{beta}\tmax abs err = {max_err:.2e}")
+    print(f"reference = {1000*ref_time:.2f} ms\tbatched = {1000*new_time:.2f} ms\tspeedup = {ref_time/new_time:.2f}x")
+
+    ref64 = reference_alpha_beta_backward(alpha, beta, x.double(), w.double(), relevance.double())
+    new64 = batched_alpha_beta_backward(alpha, beta, x.double(), w.double(), relevance.double())
+    assert new64.dtype==torch.float64
+    rel_err64 = ((ref64-new64).norm()/ref64.norm()).item()
+    print(f"float64 relative err = {rel_err64:.2e}")
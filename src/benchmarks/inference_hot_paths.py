@@ -0,0 +1,237 @@
+"""
+Benchmark of the inference hot paths on small randomly initialized networks and synthetic MNIST-shaped data:
+forward passes over posterior samples, LRP explanations, attacks, LRP robustness and pickling.
+Each run is appended to a JSON history, together with the current commit, and throughputs are compared
+against the previous run.
+
+Run from `src/`:
+python benchmarks/inference_hot_paths.py --n_images=32 --device=cpu
+"""
+
+import os
+import sys
+import json
+import time
+import copy
+import pathlib
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import torch
+import pyro
+
+base_path = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, base_path.as_posix())
+
+from utils.lrp import compute_explanations, lrp_robustness
+from utils.data import save_to_pickle, load_from_pickle
+from networks.baseNN import baseNN
+from networks.fullBNN import BNN
+from networks.redBNN import redBNN
+import attacks.run_attacks as run_attacks
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n_images", default=32, type=int, help="Number of synthetic images.")
+parser.add_argument("--n_attack_images", default=4, type=int, help="Number of attacked images.")
+parser.add_argument("--hidden_size", default=32, type=int)
+parser.add_argument("--architectures", default="fc,fc2,fc4,conv", type=str, help="baseNN architectures.")
+parser.add_argument("--bayesian_architecture", default="fc2", type=str, help="BNN and redBNN architecture.")
+parser.add_argument("--n_samples_list", default="1,10,50", type=str, help="Posterior samples in forward passes.")
+parser.add_argument("--lrp_samples", default=5, type=int, help="Posterior samples in Bayesian explanations.")
+parser.add_argument("--attack_samples", default=2, type=int, help="Posterior samples in Bayesian attacks.")
+parser.add_argument("--attacks", default="fgsm,pgd,cw,deepfool", type=str)
+parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--stages", default="forward,explanations,attacks,robustness,pickle", type=str)
+parser.add_argument("--n_iters", default=5, type=int, help="Repetitions of the forward passes.")
+parser.add_argument("--history", default=os.path.join(base_path, "benchmarks", "results", "history.json"),
+                    type=str, help="JSON file collecting the results of all the runs.")
+parser.add_argument("--device", default='cpu', type=str, help="cpu, cuda")
+args = parser.parse_args()
+
+stages = args.stages.split(",")
+n_samples_list = [int(n_samples) for n_samples in args.n_samples_list.split(",")]
+
+if args.device=="cuda":
+    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+results = []
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the process (ru_maxrss is in KB on linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def synchronize():
+    if args.device=="cuda":
+        torch.cuda.synchronize()
+
+def run_stage(stage, fn, model, n_images, n_samples=1, n_iters=1, **tags):
+    """ Times `fn` and records throughput and memory usage of the stage. """
+    synchronize()
+    if args.device=="cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        out = fn()
+    synchronize()
+    elapsed = (time.perf_counter()-start)/n_iters
+
+    result = {"stage":stage, "model":model, **tags, "n_images":n_images, "n_samples":n_samples,
+              "time":elapsed, "images/s":n_images/elapsed, "samples/s":n_images*n_samples/elapsed,
+              "peak_rss_mb":peak_rss_mb(), "rss_growth_mb":peak_rss_mb()-rss_before}
+
+    if args.device=="cuda":
+        result["cuda_peak_mb"] = torch.cuda.max_memory_allocated()/1024**2
+
+    print(f"\n{stage}\t{model}\t{tags}\tn_samples={n_samples}\ttime={elapsed:.4f}s\t"
+          f"images/s={result['images/s']:.2f}\tsamples/s={result['samples/s']:.2f}\t"
+          f"peak rss={result['peak_rss_mb']:.1f}MB")
+
+    results.append(result)
+    return out
+
+def build_models(inp_shape, num_classes, x):
+
+    models = {}
+    for architecture in args.architectures.split(","):
+        models["baseNN_"+architecture] = baseNN(inp_shape, num_classes, "mnist", args.hidden_size, "leaky",
+                                                architecture, 1, 0.001)
+
+    pyro.clear_param_store()
+    architecture = args.bayesian_architecture
+
+    svi_bnn = BNN("mnist", args.hidden_size, "leaky", architecture, "svi", 1, 0.01, None, None,
+                  inp_shape, num_classes)
+    svi_bnn.guide(x[:1]) # initializes the variational parameters
+    models["fullBNN_svi_"+architecture] = svi_bnn
+
+    hmc_bnn = BNN("mnist", args.hidden_size, "leaky", architecture, "hmc", None, None, max(n_samples_list), 0,
+                  inp_shape, num_classes)
+    hmc_bnn.posterior_samples = []
+    for _ in range(hmc_bnn.hmc_samples):
+        net = copy.deepcopy(hmc_bnn.basenet)
+        net.load_state_dict({key:value+0.01*torch.randn_like(value) for key, value in net.state_dict().items()})
+        hmc_bnn.posterior_samples.append(net)
+    models["fullBNN_hmc_"+architecture] = hmc_bnn
+
+    basenet = copy.deepcopy(models["baseNN_"+architecture]) if "baseNN_"+architecture in models else \
+              baseNN(inp_shape, num_classes, "mnist", args.hidden_size, "leaky", architecture, 1, 0.001)
+    red_bnn = redBNN(dataset_name="mnist", inference="svi", hyperparams={"epochs":1, "lr":0.01}, base_net=basenet,
+                     layer_idx=-1)
+    w, b, w_name, b_name = red_bnn._bayesian_layer(red_bnn.layer_idx)
+    with red_bnn.param_store:
+        pyro.param(w_name+"_scale", 0.1*torch.ones_like(w)) # redBNN guide takes scales as they are
+        pyro.param(b_name+"_scale", 0.1*torch.ones_like(b))
+    red_bnn.guide(x[:1])
+    models["redBNN_svi_"+architecture] = red_bnn
+
+    for net in models.values():
+        net.to(args.device)
+
+    return models
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=base_path, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return None
+
+def _result_key(result):
+    return json.dumps({key:value for key, value in result.items() if key in ["stage", "model", "method", "n_samples"]},
+                      sort_keys=True)
+
+def save_history(results):
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    if len(history)>0:
+        print("\nThroughput vs. previous run (commit "+str(history[-1]["commit"])+"):\n")
+        previous = {_result_key(result):result for result in history[-1]["results"]}
+        for result in results:
+            key = _result_key(result)
+            if key in previous:
+                print(f"{key}\timages/s ratio = {result['images/s']/previous[key]['images/s']:.2f}")
+
+    history.append({"commit":git_commit(), "date":time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "device":args.device, "torch":torch.__version__, "args":vars(args), "results":results})
+
+    os.makedirs(os.path.dirname(args.history), exist_ok=True)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=1)
+    print("\nSaving benchmark history:", args.history)
+
+
+torch.manual_seed(0)
+inp_shape, num_classes = (1, 28, 28), 10
+x = torch.rand(args.n_images, *inp_shape, device=args.device)
+y = torch.eye(num_classes, device=args.device)[torch.randint(num_classes, (args.n_images,), device=args.device)]
+
+models = build_models(inp_shape, num_classes, x)
+explanations = {}
+
+for name, net in models.items():
+
+    bayesian = hasattr(net, "basenet")
+    layer_idx = net.basenet.learnable_layers_idxs[-1] if bayesian else net.learnable_layers_idxs[-1]
+
+    if "forward" in stages:
+
+        with torch.no_grad():
+            if bayesian:
+                for n_samples in n_samples_list:
+                    run_stage("forward", lambda: net.forward(x, n_samples=n_samples), model=name,
+                              n_images=args.n_images, n_samples=n_samples, n_iters=args.n_iters)
+            else:
+                run_stage("forward", lambda: net.forward(x), model=name, n_images=args.n_images, n_iters=args.n_iters)
+
+    if "explanations" in stages or "robustness" in stages or "pickle" in stages:
+
+        if bayesian:
+            for method in ["avg_prediction", "avg_heatmap"]:
+                explanations[name] = run_stage("explanations", lambda: compute_explanations(x, net, rule=args.rule,
+                                               method=method, n_samples=args.lrp_samples, layer_idx=layer_idx),
+                                               model=name, method=method, n_images=args.n_images,
+                                               n_samples=args.lrp_samples)
+        else:
+            explanations[name] = run_stage("explanations", lambda: compute_explanations(x, net, rule=args.rule,
+                                           method=None, layer_idx=layer_idx), model=name, n_images=args.n_images)
+
+    if "attacks" in stages:
+
+        x_attack, y_attack = x[:args.n_attack_images], y[:args.n_attack_images]
+
+        for method in args.attacks.split(","):
+            if bayesian:
+                run_stage("attacks", lambda: run_attacks.attack(net, x_attack, y_attack, args.device, method,
+                          n_samples=args.attack_samples), model=name, method=method, n_images=args.n_attack_images,
+                          n_samples=args.attack_samples)
+            else:
+                run_stage("attacks", lambda: run_attacks.attack(net, x_attack, y_attack, args.device, method),
+                          model=name, method=method, n_images=args.n_attack_images)
+
+    if "robustness" in stages:
+
+        lrp = explanations[name]
+        attack_lrp = lrp+0.1*lrp.std()*torch.randn_like(lrp)
+
+        for method in ["imagewise", "pixelwise", "wasserstein", "kl", "js", "spearman", "kendall"]:
+            run_stage("robustness", lambda: lrp_robustness(lrp, attack_lrp, topk=20, method=method),
+                      model=name, method=method, n_images=args.n_images)
+
+    if "pickle" in stages:
+
+        with tempfile.TemporaryDirectory() as savedir:
+            run_stage("pickle", lambda: save_to_pickle(explanations[name], path=savedir, filename="lrp"),
+                      model=name, method="save", n_images=args.n_images)
+            run_stage("pickle", lambda: load_from_pickle(path=savedir, filename="lrp"),
+                      model=name, method="load", n_images=args.n_images)
+
+save_history(results)
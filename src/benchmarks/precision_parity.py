@@ -0,0 +1,159 @@
+"""
+Parity report of the reduced precision policy (`utils/precision.py`) on small randomly initialized networks and
+synthetic MNIST-shaped data. FGSM attacks are computed once in float32, then each precision evaluates the networks
+on the clean and adversarial images and explains them with LRP. Throughputs, prediction agreement, softmax
+robustness and LRP robustness are compared against the first precision (float32 by default) and saved to a JSON
+report.
+
+Run from `src/`:
+python benchmarks/precision_parity.py --architectures=fc2,conv --precisions=float32,bfloat16,int8 --device=cpu
+"""
+
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+
+import torch
+import numpy as np
+import pyro
+
+base_path = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, base_path.as_posix())
+
+from utils.lrp import compute_explanations, lrp_robustness
+from networks.baseNN import baseNN
+from networks.fullBNN import BNN
+from attacks.gradient_based import attack, evaluate_attack
+from utils.precision import PRECISIONS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n_images", default=64, type=int, help="Number of synthetic images.")
+parser.add_argument("--n_lrp_images", default=8, type=int, help="Number of explained images.")
+parser.add_argument("--hidden_size", default=128, type=int)
+parser.add_argument("--architectures", default="fc2,conv", type=str, help="baseNN architectures.")
+parser.add_argument("--bayesian_architecture", default="fc2", type=str, help="fullBNN architecture.")
+parser.add_argument("--precisions", default=",".join(PRECISIONS), type=str)
+parser.add_argument("--n_samples", default=10, type=int, help="Posterior samples of the fullBNN.")
+parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--topk", default=20, type=int, help="Top k pixels in LRP robustness.")
+parser.add_argument("--n_iters", default=3, type=int, help="Repetitions of the timed evaluations.")
+parser.add_argument("--report", default=os.path.join(base_path, "benchmarks", "results", "precision_parity.json"),
+                    type=str)
+parser.add_argument("--device", default='cpu', type=str, help="cpu, cuda")
+args = parser.parse_args()
+
+precisions = args.precisions.split(",")
+
+
+def synchronize():
+    if args.device=="cuda":
+        torch.cuda.synchronize()
+
+def build_models(inp_shape, num_classes, x):
+
+    models = {}
+    for architecture in args.architectures.split(","):
+        models["baseNN_"+architecture] = baseNN(inp_shape, num_classes, "mnist", args.hidden_size, "leaky",
+                                                architecture, 1, 0.001)
+
+    architecture = args.bayesian_architecture
+    svi_bnn = BNN("mnist", args.hidden_size, "leaky", architecture, "svi", 1, 0.01, None, None,
+                  inp_shape, num_classes)
+    with svi_bnn.param_store:
+        for key, value in svi_bnn.basenet.state_dict().items():
+            pyro.param(f"{key}_loc", value.clone())
+            pyro.param(f"{key}_scale", torch.full_like(value, -5.))
+    models["fullBNN_svi_"+architecture] = svi_bnn
+
+    for net in models.values():
+        net.to(args.device)
+
+    return models
+
+def evaluate(net, precision, x, x_attack, y, n_samples):
+
+    evaluate_attack(net=net, x_test=x, x_attack=x_attack, y_test=y, device=args.device, n_samples=n_samples,
+                    precision=precision) # warmup
+    synchronize()
+
+    start = time.perf_counter()
+    for _ in range(args.n_iters):
+        outputs = evaluate_attack(net=net, x_test=x, x_attack=x_attack, y_test=y, device=args.device,
+                                  n_samples=n_samples, precision=precision)
+    synchronize()
+    elapsed = (time.perf_counter()-start)/args.n_iters
+
+    return [out.cpu() for out in outputs], 2*len(x)/elapsed
+
+def explain(net, precision, images, n_samples):
+    method = None if n_samples is None else "avg_prediction"
+    layer_idx = getattr(net, "basenet", net).learnable_layers_idxs[-1]
+    return compute_explanations(images, net, rule=args.rule, method=method, n_samples=n_samples, layer_idx=layer_idx,
+                                precision=precision).cpu()
+
+def relative_error(tensor, reference):
+    return ((tensor-reference).norm()/reference.norm()).item()
+
+
+torch.manual_seed(0)
+inp_shape, num_classes = (1, 28, 28), 10
+x = torch.rand(args.n_images, *inp_shape, device=args.device)
+y = torch.eye(num_classes, device=args.device)[torch.randint(num_classes, (args.n_images,), device=args.device)]
+
+models = build_models(inp_shape, num_classes, x)
+report = []
+
+for model_name, net in models.items():
+
+    n_samples = args.n_samples if hasattr(net, "basenet") else None
+    x_attack = attack(net=net, x_test=x, y_test=y, device=args.device, method="fgsm", n_samples=n_samples)
+    lrp_images, lrp_attacks = x[:args.n_lrp_images], x_attack[:args.n_lrp_images]
+
+    reference = None
+    for precision in precisions:
+
+        if precision=="int8" and hasattr(net, "basenet"):
+            continue
+
+        (outputs, atk_outputs, softmax_rob), throughput = evaluate(net, precision, x, x_attack, y, n_samples)
+        result = {"model":model_name, "precision":precision, "images/s":throughput,
+                  "softmax_robustness":softmax_rob.mean().item()}
+
+        if precision!="int8":
+            lrp = explain(net, precision, lrp_images, n_samples)
+            atk_lrp = explain(net, precision, lrp_attacks, n_samples)
+            lrp_rob = lrp_robustness(lrp, atk_lrp, topk=args.topk, method="imagewise")[0]
+            result["lrp_robustness"] = float(np.mean(lrp_rob))
+
+        if reference is None:
+            reference = {"images/s":throughput, "outputs":outputs, "atk_outputs":atk_outputs, 
+                         "softmax_rob":softmax_rob, "lrp":lrp, "atk_lrp":atk_lrp, "lrp_rob":lrp_rob}
+
+        else:
+            result["speedup"] = throughput/reference["images/s"]
+            result["prediction_agreement"] = (outputs.argmax(-1)==reference["outputs"].argmax(-1)
+                                              ).float().mean().item()
+            result["atk_prediction_agreement"] = (atk_outputs.argmax(-1)==reference["atk_outputs"].argmax(-1)
+                                                  ).float().mean().item()
+            result["max_softmax_error"] = (outputs-reference["outputs"]).abs().max().item()
+            result["max_softmax_robustness_error"] = (softmax_rob-reference["softmax_rob"]).abs().max().item()
+
+            if precision!="int8":
+                result["lrp_relative_error"] = relative_error(lrp, reference["lrp"])
+                result["atk_lrp_relative_error"] = relative_error(atk_lrp, reference["atk_lrp"])
+                result["max_lrp_robustness_error"] = float(np.abs(lrp_rob-reference["lrp_rob"]).max())
+
+        report.append(result)
+
+print("\n")
+for result in report:
+    print("\t".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+                    for key, value in result.items()))
+
+os.makedirs(os.path.dirname(args.report), exist_ok=True)
+with open(args.report, "w") as f:
+    json.dump({"args":vars(args), "results":report}, f, indent=1)
+print("\nSaved:", args.report)
@@ -0,0 +1,101 @@
+"""
+Benchmark of fullBNN SVI training throughput (examples/s) on synthetic MNIST-shaped data: the previous loop
+(single particle `Trace_ELBO` and a second guide trace for the training accuracy) vs. `BNN._svi_step` with
+sequential or vectorized ELBO particles.
+
+Run from `src/`:
+python benchmarks/svi_particles.py --architecture=fc2 --num_particles=1,4,16 --device=cpu
+"""
+
+import os
+import sys
+import time
+import pathlib
+import argparse
+
+import torch
+import pyro
+from pyro.infer import SVI, Trace_ELBO
+
+base_path = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, base_path.as_posix())
+
+from networks.fullBNN import BNN
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n_inputs", default=1024, type=int, help="Number of synthetic training images.")
+parser.add_argument("--batch_size", default=128, type=int)
+parser.add_argument("--hidden_size", default=32, type=int)
+parser.add_argument("--architecture", default="fc2", type=str, help="fc, fc2, fc4, conv")
+parser.add_argument("--num_particles", default="1,4,16", type=str, help="Numbers of ELBO particles.")
+parser.add_argument("--epochs", default=2, type=int)
+parser.add_argument("--device", default='cpu', type=str, help="cpu, cuda")
+args = parser.parse_args()
+
+if args.device=="cuda":
+    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+# `random_module` priors are not declared as events, which fails pyro shape validation
+pyro.enable_validation(False)
+
+
+def synchronize():
+    if args.device=="cuda":
+        torch.cuda.synchronize()
+
+def build_net():
+    pyro.clear_param_store()
+    pyro.set_rng_seed(0)
+    return BNN("mnist", args.hidden_size, "leaky", args.architecture, "svi", args.epochs, 0.01, None, None,
+               (1, 28, 28), 10).to(args.device)
+
+def reference_svi_epoch(net, svi, batches):
+    """ Previous training loop. """
+    correct_predictions = 0.0
+    for x_batch, labels in batches:
+        svi.step(x_data=x_batch, y_data=labels)
+        outputs = net.forward(x_batch, training=True, avg_posterior=False)
+        correct_predictions += (outputs.argmax(-1) == labels).sum().item()
+    return correct_predictions
+
+def svi_epoch(net, svi, guide_logits, batches):
+    correct_predictions = 0.0
+    for x_batch, labels in batches:
+        correct_predictions += net._svi_step(svi, guide_logits, x_batch, labels)[1]
+    return correct_predictions
+
+def run(name, epoch_fn, num_particles):
+
+    epoch_fn() # warmup
+    synchronize()
+
+    start = time.perf_counter()
+    for _ in range(args.epochs):
+        correct_predictions = epoch_fn()
+    synchronize()
+    elapsed = time.perf_counter()-start
+
+    examples = args.epochs*args.n_inputs
+    print(f"{name}\tnum_particles={num_particles}\texamples/s={examples/elapsed:.1f}\t"
+          f"particle examples/s={num_particles*examples/elapsed:.1f}\t"
+          f"accuracy={100*correct_predictions/args.n_inputs:.2f}")
+
+
+torch.manual_seed(0)
+x = torch.rand(args.n_inputs, 1, 28, 28, device=args.device)
+y = torch.randint(10, (args.n_inputs,), device=args.device)
+batches = [(x[i:i+args.batch_size], y[i:i+args.batch_size]) for i in range(0, args.n_inputs, args.batch_size)]
+
+print(f"\narchitecture = {args.architecture}\tn_inputs = {args.n_inputs}\tbatch_size = {args.batch_size}\n")
+
+net = build_net()
+svi = SVI(net.model, net.guide, pyro.optim.Adam({"lr":0.01}), loss=Trace_ELBO())
+run("reference loop", lambda: reference_svi_epoch(net, svi, batches), num_particles=1)
+
+for num_particles in [int(n) for n in args.num_particles.split(",")]:
+    for vectorize_particles in [False, True]:
+
+        net = build_net()
+        svi, guide_logits = net._svi(lr=0.01, num_particles=num_particles, vectorize_particles=vectorize_particles)
+        name = "vectorized particles" if vectorize_particles else "sequential particles"
+        run(name, lambda: svi_epoch(net, svi, guide_logits, batches), num_particles=num_particles)
@@ -15,6 +15,10 @@ from utils.savedir import *
 from utils.seeding import *
 
 from utils.lrp import *
+from utils.lrp_cache import ExplanationsCache
+from utils.lrp_storage import save_heatmaps, load_heatmaps
+from utils.lrp_statistics import HeatmapsStatistics, ChunkedHeatmapsStore
+from utils.profiling import stage, save_report
 from plot.lrp_heatmaps import plot_vanishing_explanations
 import plot.lrp_distributions as plot_lrp
 from attacks.gradient_based import evaluate_attack
@@ -29,6 +33,12 @@ parser.add_argument("--lrp_method", default="avg_heatmap", type=str, help="avg_p
 parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
 parser.add_argument("--redBNN_layer_idx", default=-1, type=int, help="Bayesian layer idx in redBNN.")
 parser.add_argument("--load", default=False, type=eval, help="Load saved computations and evaluate them.")
+parser.add_argument("--cache", default=False, type=eval, help="Reuse explanations from the LRP cache.")
+parser.add_argument("--storage", default="float32", type=str, help="Saved heatmaps format: float32, float16, topk.")
+parser.add_argument("--storage_topk", default=100, type=int, help="Pixels kept by the topk storage format.")
+parser.add_argument("--sample_statistics", default=False, type=eval, help="Save mean, variance and quantiles of "\
+                    "the avg_heatmap sample heatmaps.")
+parser.add_argument("--store_samples", default=False, type=eval, help="Save the avg_heatmap sample heatmaps in chunks.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
@@ -46,142 +56,159 @@ if args.device=="cuda":
 
 model = baseNN_settings["model_"+str(args.model_idx)]
 
-x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=model["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
-det_model_savedir = get_model_savedir(model="baseNN", dataset=model["dataset"], architecture=model["architecture"], 
-                                  debug=args.debug, model_idx=args.model_idx)
-detnet = baseNN(inp_shape, num_classes, *list(model.values()))
-detnet.load(savedir=det_model_savedir, device=args.device)
-det_attack = load_attack(method=args.attack_method, model_savedir=det_model_savedir)
+with stage("load_data"):
+    x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=model["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
 
-if args.model=="fullBNN":
+with stage("load_models"):
+    detnet, det_model_savedir = load_model("baseNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+                                           debug=args.debug)
 
-    m = fullBNN_settings["model_"+str(args.model_idx)]
+    if args.model=="fullBNN":
 
-    bay_model_savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-                                model_idx=args.model_idx, debug=args.debug)
+        m = fullBNN_settings["model_"+str(args.model_idx)]
 
-    bayesnet = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
-    bayesnet.load(savedir=bay_model_savedir, device=args.device)
+    elif args.model=="redBNN":
 
-elif args.model=="redBNN":
+        m = redBNN_settings["model_"+str(args.model_idx)]
 
-    m = redBNN_settings["model_"+str(args.model_idx)]
-    base_m = baseNN_settings["model_"+str(m["baseNN_idx"])]
+        x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=m["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
 
-    x_test, y_test, inp_shape, out_size = load_dataset(dataset_name=m["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
-
-    basenet = baseNN(inp_shape, out_size, *list(base_m.values()))
-    basenet_savedir = get_model_savedir(model="baseNN", dataset=m["dataset"], 
-                      architecture=m["architecture"], debug=args.debug, model_idx=m["baseNN_idx"])
-    basenet.load(savedir=basenet_savedir, device=args.device)
-
-    hyp = get_hyperparams(m)
+    else:
+        raise NotImplementedError
 
-    layer_idx=args.redBNN_layer_idx+basenet.n_learnable_layers+1 if args.redBNN_layer_idx<0 else args.redBNN_layer_idx
-    bayesnet = redBNN(dataset_name=m["dataset"], inference=m["inference"], base_net=basenet, hyperparams=hyp,
-                      layer_idx=layer_idx)
-    bay_model_savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-                          debug=args.debug, model_idx=args.model_idx, layer_idx=layer_idx)
-    bayesnet.load(savedir=bay_model_savedir, device=args.device)
+    bayesnet, bay_model_savedir = load_model(args.model, args.model_idx, inp_shape, num_classes, 
+                                             layer_idx=args.redBNN_layer_idx, device=args.device, debug=args.debug)
 
-else:
-    raise NotImplementedError
+with stage("load_attacks"):
+    det_attack = load_attack(method=args.attack_method, model_savedir=det_model_savedir)
 
-bay_attack=[]
-for n_samples in n_samples_list:
+    bay_attack=[]
+    for n_samples in n_samples_list:
 
-    bay_attack.append(load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
-                                  n_samples=n_samples))
+        bay_attack.append(load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
+                                      n_samples=n_samples))
 
-if m["inference"]=="svi":
-    mode_attack = load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
-                              n_samples=n_samples, atk_mode=True)
+    if m["inference"]=="svi":
+        mode_attack = load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
+                                  n_samples=n_samples, atk_mode=True)
 
 images = x_test.to(args.device)
 labels = y_test.argmax(-1).to(args.device)
 
+storage = {"storage":args.storage, "topk":args.storage_topk}
+# loaded heatmaps are only checked, so the top storage_topk pixels are enough
+loaded = {"topk":args.storage_topk}
+lrp_cache = ExplanationsCache() if args.cache else None
+
+def heatmaps_statistics(savedir, filename):
+    if args.lrp_method!="avg_heatmap" or not (args.sample_statistics or args.store_samples):
+        return None
+
+    store = ChunkedHeatmapsStore(os.path.join(savedir, "samples"), filename) if args.store_samples else None
+    return HeatmapsStatistics(store=store)
+
+def save_statistics(statistics, savedir, filename):
+    if statistics is not None and args.sample_statistics:
+        save_to_pickle(statistics.summary(), path=savedir, filename=filename+"_stats")
+
 for layer_idx in detnet.learnable_layers_idxs:
+    with stage("lrp_layer="+str(layer_idx)):
 
-    savedir = get_lrp_savedir(model_savedir=det_model_savedir, attack_method=args.attack_method, layer_idx=layer_idx)
+        savedir = get_lrp_savedir(model_savedir=det_model_savedir, attack_method=args.attack_method, layer_idx=layer_idx)
 
-    ### Deterministic explanations
+        ### Deterministic explanations
+        with stage("deterministic"):
 
-    if args.load:
-        det_lrp = load_from_pickle(path=savedir, filename="det_lrp")
-        det_attack_lrp = load_from_pickle(path=savedir, filename="det_attack_lrp")
+            if args.load:
+                det_lrp = load_heatmaps(path=savedir, filename="det_lrp", **loaded)
+                det_attack_lrp = load_heatmaps(path=savedir, filename="det_attack_lrp", **loaded)
 
-    else:
+            else:
 
-        det_lrp = compute_explanations(images, detnet, layer_idx=layer_idx, rule=args.rule, method=args.lrp_method)
-        det_attack_lrp = compute_explanations(det_attack, detnet, layer_idx=layer_idx, rule=args.rule, 
-                                                method=args.lrp_method)
+                det_lrp = compute_explanations(images, detnet, layer_idx=layer_idx, rule=args.rule, method=args.lrp_method,
+                                               cache=lrp_cache)
+                det_attack_lrp = compute_explanations(det_attack, detnet, layer_idx=layer_idx, rule=args.rule, 
+                                                        method=args.lrp_method, cache=lrp_cache)
 
-        save_to_pickle(det_lrp, path=savedir, filename="det_lrp")
-        save_to_pickle(det_attack_lrp, path=savedir, filename="det_attack_lrp")
+                save_heatmaps(det_lrp, path=savedir, filename="det_lrp", **storage)
+                save_heatmaps(det_attack_lrp, path=savedir, filename="det_attack_lrp", **storage)
 
-    ### Bayesian explanations
+        ### Bayesian explanations
+        with stage("bayesian"):
 
-    savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
-                              layer_idx=layer_idx, lrp_method=args.lrp_method)
+            savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
+                                      layer_idx=layer_idx, lrp_method=args.lrp_method)
 
-    bay_lrp=[]
-    bay_attack_lrp=[]
-    mode_attack_lrp=[]
+            bay_lrp=[]
+            bay_attack_lrp=[]
+            mode_attack_lrp=[]
 
-    if args.load:
+            if args.load:
 
-        for n_samples in n_samples_list:
-            bay_lrp.append(load_from_pickle(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
-            bay_attack_lrp.append(load_from_pickle(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
+                for n_samples in n_samples_list:
+                    bay_lrp.append(load_heatmaps(path=savedir, filename="bay_lrp_samp="+str(n_samples), **loaded))
+                    bay_attack_lrp.append(load_heatmaps(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples), **loaded))
 
-        if m["inference"]=="svi":
-            mode_lrp = load_from_pickle(path=savedir, filename="mode_lrp_avg_post")
+                if m["inference"]=="svi":
+                    mode_lrp = load_heatmaps(path=savedir, filename="mode_lrp_avg_post", **loaded)
 
-            for n_samples in n_samples_list:
-                mode_attack_lrp.append(load_from_pickle(path=savedir, filename="mode_attack_lrp_samp="+str(n_samples)))
-            mode_attack_lrp.append(load_from_pickle(path=savedir, filename="mode_attack_lrp_avg_post"))
+                    for n_samples in n_samples_list:
+                        mode_attack_lrp.append(load_heatmaps(path=savedir, filename="mode_attack_lrp_samp="+str(n_samples), **loaded))
+                    mode_attack_lrp.append(load_heatmaps(path=savedir, filename="mode_attack_lrp_avg_post", **loaded))
 
-            # print(mode_lrp.shape, torch.stack(mode_attack_lrp).shape)
+                    # print(mode_lrp.shape, torch.stack(mode_attack_lrp).shape)
 
-    else:
+            else:
 
-        for samp_idx, n_samples in enumerate(n_samples_list):
+                for samp_idx, n_samples in enumerate(n_samples_list):
 
-            bay_lrp.append(compute_explanations(images, bayesnet, rule=args.rule, layer_idx=layer_idx, 
-                                                n_samples=n_samples, method=args.lrp_method))
-            bay_attack_lrp.append(compute_explanations(bay_attack[samp_idx], bayesnet, layer_idx=layer_idx,
-                                                       rule=args.rule, n_samples=n_samples, method=args.lrp_method))
+                    filename, attack_filename = "bay_lrp_samp="+str(n_samples), "bay_attack_lrp_samp="+str(n_samples)
+                    statistics = heatmaps_statistics(savedir, filename)
+                    attack_statistics = heatmaps_statistics(savedir, attack_filename)
 
-            save_to_pickle(bay_lrp[samp_idx], path=savedir, filename="bay_lrp_samp="+str(n_samples))
-            save_to_pickle(bay_attack_lrp[samp_idx], path=savedir, filename="bay_attack_lrp_samp="+str(n_samples))
+                    bay_lrp.append(compute_explanations(images, bayesnet, rule=args.rule, layer_idx=layer_idx, 
+                                                        n_samples=n_samples, method=args.lrp_method, cache=lrp_cache,
+                                                        statistics=statistics))
+                    bay_attack_lrp.append(compute_explanations(bay_attack[samp_idx], bayesnet, layer_idx=layer_idx,
+                                                               rule=args.rule, n_samples=n_samples, method=args.lrp_method,
+                                                               cache=lrp_cache, statistics=attack_statistics))
+
+                    save_heatmaps(bay_lrp[samp_idx], path=savedir, filename=filename, **storage)
+                    save_heatmaps(bay_attack_lrp[samp_idx], path=savedir, filename=attack_filename, **storage)
+                    save_statistics(statistics, savedir, filename)
+                    save_statistics(attack_statistics, savedir, attack_filename)
         
-        if m["inference"]=="svi":
+                if m["inference"]=="svi":
+
+                    mode_lrp = compute_explanations(images, bayesnet, rule=args.rule, layer_idx=layer_idx, 
+                                                    n_samples=n_samples, avg_posterior=True, method=args.lrp_method,
+                                                    cache=lrp_cache)
+                    save_heatmaps(mode_lrp, path=savedir, filename="mode_lrp_avg_post", **storage)
 
-            mode_lrp = compute_explanations(images, bayesnet, rule=args.rule, layer_idx=layer_idx, 
-                                            n_samples=n_samples, avg_posterior=True, method=args.lrp_method)
-            save_to_pickle(mode_lrp, path=savedir, filename="mode_lrp_avg_post")
+                    for samp_idx, n_samples in enumerate(n_samples_list):
+                        mode_attack_lrp.append(compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx, 
+                                                                    n_samples=n_samples, method=args.lrp_method,
+                                                                    cache=lrp_cache))
+                        save_heatmaps(mode_attack_lrp[samp_idx], path=savedir, filename="mode_attack_lrp_samp="+str(n_samples), **storage)
 
-            for samp_idx, n_samples in enumerate(n_samples_list):
-                mode_attack_lrp.append(compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx, 
-                                                            n_samples=n_samples, method=args.lrp_method))
-                save_to_pickle(mode_attack_lrp[samp_idx], path=savedir, filename="mode_attack_lrp_samp="+str(n_samples))
+                    mode_attack_lrp.append(compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx,
+                                                                    # n_samples=n_samples, 
+                                                                avg_posterior=True, method=args.lrp_method, cache=lrp_cache))
+                    save_heatmaps(mode_attack_lrp[samp_idx+1], path=savedir, filename="mode_attack_lrp_avg_post", **storage)
 
-            mode_attack_lrp.append(compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx,
-                                                            # n_samples=n_samples, 
-                                                        avg_posterior=True, method=args.lrp_method))
-            save_to_pickle(mode_attack_lrp[samp_idx+1], path=savedir, filename="mode_attack_lrp_avg_post")
 
+                    # mode_attack_lrp = compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx,
+                    #                                                 # n_samples=n_samples, 
+                    #                                             avg_posterior=True, method=args.lrp_method)
+                    # save_to_pickle(mode_attack_lrp, path=savedir, filename="mode_attack_lrp_avg_post")
 
-            # mode_attack_lrp = compute_explanations(mode_attack, bayesnet, rule=args.rule, layer_idx=layer_idx,
-            #                                                 # n_samples=n_samples, 
-            #                                             avg_posterior=True, method=args.lrp_method)
-            # save_to_pickle(mode_attack_lrp, path=savedir, filename="mode_attack_lrp_avg_post")
 
+        n_images = det_lrp.shape[0]
+        if det_attack_lrp.shape[0]!=n_images or bay_lrp[0].shape[0]!=n_inputs or bay_attack_lrp[0].shape[0]!=n_inputs:
+            print("det_lrp.shape[0] =", det_lrp.shape[0])
+            print("det_attack_lrp.shape[0] =", det_attack_lrp.shape[0])
+            print("bay_lrp[0].shape[0] =", bay_lrp[0].shape[0])
+            print("bay_attack_lrp[0].shape[0] =", bay_attack_lrp[0].shape[0])
+            raise ValueError("Inconsistent n_inputs")
 
-    n_images = det_lrp.shape[0]
-    if det_attack_lrp.shape[0]!=n_images or bay_lrp[0].shape[0]!=n_inputs or bay_attack_lrp[0].shape[0]!=n_inputs:
-        print("det_lrp.shape[0] =", det_lrp.shape[0])
-        print("det_attack_lrp.shape[0] =", det_attack_lrp.shape[0])
-        print("bay_lrp[0].shape[0] =", bay_lrp[0].shape[0])
-        print("bay_attack_lrp[0].shape[0] =", bay_attack_lrp[0].shape[0])
-        raise ValueError("Inconsistent n_inputs")
\ No newline at end of file
+save_report()
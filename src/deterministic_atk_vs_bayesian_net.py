@@ -15,7 +15,7 @@ from networks.redBNN import *
 parser = argparse.ArgumentParser()
 parser.add_argument("--model", default="fullBNN", type=str, help="baseNN, fullBNN, redBNN")
 parser.add_argument("--model_idx", default=0, type=int, help="choose model idx from pre defined settings")
-parser.add_argument("--inference", default="svi", type=str, help="svi, hmc")
+parser.add_argument("--inference", default="svi", type=str, help="svi, hmc, sgld, sghmc")
 parser.add_argument("--load", default=True, type=eval)
 parser.add_argument("--attack_method", default="fgsm", type=str, help="fgsm, pgd")
 parser.add_argument("--atk_inputs", default=1000, type=int, help="number of input points")
@@ -93,7 +93,7 @@ else:
     if m["inference"]=="svi":
         bayesian_defence_samples=[1,10,50]
 
-    elif m["inference"]=="hmc":
+    elif m["inference"] in ["hmc", "sgld", "sghmc"]:
         bayesian_defence_samples=[1,5,10]
 
 if args.load:
@@ -19,7 +19,9 @@ from networks.fullBNN import *
 from networks.redBNN import *
 
 from utils.lrp import *
+from utils.lrp_cache import ExplanationsCache, explanations_key, load_explanations
 from plot.lrp_heatmaps import plot_heatmaps_det_vs_bay
+from plot.render import PlotRenderer
 from attacks.gradient_based import evaluate_attack
 from attacks.run_attacks import *
 
@@ -31,7 +33,9 @@ parser.add_argument("--n_samples", default=100, type=int)
 parser.add_argument("--attack_method", default="fgsm", type=str, help="fgsm, pgd")
 parser.add_argument("--lrp_method", default="avg_heatmap", type=str, help="avg_prediction, avg_heatmap")
 parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--cache", default=True, type=eval, help="Look up explanations in the LRP cache first.")
 parser.add_argument("--normalize", default=False, type=eval, help="Normalize lrp heatmaps.")
+parser.add_argument("--plot_workers", default=4, type=int, help="Processes rendering the plots, 0 draws them inline.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
@@ -45,15 +49,15 @@ print("Torchvision Version: ", torchvision.__version__)
 if args.device=="cuda":
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
+renderer = PlotRenderer(n_workers=args.plot_workers)
+
 ### Load models and attacks
 
 m = baseNN_settings["model_"+str(args.model_idx)]
 
 x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=m["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
-det_model_savedir = get_model_savedir(model="baseNN", dataset=m["dataset"], architecture=m["architecture"], 
-                                            debug=args.debug, model_idx=args.model_idx)
-detnet = baseNN(inp_shape, num_classes, *list(m.values()))
-detnet.load(savedir=det_model_savedir, device=args.device)
+detnet, det_model_savedir = load_model("baseNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+                                       debug=args.debug)
 
 det_attacks = load_attack(method=args.attack_method, model_savedir=det_model_savedir)
 
@@ -64,11 +68,8 @@ det_predictions, det_atk_predictions, det_softmax_robustness, det_successful_idx
 m = fullBNN_settings["model_"+str(args.model_idx)]
 x_test, y_test, inp_shape, out_size = load_dataset(dataset_name=m["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
 
-bay_model_savedir = get_model_savedir(model="fullBNN", dataset=m["dataset"], architecture=m["architecture"], 
-                                                        model_idx=args.model_idx, debug=args.debug)
-
-bayesnet = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
-bayesnet.load(savedir=bay_model_savedir, device=args.device)
+bayesnet, bay_model_savedir = load_model("fullBNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+                                         debug=args.debug)
 
 bay_attacks = load_attack(method=args.attack_method, model_savedir=bay_model_savedir, n_samples=args.n_samples)
 
@@ -82,15 +83,22 @@ labels = y_test.argmax(-1).to(args.device)
 ### Load explanations
 
 layer_idx = detnet.learnable_layers_idxs[-1]
+lrp_cache = ExplanationsCache() if args.cache else None
+
+def load_lrp(x, network, savedir, filename, n_samples=None):
+    key = explanations_key(network, x, rule=args.rule, method=args.lrp_method, n_samples=n_samples, 
+                           layer_idx=layer_idx)
+    return load_explanations(lrp_cache, key, path=savedir, filename=filename, device=args.device)
 
 savedir = get_lrp_savedir(model_savedir=det_model_savedir, attack_method=args.attack_method, layer_idx=layer_idx)
-det_lrp = load_from_pickle(path=savedir, filename="det_lrp")
-det_attack_lrp = load_from_pickle(path=savedir, filename="det_attack_lrp")
+det_lrp = load_lrp(images, detnet, savedir, "det_lrp")
+det_attack_lrp = load_lrp(det_attacks, detnet, savedir, "det_attack_lrp")
 
 savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
                           layer_idx=layer_idx, lrp_method=args.lrp_method)
-bay_lrp = load_from_pickle(path=savedir, filename="bay_lrp_samp="+str(args.n_samples))
-bay_attack_lrp = load_from_pickle(path=savedir, filename="bay_attack_lrp_samp="+str(args.n_samples))
+bay_lrp = load_lrp(images, bayesnet, savedir, "bay_lrp_samp="+str(args.n_samples), n_samples=args.n_samples)
+bay_attack_lrp = load_lrp(bay_attacks, bayesnet, savedir, "bay_attack_lrp_samp="+str(args.n_samples), 
+                          n_samples=args.n_samples)
 
 if args.normalize:  
     for im_idx in range(det_lrp.shape[0]):
@@ -125,15 +133,18 @@ filename=args.rule+"_heatmaps_det_vs_bay_"+m["dataset"]+"_topk="+str(args.topk)+
 if args.normalize:
     filename+="_norm"
 
-plot_heatmaps_det_vs_bay(image=images[im_idx].detach().cpu().numpy(), 
-                         det_attack=det_attacks[im_idx].detach().cpu().numpy(), 
-                         bay_attack=bay_attacks[im_idx].detach().cpu().numpy(), 
-                         det_prediction=det_predictions[im_idx],
-                         bay_prediction=bay_predictions[im_idx],
-                         label=labels[im_idx],
-                         det_explanation=det_lrp[im_idx],
-                         det_attack_explanation=det_attack_lrp[im_idx],
-                         bay_explanation=bay_lrp[im_idx],
-                         bay_attack_explanation=bay_attack_lrp[im_idx],
-                         lrp_rob_method=lrp_robustness_method, 
-                         topk=args.topk, rule=args.rule, savedir=savedir, filename=filename)
+renderer.submit(plot_heatmaps_det_vs_bay,
+                image=images[im_idx].detach().cpu().numpy(),
+                det_attack=det_attacks[im_idx].detach().cpu().numpy(),
+                bay_attack=bay_attacks[im_idx].detach().cpu().numpy(),
+                det_prediction=det_predictions[im_idx],
+                bay_prediction=bay_predictions[im_idx],
+                label=labels[im_idx],
+                det_explanation=det_lrp[im_idx],
+                det_attack_explanation=det_attack_lrp[im_idx],
+                bay_explanation=bay_lrp[im_idx],
+                bay_attack_explanation=bay_attack_lrp[im_idx],
+                lrp_rob_method=lrp_robustness_method,
+                topk=args.topk, rule=args.rule, savedir=savedir, filename=filename)
+
+renderer.close()
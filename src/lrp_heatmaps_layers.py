@@ -19,7 +19,9 @@ from networks.fullBNN import *
 from networks.redBNN import *
 
 from utils.lrp import *
+from utils.lrp_cache import ExplanationsCache, explanations_key, load_explanations
 from plot.lrp_heatmaps import plot_attacks_explanations_layers
+from plot.render import PlotRenderer
 from attacks.gradient_based import evaluate_attack
 from attacks.run_attacks import *
 
@@ -32,7 +34,9 @@ parser.add_argument("--n_samples", default=50, type=int)
 parser.add_argument("--attack_method", default="fgsm", type=str, help="fgsm, pgd")
 parser.add_argument("--lrp_method", default="avg_heatmap", type=str, help="avg_prediction, avg_heatmap")
 parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--cache", default=True, type=eval, help="Look up explanations in the LRP cache first.")
 parser.add_argument("--normalize", default=True, type=eval, help="Normalize lrp heatmaps.")
+parser.add_argument("--plot_workers", default=4, type=int, help="Processes rendering the plots, 0 draws them inline.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
@@ -46,6 +50,8 @@ print("Torchvision Version: ", torchvision.__version__)
 if args.device=="cuda":
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
+renderer = PlotRenderer(n_workers=args.plot_workers)
+
 ### Load models and attacks
 
 if args.model=="baseNN":
@@ -54,10 +60,8 @@ if args.model=="baseNN":
 
     x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=m["dataset"], 
                                                                 shuffle=False, n_inputs=n_inputs)[2:]
-    model_savedir = get_model_savedir(model="baseNN", dataset=m["dataset"], architecture=m["architecture"], 
-                                                debug=args.debug, model_idx=args.model_idx)
-    detnet = baseNN(inp_shape, num_classes, *list(m.values()))
-    detnet.load(savedir=model_savedir, device=args.device)
+    detnet, model_savedir = load_model("baseNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+                                       debug=args.debug)
 
     attacks = load_attack(method=args.attack_method, model_savedir=model_savedir)
 
@@ -71,11 +75,8 @@ elif args.model=="fullBNN":
     m = fullBNN_settings["model_"+str(args.model_idx)]
     x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=m["dataset"], shuffle=False, n_inputs=n_inputs)[2:]
 
-    model_savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-                                                            model_idx=args.model_idx, debug=args.debug)
-
-    bayesnet = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
-    bayesnet.load(savedir=model_savedir, device=args.device)
+    bayesnet, model_savedir = load_model(args.model, args.model_idx, inp_shape, num_classes, device=args.device, 
+                                         debug=args.debug)
 
     attacks = load_attack(method=args.attack_method, model_savedir=model_savedir, n_samples=args.n_samples)
 
@@ -94,6 +95,7 @@ labels = y_test.argmax(-1).to(args.device)
 explanations_layers = []
 attacks_explanations_layers = []
 pxl_idxs_layers=[]
+lrp_cache = ExplanationsCache() if args.cache else None
 
 for layer_idx in detnet.learnable_layers_idxs:
 
@@ -103,8 +105,11 @@ for layer_idx in detnet.learnable_layers_idxs:
 
         savedir = get_lrp_savedir(model_savedir=model_savedir, attack_method=args.attack_method, 
                                   layer_idx=layer_idx)
-        lrp = load_from_pickle(path=savedir, filename="det_lrp")
-        attack_lrp = load_from_pickle(path=savedir, filename="det_attack_lrp")
+        key = explanations_key(detnet, images, rule=args.rule, method=args.lrp_method, layer_idx=layer_idx)
+        lrp = load_explanations(lrp_cache, key, path=savedir, filename="det_lrp", device=args.device)
+
+        key = explanations_key(detnet, attacks, rule=args.rule, method=args.lrp_method, layer_idx=layer_idx)
+        attack_lrp = load_explanations(lrp_cache, key, path=savedir, filename="det_attack_lrp", device=args.device)
 
     else:
 
@@ -112,8 +117,8 @@ for layer_idx in detnet.learnable_layers_idxs:
 
         # savedir = get_lrp_savedir(model_savedir=model_savedir, attack_method=args.attack_method, 
         #                           layer_idx=layer_idx, lrp_method=args.lrp_method)
-        # lrp.append(load_from_pickle(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
-        # attack_lrp.append(load_from_pickle(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
+        # lrp.append(load_heatmaps(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
+        # attack_lrp.append(load_heatmaps(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
 
     if args.normalize:  
         for im_idx in range(lrp.shape[0]):
@@ -141,16 +146,19 @@ filename=args.rule+"_layers_heatmaps_"+m["dataset"]+"_images="+str(n_inputs)+\
 if args.normalize:
     filename+="_norm"
 
-plot_attacks_explanations_layers(images=images, 
-                                 attacks=attacks, 
-                                 explanations=explanations_layers, 
-                                 attacks_explanations=attacks_explanations_layers, 
-                                 predictions=predictions, 
-                                 attacks_predictions=atk_predictions, 
-                                 successful_attacks_idxs=successful_idxs, 
-                                 failed_attacks_idxs=failed_idxs,
-                                 labels=labels, 
-                                 pxl_idxs=pxl_idxs_layers, 
-                                 learnable_layers_idxs=learnable_layers_idxs,
-                                 lrp_rob_method=lrp_robustness_method, 
-                                 rule=args.rule, savedir=savedir, filename=filename)
+renderer.submit(plot_attacks_explanations_layers,
+                images=images,
+                attacks=attacks,
+                explanations=explanations_layers,
+                attacks_explanations=attacks_explanations_layers,
+                predictions=predictions,
+                attacks_predictions=atk_predictions,
+                successful_attacks_idxs=successful_idxs,
+                failed_attacks_idxs=failed_idxs,
+                labels=labels,
+                pxl_idxs=pxl_idxs_layers,
+                learnable_layers_idxs=learnable_layers_idxs,
+                lrp_rob_method=lrp_robustness_method,
+                rule=args.rule, savedir=savedir, filename=filename)
+
+renderer.close()
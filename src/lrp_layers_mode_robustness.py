@@ -19,8 +19,10 @@ from networks.fullBNN import *
 from networks.redBNN import *
 
 from utils.lrp import *
+from utils.lrp_cache import ExplanationsCache, explanations_key, load_explanations
 from plot.lrp_heatmaps import *
 import plot.lrp_distributions as plot_lrp
+from plot.render import PlotRenderer
 from attacks.gradient_based import evaluate_attack
 from attacks.run_attacks import *
 
@@ -31,7 +33,9 @@ parser.add_argument("--model", default="fullBNN", type=str, help="baseNN, fullBN
 parser.add_argument("--attack_method", default="fgsm", type=str, help="fgsm, pgd")
 parser.add_argument("--lrp_method", default="avg_heatmap", type=str, help="avg_prediction, avg_heatmap")
 parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--cache", default=True, type=eval, help="Look up explanations in the LRP cache first.")
 parser.add_argument("--normalize", default=True, type=eval, help="Normalize lrp heatmaps.")
+parser.add_argument("--plot_workers", default=4, type=int, help="Processes rendering the plots, 0 draws them inline.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
@@ -47,16 +51,16 @@ print("Torchvision Version: ", torchvision.__version__)
 if args.device=="cuda":
 		torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
+renderer = PlotRenderer(n_workers=args.plot_workers)
+
 ### Load models and attacks
 
 model = baseNN_settings["model_"+str(args.model_idx)]
 
 _, _, x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=model["dataset"], 
 															shuffle=False, n_inputs=n_inputs)
-det_model_savedir = get_model_savedir(model="baseNN", dataset=model["dataset"], architecture=model["architecture"], 
-											debug=args.debug, model_idx=args.model_idx)
-detnet = baseNN(inp_shape, num_classes, *list(model.values()))
-detnet.load(savedir=det_model_savedir, device=args.device)
+detnet, det_model_savedir = load_model("baseNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+									   debug=args.debug)
 
 det_attack = load_attack(method=args.attack_method, model_savedir=det_model_savedir)
 
@@ -67,17 +71,17 @@ if args.model=="fullBNN":
 		if m["inference"]!="svi":
 			raise NotImplementedError
 
-		bay_model_savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-																model_idx=args.model_idx, debug=args.debug)
-
-		bayesnet = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
-		bayesnet.load(savedir=bay_model_savedir, device=args.device)
+		bayesnet, bay_model_savedir = load_model(args.model, args.model_idx, inp_shape, num_classes, 
+												 device=args.device, debug=args.debug)
 
 		bay_attack=[]
 		for n_samples in n_samples_list:
 				bay_attack.append(load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
 													n_samples=n_samples))
 
+		mode_attack = load_attack(method=args.attack_method, model_savedir=bay_model_savedir, 
+								  n_samples=n_samples_list[-1], atk_mode=True)
+
 else:
 	raise NotImplementedError
 
@@ -88,33 +92,47 @@ det_lrp_robustness_topk=[]
 bay_lrp_robustness_topk=[]
 mode_lrp_robustness_topk=[]
 
+lrp_cache = ExplanationsCache() if args.cache else None
+
+def load_lrp(x, network, savedir, filename, loaded, n_samples=None, avg_posterior=False):
+	key = explanations_key(network, x, rule=args.rule, method=args.lrp_method, n_samples=n_samples, 
+						   layer_idx=layer_idx, avg_posterior=avg_posterior)
+	return load_explanations(lrp_cache, key, path=savedir, filename=filename, device=args.device, **loaded)
+
 for topk in topk_list:
 
 	det_lrp_robustness_layers=[]
 	bay_lrp_robustness_layers=[]
 	mode_lrp_robustness_layers=[]
 
+	# only the top k pixels of the heatmaps are used
+	loaded = {"topk":topk, "method":lrp_robustness_method}
+
 	for layer_idx in detnet.learnable_layers_idxs:
 
 		### Load explanations
 		savedir = get_lrp_savedir(model_savedir=det_model_savedir, attack_method=args.attack_method, layer_idx=layer_idx)
 
-		det_lrp = load_from_pickle(path=savedir, filename="det_lrp")
-		det_attack_lrp = load_from_pickle(path=savedir, filename="det_attack_lrp")
+		det_lrp = load_lrp(images, detnet, savedir, "det_lrp", loaded)
+		det_attack_lrp = load_lrp(det_attack, detnet, savedir, "det_attack_lrp", loaded)
 
 		savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
 	                          	  layer_idx=layer_idx, lrp_method=args.lrp_method)
 		bay_lrp=[]
 		bay_attack_lrp=[]
-		for n_samples in n_samples_list:
-			bay_lrp.append(load_from_pickle(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
-			bay_attack_lrp.append(load_from_pickle(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
+		for samp_idx, n_samples in enumerate(n_samples_list):
+			bay_lrp.append(load_lrp(images, bayesnet, savedir, "bay_lrp_samp="+str(n_samples), loaded, 
+									n_samples=n_samples))
+			bay_attack_lrp.append(load_lrp(bay_attack[samp_idx], bayesnet, savedir, 
+										   "bay_attack_lrp_samp="+str(n_samples), loaded, n_samples=n_samples))
 
-		mode_lrp = load_from_pickle(path=savedir, filename="mode_lrp_avg_post")
+		mode_lrp = load_lrp(images, bayesnet, savedir, "mode_lrp_avg_post", loaded, avg_posterior=True)
 		mode_attack_lrp=[]
 		for samp_idx, n_samples in enumerate(n_samples_list):
-		    mode_attack_lrp.append(load_from_pickle(path=savedir, filename="mode_attack_lrp_samp="+str(n_samples)))
-		mode_attack_lrp.append(load_from_pickle(path=savedir, filename="mode_attack_lrp_avg_post"))
+		    mode_attack_lrp.append(load_lrp(mode_attack, bayesnet, savedir, "mode_attack_lrp_samp="+str(n_samples), 
+		    								loaded, n_samples=n_samples))
+		mode_attack_lrp.append(load_lrp(mode_attack, bayesnet, savedir, "mode_attack_lrp_avg_post", loaded, 
+										avg_posterior=True))
 
 		n_images = det_lrp.shape[0]
 		if det_attack_lrp.shape[0]!=n_images or bay_lrp[0].shape[0]!=n_inputs or bay_attack_lrp[0].shape[0]!=n_inputs:
@@ -192,7 +210,7 @@ filename=args.rule+"_lrp_robustness_"+m["dataset"]+"_images="+str(n_inputs)+\
 if args.normalize:
 	filename+="_norm"
 
-plot_lrp.lrp_layers_mode_robustness(
+renderer.submit(plot_lrp.lrp_layers_mode_robustness,
 						det_lrp_robustness=det_lrp_robustness_topk,
 						bay_lrp_robustness=bay_lrp_robustness_topk,
 						mode_lrp_robustness=mode_lrp_robustness_topk,
@@ -202,3 +220,4 @@ plot_lrp.lrp_layers_mode_robustness(
 						savedir=savedir, 
 						filename="dist_"+filename+"_layers")
 
+renderer.close()
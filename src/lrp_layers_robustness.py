@@ -19,8 +19,10 @@ from networks.fullBNN import *
 from networks.redBNN import *
 
 from utils.lrp import *
+from utils.lrp_storage import load_heatmaps
 from plot.lrp_heatmaps import *
 import plot.lrp_distributions as plot_lrp
+from plot.render import PlotRenderer
 from attacks.gradient_based import evaluate_attack
 from attacks.run_attacks import *
 
@@ -31,12 +33,15 @@ parser.add_argument("--model", default="fullBNN", type=str, help="baseNN, fullBN
 parser.add_argument("--attack_method", default="fgsm", type=str, help="fgsm, pgd")
 parser.add_argument("--lrp_method", default="avg_heatmap", type=str, help="avg_prediction, avg_heatmap")
 parser.add_argument("--rule", default="epsilon", type=str, help="Rule for LRP computation.")
+parser.add_argument("--lrp_robustness_method", default="imagewise", type=str, 
+					help="imagewise, pixelwise, wasserstein, kl, js, spearman, kendall")
 parser.add_argument("--normalize", default=False, type=eval, help="Normalize lrp heatmaps.")
+parser.add_argument("--plot_workers", default=4, type=int, help="Processes rendering the plots, 0 draws them inline.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
 
-lrp_robustness_method = "imagewise"
+lrp_robustness_method = args.lrp_robustness_method
 n_samples_list=[10,50,100]
 topk_list = [10,30,100]
 n_inputs=100 if args.debug else args.n_inputs
@@ -47,16 +52,16 @@ print("Torchvision Version: ", torchvision.__version__)
 if args.device=="cuda":
 		torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
+renderer = PlotRenderer(n_workers=args.plot_workers)
+
 ### Load models and attacks
 
 model = baseNN_settings["model_"+str(args.model_idx)]
 
 _, _, x_test, y_test, inp_shape, num_classes = load_dataset(dataset_name=model["dataset"], 
 															shuffle=False, n_inputs=n_inputs)
-det_model_savedir = get_model_savedir(model="baseNN", dataset=model["dataset"], architecture=model["architecture"], 
-											debug=args.debug, model_idx=args.model_idx)
-detnet = baseNN(inp_shape, num_classes, *list(model.values()))
-detnet.load(savedir=det_model_savedir, device=args.device)
+detnet, det_model_savedir = load_model("baseNN", args.model_idx, inp_shape, num_classes, device=args.device, 
+									   debug=args.debug)
 
 det_attack = load_attack(method=args.attack_method, model_savedir=det_model_savedir)
 
@@ -64,11 +69,8 @@ if args.model=="fullBNN":
 
 		m = fullBNN_settings["model_"+str(args.model_idx)]
 
-		bay_model_savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
-																model_idx=args.model_idx, debug=args.debug)
-
-		bayesnet = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
-		bayesnet.load(savedir=bay_model_savedir, device=args.device)
+		bayesnet, bay_model_savedir = load_model(args.model, args.model_idx, inp_shape, num_classes, 
+												 device=args.device, debug=args.debug)
 
 		bay_attack=[]
 		for n_samples in n_samples_list:
@@ -98,7 +100,10 @@ bay_failed_norm_topk=[]
 det_softmax_robustness_topk=[]
 bay_softmax_robustness_topk=[]
 
-for topk in topk_list:
+# distance and rank correlation methods compare the full heatmaps, so they are computed once for all topk
+robustness_topk_list = topk_list if lrp_robustness_method in ["imagewise", "pixelwise"] else topk_list[:1]
+
+for topk in robustness_topk_list:
 
 	det_lrp_robustness_layers=[]
 	det_successful_lrp_robustness_layers=[]
@@ -121,16 +126,16 @@ for topk in topk_list:
 
 		### Load explanations
 		savedir = get_lrp_savedir(model_savedir=det_model_savedir, attack_method=args.attack_method, layer_idx=layer_idx)
-		det_lrp = load_from_pickle(path=savedir, filename="det_lrp")
-		det_attack_lrp = load_from_pickle(path=savedir, filename="det_attack_lrp")
+		det_lrp = load_heatmaps(path=savedir, filename="det_lrp")
+		det_attack_lrp = load_heatmaps(path=savedir, filename="det_attack_lrp")
 
 		savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
 	                          	  layer_idx=layer_idx, lrp_method=args.lrp_method)
 		bay_lrp=[]
 		bay_attack_lrp=[]
 		for n_samples in n_samples_list:
-			bay_lrp.append(load_from_pickle(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
-			bay_attack_lrp.append(load_from_pickle(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
+			bay_lrp.append(load_heatmaps(path=savedir, filename="bay_lrp_samp="+str(n_samples)))
+			bay_attack_lrp.append(load_heatmaps(path=savedir, filename="bay_attack_lrp_samp="+str(n_samples)))
 
 		n_images = det_lrp.shape[0]
 		if det_attack_lrp.shape[0]!=n_images or bay_lrp[0].shape[0]!=n_inputs or bay_attack_lrp[0].shape[0]!=n_inputs:
@@ -157,16 +162,12 @@ for topk in topk_list:
 						x_test=images, x_attack=det_attack, y_test=y_test, device=args.device, return_classification_idxs=True)
 		det_softmax_robustness = det_softmax_robustness.detach().cpu().numpy()
 
-		det_lrp_robustness, det_lrp_pxl_idxs = lrp_robustness(original_heatmaps=det_lrp, 
-															  adversarial_heatmaps=det_attack_lrp, 
-															  topk=topk, method=lrp_robustness_method)
-
-		succ_det_lrp_robustness, succ_det_lrp_pxl_idxs = lrp_robustness(original_heatmaps=det_lrp[det_successful_idxs], 
-																		adversarial_heatmaps=det_attack_lrp[det_successful_idxs], 
-																		topk=topk, method=lrp_robustness_method)
-		fail_det_lrp_robustness, fail_det_lrp_pxl_idxs = lrp_robustness(original_heatmaps=det_lrp[det_failed_idxs], 
-																		adversarial_heatmaps=det_attack_lrp[det_failed_idxs], 
-																		topk=topk, method=lrp_robustness_method)
+		robustness = grouped_lrp_robustness(original_heatmaps=det_lrp, adversarial_heatmaps=det_attack_lrp, 
+											topk=topk, method=lrp_robustness_method, 
+											groups=attack_groups(det_successful_idxs, det_failed_idxs))
+		det_lrp_robustness, det_lrp_pxl_idxs = robustness["all"]
+		succ_det_lrp_robustness, succ_det_lrp_pxl_idxs = robustness["successful"]
+		fail_det_lrp_robustness, fail_det_lrp_pxl_idxs = robustness["failed"]
 		
 		det_norm = lrp_distances(det_lrp, det_attack_lrp, axis_norm=1).detach().cpu().numpy()
 		det_successful_norm = lrp_distances(det_lrp[det_successful_idxs], det_attack_lrp[det_successful_idxs], 
@@ -202,23 +203,16 @@ for topk in topk_list:
 				bay_successful_idxs.append(successf_idxs)
 				bay_failed_idxs.append(failed_idxs)
 
-				robustness, pxl_idxs = lrp_robustness(original_heatmaps=bay_lrp[samp_idx], 
-													 adversarial_heatmaps=bay_attack_lrp[samp_idx], 
-													 topk=topk, method=lrp_robustness_method)
-				bay_lrp_robustness.append(robustness)
-				bay_lrp_pxl_idxs.append(pxl_idxs)
-
-				robustness, pxl_idxs = lrp_robustness(original_heatmaps=bay_lrp[samp_idx][successf_idxs], 
-													 adversarial_heatmaps=bay_attack_lrp[samp_idx][successf_idxs], 
-													 topk=topk, method=lrp_robustness_method)
-				succ_bay_lrp_robustness.append(robustness)
-				succ_bay_lrp_pxl_idxs.append(pxl_idxs)
-
-				robustness, pxl_idxs = lrp_robustness(original_heatmaps=bay_lrp[samp_idx][failed_idxs], 
-													 adversarial_heatmaps=bay_attack_lrp[samp_idx][failed_idxs], 
-													 topk=topk, method=lrp_robustness_method)
-				fail_bay_lrp_robustness.append(robustness)
-				fail_bay_lrp_pxl_idxs.append(pxl_idxs)
+				robustness = grouped_lrp_robustness(original_heatmaps=bay_lrp[samp_idx], 
+													adversarial_heatmaps=bay_attack_lrp[samp_idx], topk=topk, 
+													method=lrp_robustness_method, 
+													groups=attack_groups(successf_idxs, failed_idxs))
+				bay_lrp_robustness.append(robustness["all"][0])
+				bay_lrp_pxl_idxs.append(robustness["all"][1])
+				succ_bay_lrp_robustness.append(robustness["successful"][0])
+				succ_bay_lrp_pxl_idxs.append(robustness["successful"][1])
+				fail_bay_lrp_robustness.append(robustness["failed"][0])
+				fail_bay_lrp_pxl_idxs.append(robustness["failed"][1])
 
 				bay_norm.append(lrp_distances(bay_lrp[samp_idx], 
 												bay_attack_lrp[samp_idx], 
@@ -264,6 +258,14 @@ for topk in topk_list:
 	det_softmax_robustness_topk.append(det_softmax_robustness_layers)
 	bay_softmax_robustness_topk.append(bay_softmax_robustness_layers)
 
+if len(robustness_topk_list)<len(topk_list):
+	for topk_results in [det_lrp_robustness_topk, det_successful_lrp_robustness_topk, det_failed_lrp_robustness_topk,
+						 bay_lrp_robustness_topk, bay_successful_lrp_robustness_topk, bay_failed_lrp_robustness_topk,
+						 det_norm_topk, det_successful_norm_topk, det_failed_norm_topk, 
+						 bay_norm_topk, bay_successful_norm_topk, bay_failed_norm_topk,
+						 det_softmax_robustness_topk, bay_softmax_robustness_topk]:
+		topk_results.extend(topk_results*(len(topk_list)-1))
+
 ### Plots
 
 savedir = get_lrp_savedir(model_savedir=bay_model_savedir, attack_method=args.attack_method, 
@@ -275,7 +277,10 @@ filename=args.rule+"_lrp_robustness_"+m["dataset"]+"_images="+str(n_inputs)+\
 if args.normalize:
 	filename+="_norm"
 
-plot_lrp.lrp_layers_robustness_distributions(
+if lrp_robustness_method!="imagewise":
+	filename+="_"+lrp_robustness_method
+
+renderer.submit(plot_lrp.lrp_layers_robustness_distributions,
 						det_lrp_robustness=det_lrp_robustness_topk,
 						det_successful_lrp_robustness=det_successful_lrp_robustness_topk,
 						det_failed_lrp_robustness=det_failed_lrp_robustness_topk,
@@ -289,7 +294,7 @@ plot_lrp.lrp_layers_robustness_distributions(
 						savedir=savedir, 
 						filename="dist_"+filename+"_layers")
 
-plot_lrp.lrp_layers_robustness_scatterplot(
+renderer.submit(plot_lrp.lrp_layers_robustness_scatterplot,
 						det_lrp_robustness=det_lrp_robustness_topk,
 						bay_lrp_robustness=bay_lrp_robustness_topk,
                       	det_softmax_robustness=det_softmax_robustness_topk,
@@ -299,4 +304,6 @@ plot_lrp.lrp_layers_robustness_scatterplot(
 						n_original_images=len(images),
 						learnable_layers_idxs=detnet.learnable_layers_idxs,
 						savedir=savedir, 
-						filename="scatterplot_"+filename+"_layers_topk="+str(topk_list[-1]))
\ No newline at end of file
+						filename="scatterplot_"+filename+"_layers_topk="+str(topk_list[-1]))
+
+renderer.close()
@@ -21,6 +21,8 @@ from TorchLRP import lrp
 
 DEBUG = False
 
+# indexes of the learnable layers among the children of `baseNN.model`, for each architecture
+LEARNABLE_LAYERS_IDXS = {"fc":[1, 3], "fc2":[1, 3, 5], "fc4":[1, 3, 5, 7, 9], "conv":[0, 3, 7]}
 
 class baseNN(nn.Module):
 
@@ -71,7 +73,7 @@ class baseNN(nn.Module):
                 activ(),
                 lrp.Linear(hidden_size, output_size))
 
-            self.learnable_layers_idxs = [1, 3]
+            self.learnable_layers_idxs = list(LEARNABLE_LAYERS_IDXS["fc"])
 
         elif architecture == "fc2":
             self.model = nn.Sequential(
@@ -83,7 +85,7 @@ class baseNN(nn.Module):
                 lrp.Linear(hidden_size, output_size)
                 )
 
-            self.learnable_layers_idxs = [1, 3, 5]
+            self.learnable_layers_idxs = list(LEARNABLE_LAYERS_IDXS["fc2"])
 
         elif architecture == "fc4":
             self.model = nn.Sequential(
@@ -98,7 +100,7 @@ class baseNN(nn.Module):
                 activ(),
                 lrp.Linear(hidden_size, output_size))
 
-            self.learnable_layers_idxs = [1, 3, 5, 7, 9]
+            self.learnable_layers_idxs = list(LEARNABLE_LAYERS_IDXS["fc4"])
 
         elif architecture == "conv":
 
@@ -114,7 +116,7 @@ class baseNN(nn.Module):
                     nn.Flatten(),
                     lrp.Linear(int(hidden_size/(4*4))*input_size, output_size))
 
-                self.learnable_layers_idxs = [0, 3, 7]
+                self.learnable_layers_idxs = list(LEARNABLE_LAYERS_IDXS["conv"])
 
             else:
                 raise NotImplementedError()
@@ -187,7 +189,10 @@ class baseNN(nn.Module):
 
         return layer_idx
 
-    def forward(self, inputs, layer_idx=-1, softmax=False, *args, **kwargs):
+    def forward(self, inputs, layer_idx=-1, softmax=False, n_samples=None, sample_idxs=None, avg_posterior=False,
+                *args, **kwargs):
+        """ Bayesian arguments (n_samples, sample_idxs, avg_posterior) are ignored, so that baseNN and BNN
+        share the same calls. """
 
         layer_idx = self._set_correct_layer_idx(layer_idx)
 
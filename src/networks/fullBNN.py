@@ -4,6 +4,8 @@ Bayesian Neural Network model
 
 import argparse
 import os
+import json
+import multiprocessing
 import numpy as np
 import pandas as pd 
 import copy
@@ -23,19 +25,53 @@ import pyro.optim as pyroopt
 from pyro.infer.mcmc import MCMC, HMC, NUTS
 from pyro.distributions import OneHotCategorical, Normal, Categorical, Uniform
 from pyro.nn import PyroModule
+from pyro.ops.stats import gelman_rubin, effective_sample_size
 
 from utils.data import *
 from utils.savedir import *
 from utils.model_settings import fullBNN_settings
+from utils.param_store import ParamStoreScope, param_scoped
+from utils.uncertainty import PredictiveMoments, adaptive_moments
 from networks.baseNN import baseNN
+from networks.redBNN import swapped_parameters
+from TorchLRP import lrp
 
 
 DEBUG=False
+sampling_inferences = ["hmc", "sgld", "sghmc"] # posteriors stored as lists of basenet samples
+
+
+def available_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def _run_chain(bnn, batches, batch_samples, warmup, seed, num_threads):
+    """ 
+    Runs a single NUTS chain over the batches, in a separate process. Returns the samples of each batch, in the 
+    order they were drawn. 
+    Chains are forked, and a forked process cannot use cuda once the parent has initialized it, so tensors are 
+    created on the CPU regardless of the default tensor type of the training script.
+    """
+    torch.set_default_tensor_type('torch.FloatTensor')
+    torch.set_num_threads(num_threads)
+    pyro.set_rng_seed(seed)
+
+    kernel = NUTS(bnn.model, adapt_step_size=True)
+    mcmc = MCMC(kernel=kernel, num_samples=batch_samples, warmup_steps=warmup, num_chains=1, disable_progbar=True)
+
+    chain_samples = []
+    for x_batch, y_batch in batches:
+        mcmc.run(x_batch, y_batch)
+        chain_samples.append(mcmc.get_samples())
+
+    return chain_samples
+
 
 class BNN(PyroModule):
 
     def __init__(self, dataset_name, hidden_size, activation, architecture, inference, 
-                 epochs, lr, hmc_samples, warmup, input_shape, output_size):
+                 epochs, lr, hmc_samples, warmup, input_shape, output_size, local_reparameterization=False):
+        """ With `local_reparameterization` SVI models are trained and evaluated with Bayesian layers that 
+        sample pre-activations instead of weights (see `_local_reparameterization_basenet`). """
         super(BNN, self).__init__()
         self.dataset_name = dataset_name
         self.inference = inference
@@ -46,12 +82,14 @@ class BNN(PyroModule):
         self.warmup = 5 if DEBUG else warmup
         self.step_size = 0.5
         self.num_steps = 10
+        self.local_reparameterization = local_reparameterization
         self.basenet = baseNN(dataset_name=dataset_name, input_shape=input_shape, 
                               output_size=output_size, hidden_size=hidden_size, 
                               activation=activation, architecture=architecture, 
                               epochs=epochs, lr=lr)
         self.name = self.get_name()
         self.n_layers = self.basenet.n_layers
+        self.param_store = ParamStoreScope() # variational parameters of this model
 
     def get_name(self, n_inputs=None):
         
@@ -67,7 +105,11 @@ class BNN(PyroModule):
         elif self.inference == "hmc":
             return name+"_samp="+str(self.hmc_samples)+"_warm="+str(self.warmup)+\
                    "_stepsize="+str(self.step_size)+"_numsteps="+str(self.num_steps)
+        elif self.inference in ["sgld", "sghmc"]:
+            return name+"_ep="+str(self.epochs)+"_lr="+str(self.lr)+"_samp="+str(self.hmc_samples)+\
+                   "_warm="+str(self.warmup)
 
+    @param_scoped
     def model(self, x_data, y_data):
 
         priors = {}
@@ -84,6 +126,7 @@ class BNN(PyroModule):
             logits = nnf.log_softmax(logits, dim=-1)
             obs = pyro.sample("obs", Categorical(logits=logits), obs=y_data)
 
+    @param_scoped
     def guide(self, x_data, y_data=None):
 
         dists = {}
@@ -100,6 +143,89 @@ class BNN(PyroModule):
 
         return logits 
 
+    def _particles_forward(self, weights, inputs):
+        """ Forward pass of the basenet vectorized over the leading (particles) dimension of the weights. 
+        Without `torch.func` (torch < 2.0) the particles are evaluated one at a time. """
+        if hasattr(torch, "func"):
+            forward = lambda particle_weights: torch.func.functional_call(self.basenet, particle_weights, (inputs,))
+            return torch.vmap(forward)(weights)
+
+        logits = []
+        for particle_idx in range(len(next(iter(weights.values())))):
+            particle_weights = {key:w[particle_idx] for key, w in weights.items()}
+            with swapped_parameters(self.basenet, particle_weights) as basenet:
+                logits.append(basenet(inputs))
+        return torch.stack(logits)
+
+    def _sample_weights(self, dists):
+        """ Weights are sampled as single events, so that the vectorized particles plate adds one leading 
+        dimension to each weight tensor. """
+        weights = {}
+        for key, value in self.basenet.state_dict().items():
+            w = pyro.sample(f"module$$${key}", dists[key].to_event(value.dim()))
+            weights.update({str(key):w.reshape(-1, *value.shape)})
+        return weights
+
+    @param_scoped
+    def vectorized_model(self, x_data, y_data):
+        """ Same model as `model`, with weights of shape (n. particles, weight shape) and logits of shape 
+        (n. particles, n. inputs, n. classes). """
+
+        priors = {}
+        for key, value in self.basenet.state_dict().items():
+            priors.update({str(key):Normal(loc=torch.zeros_like(value), scale=torch.ones_like(value))})
+
+        logits = self._particles_forward(self._sample_weights(priors), x_data)
+
+        with pyro.plate("data", len(x_data)):
+            logits = nnf.log_softmax(logits, dim=-1)
+            obs = pyro.sample("obs", Categorical(logits=logits), obs=y_data)
+
+    @param_scoped
+    def vectorized_guide(self, x_data, y_data=None):
+        """ Same variational parameters and sample sites as `guide`, so the trained param store is also used 
+        by `forward`. """
+
+        dists = {}
+        for key, value in self.basenet.state_dict().items():
+            loc = pyro.param(str(f"{key}_loc"), torch.randn_like(value)) 
+            scale = pyro.param(str(f"{key}_scale"), torch.randn_like(value))
+            dists.update({str(key):Normal(loc=loc, scale=softplus(scale))})
+
+        weights = self._sample_weights(dists)
+
+        with pyro.plate("data", len(x_data)):
+            logits = self._particles_forward(weights, x_data)
+
+        return logits
+
+    @param_scoped
+    def _local_reparameterization_basenet(self):
+        """
+        Copy of the basenet with `lrp.BayesianLinear` and `lrp.BayesianConv2d` layers, whose means and scales 
+        are the variational parameters of `guide`. Each input gets its own pre-activations noise, so that 
+        multiple samples are drawn in a single forward pass on the repeated inputs.
+        """
+        basenet = copy.deepcopy(self.basenet)
+
+        layers = []
+        for layer in basenet.model.children():
+            if isinstance(layer, lrp.Linear):
+                layer = lrp.BayesianLinear.from_torch(layer)
+            elif isinstance(layer, lrp.Conv2d):
+                layer = lrp.BayesianConv2d.from_torch(layer)
+            layers.append(layer)
+        basenet.model = nn.Sequential(*layers)
+
+        state_dict = {}
+        for key, value in self.basenet.state_dict().items():
+            state_dict.update({str(key):pyro.param(str(f"{key}_loc"), torch.randn_like(value)),
+                               str(f"{key}_scale"):pyro.param(str(f"{key}_scale"), torch.randn_like(value))})
+
+        basenet.load_state_dict(state_dict)
+        return basenet.to(state_dict[key].device)
+
+    @param_scoped
     def save(self, savedir):
         filename=self.name+"_weights"
 
@@ -115,7 +241,7 @@ class BNN(PyroModule):
             print("\nSaving: ", fullpath)
             param_store.save(fullpath)
 
-        elif self.inference == "hmc":
+        elif self.inference in sampling_inferences:
             savedir=os.path.join(savedir, "weights")
             os.makedirs(savedir, exist_ok=True)  
 
@@ -126,6 +252,7 @@ class BNN(PyroModule):
                 fullpath=os.path.join(savedir, filename+"_"+str(idx)+".pt")    
                 torch.save(weights.state_dict(), fullpath)
 
+    @param_scoped
     def load(self, savedir, device):
         filename=self.name+"_weights"
 
@@ -138,7 +265,7 @@ class BNN(PyroModule):
                 param_store.replace_param(key, value.to(device), value)
             print("\nLoading ", os.path.join(savedir, filename + ".pt"))
 
-        elif self.inference == "hmc":
+        elif self.inference in sampling_inferences:
             savedir=os.path.join(savedir, "weights")
             os.makedirs(savedir, exist_ok=True)  
 
@@ -158,8 +285,42 @@ class BNN(PyroModule):
     def _set_correct_layer_idx(self, layer_idx):
         return self.basenet._set_correct_layer_idx(layer_idx)
 
+    @param_scoped
     def forward(self, inputs, n_samples=10, avg_posterior=False, sample_idxs=None, training=False,
-                expected_out=True, softmax=False, layer_idx=-1, *args, **kwargs):
+                expected_out=True, softmax=False, layer_idx=-1, moments=False, entropy=False, tolerance=None,
+                min_samples=10, *args, **kwargs):
+        """
+        With `moments` the posterior sample outputs are reduced as they are computed, instead of being stacked, 
+        and a dictionary with their mean and variance is returned (see `utils.uncertainty.PredictiveMoments`). 
+        `entropy` adds the predictive entropy, the expected entropy, the mutual information and the variation ratio.
+        With a `tolerance` at most `n_samples` samples are drawn for each input, stopping when its mean output 
+        converges (see `utils.uncertainty.standard_error_converged`). Moments are returned with the samples used by 
+        each input (see `utils.uncertainty.adaptive_moments`).
+        """
+        if tolerance is not None:
+
+            if avg_posterior or training:
+                raise ValueError("Adaptive sampling needs posterior samples.")
+
+            def sample_outputs(rows, sample_idx):
+                return next(self._sample_outputs(inputs[rows], 1, False, [sample_idx], False, softmax, layer_idx,
+                                                 *args, **kwargs))
+
+            sample_idxs = sample_idxs if sample_idxs else list(range(n_samples))
+            return adaptive_moments(sample_outputs, len(inputs), sample_idxs, tolerance, min_samples, 
+                                    entropy=entropy, softmax=softmax, device=inputs.device)
+
+        outputs = self._sample_outputs(inputs, n_samples, avg_posterior, sample_idxs, training, softmax, layer_idx,
+                                       *args, **kwargs)
+        if moments:
+            return PredictiveMoments(entropy=entropy, softmax=softmax).reduce(outputs)
+
+        preds = torch.stack(list(outputs))
+        return preds.mean(0) if expected_out else preds
+
+    def _sample_outputs(self, inputs, n_samples, avg_posterior, sample_idxs, training, softmax, layer_idx, 
+                        *args, **kwargs):
+        """ Outputs of the posterior samples, computed one at a time. """
 
         # change external attack libraries behavior #
         n_samples = self.n_samples if hasattr(self, "n_samples") else n_samples
@@ -190,18 +351,29 @@ class BNN(PyroModule):
                 out = basenet_copy.forward(inputs, layer_idx=layer_idx, *args, **kwargs)
                 if softmax:
                     out = nnf.softmax(out, dim=-1)
-                preds = [out]
+                yield out
 
-            else:
+            elif self.local_reparameterization and not training:
 
-                preds = []  
+                # the seed of the first sample index sets the noise of all the samples
+                pyro.set_rng_seed(sample_idxs[0])
+                basenet = self._local_reparameterization_basenet()
+
+                repeated_inputs = inputs.repeat(n_samples, *[1]*(inputs.dim()-1))
+                out = basenet.forward(repeated_inputs, layer_idx=layer_idx, *args, **kwargs)
+                out = out.reshape(n_samples, len(inputs), *out.shape[1:])
+                if softmax:
+                    out = nnf.softmax(out, dim=-1)
+                yield from out
+
+            else:
 
                 if training:
                     guide_trace = poutine.trace(self.guide).get_trace(inputs)  
                     out = guide_trace.nodes['_RETURN']['value']
                     if softmax:
                         out = nnf.softmax(out, dim=-1)
-                    preds.append(out)
+                    yield out
 
                 else:
                     for seed in sample_idxs:
@@ -223,9 +395,9 @@ class BNN(PyroModule):
                         out = basenet_copy.forward(inputs, layer_idx=layer_idx, *args, **kwargs)
                         if softmax:
                             out = nnf.softmax(out, dim=-1)
-                        preds.append(out)
+                        yield out
 
-        elif self.inference == "hmc":
+        elif self.inference in sampling_inferences:
 
             if n_samples>len(self.posterior_samples):
                 raise ValueError("Too many samples. Max available samples =", len(self.posterior_samples))
@@ -247,20 +419,16 @@ class BNN(PyroModule):
                 out = basenet_copy.forward(inputs, layer_idx=layer_idx, *args, **kwargs)
                 if softmax:
                     out = nnf.softmax(out, dim=-1)
-                preds = [out]
+                yield out
 
             else:
-                preds = []
                 posterior_predictive = self.posterior_samples
                 for seed in sample_idxs:
                     net = posterior_predictive[seed]
                     out = net.forward(inputs, layer_idx=layer_idx, *args, **kwargs)
                     if softmax:
                         out = nnf.softmax(out, dim=-1)
-                    preds.append(out)
-        
-        preds = torch.stack(preds)
-        return preds.mean(0) if expected_out else preds
+                    yield out
 
     def _train_hmc(self, train_loader, n_samples, warmup, step_size, num_steps, savedir, device):
         print("\n == fullBNN HMC training ==")
@@ -299,16 +467,102 @@ class BNN(PyroModule):
         execution_time(start=start, end=time.time())     
         self.save(savedir)
 
-    def _train_svi(self, train_loader, epochs, lr, savedir, device):
-        print("\n == fullBNN SVI training ==")
+    def _set_posterior_samples(self, stacked_samples):
+        """ Loads the stacked samples {parameter name: tensor of shape (n. samples, parameter shape)} into 
+        one basenet copy per sample. """
+        self.stacked_posterior_samples = stacked_samples
+        n_samples = len(next(iter(stacked_samples.values())))
 
-        optimizer = pyro.optim.Adam({"lr":lr})
-        elbo = Trace_ELBO()
-        svi = SVI(self.model, self.guide, optimizer, loss=elbo)
+        self.posterior_samples=[]
+        for sample_idx in range(n_samples):
+            net_copy = copy.deepcopy(self.basenet)
+            net_copy.load_state_dict({key:weights[sample_idx] for key, weights in stacked_samples.items()})
+            self.posterior_samples.append(net_copy)
+
+    def _train_hmc_chains(self, train_loader, n_samples, warmup, savedir, device, num_chains=None):
+        """
+        Runs `num_chains` NUTS chains in parallel processes on the CPU (by default one chain per available core, 
+        and at least two). Each chain visits all the batches, as in `_train_hmc`. Gelman-Rubin R-hat and effective 
+        sample sizes are computed on the ordered draws of the chains of each batch, printed and saved to the model 
+        directory, then the samples of all chains and batches are thinned to `n_samples` by parameter name.
+        """
+        print("\n == fullBNN HMC training with parallel chains ==")
+        pyro.clear_param_store()
+
+        # Gelman-Rubin needs at least two chains of two samples
+        num_chains = max(2, available_cpus()) if num_chains is None else num_chains
+        num_threads = max(1, available_cpus()//num_chains)
+        num_batches = len(train_loader)
+        batch_samples = max(2, int(n_samples/(num_batches*num_chains))+1)
+        print("\nn_chains =", num_chains, "\tn_batches =", num_batches, "\tbatch_samples =", batch_samples)
+
+        batches = [(x_batch.cpu(), y_batch.cpu().argmax(-1)) for x_batch, y_batch in train_loader]
+        self.to("cpu")
+        self.basenet.to("cpu")
+
+        start = time.time()
+        with multiprocessing.get_context("fork").Pool(num_chains) as pool:
+            chains = pool.starmap(_run_chain, [(self, batches, batch_samples, warmup, seed, num_threads) 
+                                               for seed in range(num_chains)])
+        execution_time(start=start, end=time.time())
+
+        # chain samples have shape (n. chains, n. samples, parameter shape) for each batch
+        sites = list(chains[0][0].keys())
+        batch_chains = [{site:torch.stack([chain[batch_idx][site] for chain in chains]) for site in sites}
+                        for batch_idx in range(num_batches)]
+
+        self.mcmc_diagnostics = {}
+        print("\nparameter\tmax r_hat\tmin n_eff")
+        for site in sites:
+            r_hat = torch.stack([gelman_rubin(samples[site], chain_dim=0, sample_dim=1) for samples in batch_chains])
+            n_eff = torch.stack([effective_sample_size(samples[site], chain_dim=0, sample_dim=1)
+                                 for samples in batch_chains])
+            key = site.replace("module$$$", "")
+            self.mcmc_diagnostics[key] = {"max_r_hat":r_hat.max().item(), "mean_r_hat":r_hat.mean().item(),
+                                          "min_n_eff":n_eff.min().item(), "mean_n_eff":n_eff.mean().item()}
+            print(f"{key}\t{r_hat.max().item():.3f}\t{n_eff.min().item():.1f}")
+
+        # samples are thinned evenly over all the batches and chains
+        stacked_samples = {}
+        for site in sites:
+            samples = torch.cat([chains_samples[site].flatten(0, 1) for chains_samples in batch_chains])
+            idxs = torch.linspace(0, len(samples)-1, n_samples, device=samples.device).round().long()
+            stacked_samples[site.replace("module$$$", "")] = samples[idxs]
+        self._set_posterior_samples(stacked_samples)
+
+        self.save(savedir)
+        with open(os.path.join(savedir, self.name+"_diagnostics.json"), "w") as f:
+            json.dump(self.mcmc_diagnostics, f, indent=1)
+
+        self.to(device)
+        self.basenet.to(device)
+
+    def _train_sgmcmc(self, train_loader, epochs, lr, n_samples, burnin, savedir, device, friction=0.1):
+        """
+        Stochastic gradient MCMC on the basenet weights, with minibatch estimates of the potential energy 
+        U = n_inputs * mean NLL + |w|^2/2 (standard normal prior).
+        SGLD:   w <- w - lr/2 * grad U + N(0, lr)
+        SGHMC:  v <- (1-friction) * v - lr * grad U + N(0, 2 * friction * lr),  w <- w + v
+        After `burnin` epochs, `n_samples` weight samples are thinned evenly from the remaining steps.
+        """
+        print(f"\n == fullBNN {self.inference.upper()} training ==")
+
+        n_inputs = len(train_loader.dataset)
+        n_steps = (epochs-burnin)*len(train_loader)
+        if n_steps < n_samples:
+            raise ValueError(f"Only {n_steps} steps after burn-in, {n_samples} samples are needed.")
+
+        thinning = n_steps//n_samples
+        print("\nn_steps after burn-in =", n_steps, "\tthinning =", thinning)
+
+        params = list(self.basenet.parameters())
+        momenta = [torch.zeros_like(p) for p in params]
+        stacked_samples = {key:[] for key in self.basenet.state_dict().keys()}
 
         loss_list = []
         accuracy_list = []
 
+        step = 0
         start = time.time()
         for epoch in range(epochs):
             loss = 0.0
@@ -317,17 +571,110 @@ class BNN(PyroModule):
             for x_batch, y_batch in train_loader:
 
                 x_batch = x_batch.to(device)
-                y_batch = y_batch.to(device)
-                loss += svi.step(x_data=x_batch, y_data=y_batch.argmax(dim=-1))
+                labels = y_batch.to(device).argmax(-1)
+                outputs = self.basenet.forward(x_batch)
+
+                potential = n_inputs*nnf.cross_entropy(outputs, labels) + sum((p**2).sum() for p in params)/2
+                self.basenet.zero_grad()
+                potential.backward()
+
+                with torch.no_grad():
+                    for p, v in zip(params, momenta):
+                        if self.inference == "sgld":
+                            p.add_(-lr/2*p.grad + np.sqrt(lr)*torch.randn_like(p))
+                        else:
+                            v.mul_(1-friction).add_(-lr*p.grad + np.sqrt(2*friction*lr)*torch.randn_like(p))
+                            p.add_(v)
+
+                if epoch >= burnin:
+                    step += 1
+                    if step % thinning == 0 and step//thinning <= n_samples:
+                        for key, value in self.basenet.state_dict().items():
+                            stacked_samples[key].append(value.detach().clone())
 
-                outputs = self.forward(x_batch, training=True, avg_posterior=False).to(device)
-                predictions = outputs.argmax(-1)
-                labels = y_batch.argmax(-1)
-                correct_predictions += (predictions == labels).sum().item()
+                loss += potential.item()
+                correct_predictions += (outputs.argmax(-1) == labels).sum().item()
+
+            total_loss = loss / len(train_loader.dataset)
+            accuracy = 100 * correct_predictions / len(train_loader.dataset)
+
+            print(f"\n[Epoch {epoch + 1}]\t loss: {total_loss:.2f} \t accuracy: {accuracy:.2f}", 
+                  end="\t")
+
+            loss_list.append(loss)
+            accuracy_list.append(accuracy)
+
+        execution_time(start=start, end=time.time())
+
+        self._set_posterior_samples({key:torch.stack(samples) for key, samples in stacked_samples.items()})
+        self.save(savedir)
+
+        plot_loss_accuracy(dict={'loss':loss_list, 'accuracy':accuracy_list},
+                           path=os.path.join(savedir, self.name+"_training.png"))
+        self.to(device)
+        self.basenet.to(device)
+
+    def _svi(self, lr, num_particles=1, vectorize_particles=False):
+        """
+        Builds the SVI object and the list collecting the logits returned by the guide during each ELBO step, 
+        which are used for the training accuracy. Vectorized particles run on `vectorized_model` and 
+        `vectorized_guide`.
+        """
+        if vectorize_particles:
+            model, guide = self.vectorized_model, self.vectorized_guide
+        else:
+            model, guide = self.model, self.guide
+
+        guide_logits = []
+
+        def recorded_guide(x_data, y_data=None):
+            logits = guide(x_data, y_data)
+            guide_logits.append(logits.detach())
+            return logits
+
+        optimizer = pyro.optim.Adam({"lr":lr})
+        if vectorize_particles:
+            elbo = Trace_ELBO(num_particles=num_particles, vectorize_particles=True, max_plate_nesting=1)
+        else:
+            elbo = Trace_ELBO(num_particles=num_particles)
+
+        svi = SVI(model, recorded_guide, optimizer, loss=elbo)
+        return svi, guide_logits
+
+    def _svi_step(self, svi, guide_logits, x_batch, labels):
+        """ Returns the ELBO loss and the number of correct predictions, averaged over the step particles. """
+
+        guide_logits.clear()
+        loss = svi.step(x_data=x_batch, y_data=labels)
+
+        logits = torch.cat([logits.reshape(-1, *logits.shape[-2:]) for logits in guide_logits])
+        predictions = nnf.softmax(logits, dim=-1).mean(0).argmax(-1)
+        return loss, (predictions == labels).sum().item()
+
+    def _train_svi(self, train_loader, epochs, lr, savedir, device, num_particles=1, vectorize_particles=False):
+        print("\n == fullBNN SVI training ==")
+        print(f"\nnum_particles = {num_particles}\tvectorize_particles = {vectorize_particles}")
+
+        svi, guide_logits = self._svi(lr=lr, num_particles=num_particles, vectorize_particles=vectorize_particles)
+
+        loss_list = []
+        accuracy_list = []
+
+        start = time.time()
+        for epoch in range(epochs):
+            loss = 0.0
+            correct_predictions = 0.0
+
+            for x_batch, y_batch in train_loader:
+
+                x_batch = x_batch.to(device)
+                labels = y_batch.to(device).argmax(-1)
+                batch_loss, batch_correct = self._svi_step(svi, guide_logits, x_batch, labels)
+                loss += batch_loss
+                correct_predictions += batch_correct
             
             if DEBUG:
                 print("\n", pyro.get_param_store()["model.0.weight_loc"][0][:5])
-                print("\n",predictions[:10],"\n", labels[:10])
 
             total_loss = loss / len(train_loader.dataset)
             accuracy = 100 * correct_predictions / len(train_loader.dataset)
@@ -344,17 +691,93 @@ class BNN(PyroModule):
         plot_loss_accuracy(dict={'loss':loss_list, 'accuracy':accuracy_list},
                            path=os.path.join(savedir, self.name+"_training.png"))
 
-    def train(self, train_loader, savedir, device):
+    def _train_local_reparameterization(self, train_loader, epochs, lr, savedir, device):
+        """
+        Maximizes the same ELBO as `_train_svi` on the Bayesian layers of `_local_reparameterization_basenet`, 
+        with the closed form KL divergence from the standard normal prior. Learned means and scales are 
+        written back to the param store.
+        """
+        print("\n == fullBNN SVI training with local reparameterization ==")
+
+        basenet = self._local_reparameterization_basenet()
+        bayesian_layers = [layer for layer in basenet.model.children() if hasattr(layer, "kl_divergence")]
+        optimizer = torchopt.Adam(params=basenet.parameters(), lr=lr)
+
+        loss_list = []
+        accuracy_list = []
+
+        start = time.time()
+        for epoch in range(epochs):
+            loss = 0.0
+            correct_predictions = 0.0
+
+            for x_batch, y_batch in train_loader:
+
+                x_batch = x_batch.to(device)
+                labels = y_batch.to(device).argmax(-1)
+                outputs = basenet.forward(x_batch)
+
+                optimizer.zero_grad()
+                batch_loss = nnf.cross_entropy(outputs, labels, reduction="sum")
+                batch_loss += sum(layer.kl_divergence() for layer in bayesian_layers)
+                batch_loss.backward()
+                optimizer.step()
+
+                loss += batch_loss.item()
+                correct_predictions += (outputs.argmax(-1) == labels).sum().item()
+
+            total_loss = loss / len(train_loader.dataset)
+            accuracy = 100 * correct_predictions / len(train_loader.dataset)
+
+            print(f"\n[Epoch {epoch + 1}]\t loss: {total_loss:.2f} \t accuracy: {accuracy:.2f}", 
+                  end="\t")
+
+            loss_list.append(loss)
+            accuracy_list.append(accuracy)
+
+        execution_time(start=start, end=time.time())
+
+        param_store = pyro.get_param_store()
+        learned_params = basenet.state_dict()
+        for key in self.basenet.state_dict().keys():
+            param_store[str(f"{key}_loc")] = learned_params[key].detach()
+            param_store[str(f"{key}_scale")] = learned_params[str(f"{key}_scale")].detach()
+
+        self.save(savedir)
+
+        plot_loss_accuracy(dict={'loss':loss_list, 'accuracy':accuracy_list},
+                           path=os.path.join(savedir, self.name+"_training.png"))
+
+    @param_scoped
+    def train(self, train_loader, savedir, device, num_particles=1, vectorize_particles=False, num_chains=None):
+        """ `num_particles` and `vectorize_particles` set the ELBO estimator in SVI training. HMC training runs 
+        `num_chains` parallel chains, by default one per available CPU core, while 1 runs the sequential chain of 
+        `_train_hmc`. """
         self.to(device)
         self.basenet.to(device)
 
-        if self.inference == "svi":
-            self._train_svi(train_loader, self.epochs, self.lr, savedir, device)
+        if self.inference == "svi" and self.local_reparameterization:
+            self._train_local_reparameterization(train_loader, self.epochs, self.lr, savedir, device)
+
+        elif self.inference == "svi":
+            self._train_svi(train_loader, self.epochs, self.lr, savedir, device, num_particles=num_particles,
+                            vectorize_particles=vectorize_particles)
+
+        elif self.inference == "hmc" and num_chains != 1:
+            self._train_hmc_chains(train_loader, self.hmc_samples, self.warmup, savedir, device, 
+                                   num_chains=num_chains)
 
         elif self.inference == "hmc":
             self._train_hmc(train_loader, self.hmc_samples, self.warmup,
                             self.step_size, self.num_steps, savedir, device)
 
+        elif self.inference in ["sgld", "sghmc"]:
+            self._train_sgmcmc(train_loader, self.epochs, self.lr, self.hmc_samples, self.warmup, savedir, device)
+
+        else:
+            raise NotImplementedError
+
+    @param_scoped
     def evaluate(self, test_loader, device, avg_posterior=False, n_samples=10):
         self.to(device)
         self.basenet.to(device)
@@ -8,6 +8,7 @@ import numpy as np
 import pandas as pd 
 import copy
 from collections import OrderedDict
+from contextlib import contextmanager
 
 import torch
 from torch import nn
@@ -27,11 +28,37 @@ from pyro.nn import PyroModule
 from utils.data import *
 from utils.savedir import *
 from networks.baseNN import baseNN
+from utils.param_store import ParamStoreScope, param_scoped
+from utils.uncertainty import PredictiveMoments, adaptive_moments
+from TorchLRP import lrp
 
 
 DEBUG=False
 
 
+@contextmanager
+def swapped_parameters(module, params):
+    """ 
+    Replaces the parameters `params` ({name: tensor}) of `module` with the given tensors, which keep their graph 
+    as with `pyro.random_module`, and restores the original parameters on exit.
+    """
+    swapped = []
+    try:
+        for name, value in params.items():
+            *path, param_name = name.split(".")
+            submodule = module
+            for child_name in path:
+                submodule = getattr(submodule, child_name)
+
+            swapped.append((submodule, param_name, submodule._parameters[param_name]))
+            submodule._parameters[param_name] = value
+        yield module
+
+    finally:
+        for submodule, param_name, param in reversed(swapped):
+            submodule._parameters[param_name] = param
+
+
 redBNN_settings = {"model_0":{"dataset":"mnist", "inference":"svi", "hidden_size":512, 
                             "n_inputs":60000, "epochs":5, "lr":0.01, 
                             "activation":"leaky", "architecture":"conv", "baseNN_idx":0},
@@ -68,6 +95,7 @@ class redBNN(PyroModule):
         print("\nBayesian layer:", w_name, b_name)
         print("redBNN n. of learnable weights = ", sum(p.numel() for p in [w,b]))
         self.n_layers=self.basenet.n_layers
+        self.param_store = ParamStoreScope() # variational parameters of this model
 
 
     def _set_name(self):
@@ -97,49 +125,50 @@ class redBNN(PyroModule):
 
         return w, b, w_name, b_name
 
-    def model(self, x_data, y_data):
+    def _bayesian_forward(self, x_data, w, b):
+        """ Forward pass of the basenet with weights `w` and bias `b` in the Bayesian layer. """
+        w_name, b_name = self._bayesian_layer(self.layer_idx)[2:]
+        with swapped_parameters(self.basenet.model, {w_name:w, b_name:b}) as model:
+            return model(x_data)
 
+    @param_scoped
+    def model(self, x_data, y_data):
+        """ Only the Bayesian layer is lifted, deterministic weights never enter the param store. """
         w, b, w_name, b_name = self._bayesian_layer(self.layer_idx)
 
-        model=self.basenet.model
-        for param_name in self.basenet.model.state_dict().keys():
-            if param_name not in [w_name, b_name]:
-                pyro.get_param_store().__delitem__('module$$$'+param_name)
-
-        # print("param store =", pyro.get_param_store().get_all_param_names())
+        w_prior = Normal(loc=torch.zeros_like(w), scale=torch.ones_like(w)).to_event(w.dim())
+        b_prior = Normal(loc=torch.zeros_like(b), scale=torch.ones_like(b)).to_event(b.dim())
 
-        w_prior = Normal(loc=torch.zeros_like(w), scale=torch.ones_like(w))
-        b_prior = Normal(loc=torch.zeros_like(b), scale=torch.ones_like(b))
-        
-        priors = {w_name: w_prior, b_name: b_prior}
-        lifted_module = pyro.random_module("module", model, priors)()
+        w_sample = pyro.sample("module$$$"+w_name, w_prior)
+        b_sample = pyro.sample("module$$$"+b_name, b_prior)
 
         with pyro.plate("data", len(x_data)):
-            logits = lifted_module(x_data)
+            logits = self._bayesian_forward(x_data, w_sample, b_sample)
             lhat = nnf.log_softmax(logits, dim=-1)
             cond_model = pyro.sample("obs", Categorical(logits=lhat), obs=y_data)
 
+    @param_scoped
     def guide(self, x_data, y_data=None):
 
         w, b, w_name, b_name = self._bayesian_layer(self.layer_idx)
-        model=self.basenet.model
 
         w_loc = pyro.param(w_name+"_loc", torch.randn_like(w))
         w_scale = pyro.param(w_name+"_scale", torch.randn_like(w))
-        w_dist = Normal(loc=w_loc, scale=w_scale)
+        w_dist = Normal(loc=w_loc, scale=w_scale).to_event(w.dim())
 
         b_loc = pyro.param(b_name+"_loc", torch.randn_like(b))
         b_scale = pyro.param(b_name+"_scale", torch.randn_like(b))
-        b_dist = Normal(loc=b_loc, scale=b_scale)
+        b_dist = Normal(loc=b_loc, scale=b_scale).to_event(b.dim())
 
-        dists = {w_name: w_dist, b_name: b_dist}
-        lifted_module = pyro.random_module("module", model, dists)()
+        w_sample = pyro.sample("module$$$"+w_name, w_dist)
+        b_sample = pyro.sample("module$$$"+b_name, b_dist)
 
         with pyro.plate("data", len(x_data)):
-            logits = lifted_module(x_data)
+            logits = self._bayesian_forward(x_data, w_sample, b_sample)
         
         return logits 
 
+    @param_scoped
     def save(self, savedir):
         filename=self.name+"_weights"
 
@@ -166,6 +195,7 @@ class redBNN(PyroModule):
                 fullpath=os.path.join(savedir, filename+"_"+str(idx)+".pt")    
                 torch.save(weights.state_dict(), fullpath)
 
+    @param_scoped
     def load(self, savedir, device):
         filename=self.name+"_weights"
 
@@ -196,8 +226,89 @@ class redBNN(PyroModule):
         self.basenet.to(device)
         self.device=device
 
+    def _set_correct_layer_idx(self, layer_idx):
+        return self.basenet._set_correct_layer_idx(layer_idx)
+
+    def _bayesian_layer_position(self):
+        """ Index of the Bayesian layer among the children of `basenet.model`. """
+        w_name = self._bayesian_layer(self.layer_idx)[2]
+        return int(w_name.split(".")[0])
+
+    def _bayesian_layer_samples(self, sample_idxs, training=False):
+        """ Yields weights and bias of the Bayesian layer for each posterior sample. """
+        w, b, w_name, b_name = self._bayesian_layer(self.layer_idx)
+
+        if self.inference == "svi":
+
+            w_dist = Normal(loc=pyro.param(w_name+"_loc"), scale=pyro.param(w_name+"_scale"))
+            b_dist = Normal(loc=pyro.param(b_name+"_loc"), scale=pyro.param(b_name+"_scale"))
+
+            for seed in sample_idxs:
+                if not training:
+                    pyro.set_rng_seed(seed)
+                yield pyro.sample("module$$$"+w_name, w_dist), pyro.sample("module$$$"+b_name, b_dist)
+
+        elif self.inference == "hmc":
+
+            for seed in sample_idxs:
+                weights = self.posterior_samples[seed].model.state_dict()
+                yield weights[w_name], weights[b_name]
+
+    def has_gaussian_logits(self):
+        """ With a Gaussian guide on the last linear layer, logits are Gaussian given the penultimate features. """
+        layers = list(self.basenet.model.children())
+        bayesian_idx = self._bayesian_layer_position()
+        return self.inference == "svi" and bayesian_idx == len(layers)-1 and isinstance(layers[-1], nn.Linear)
+
+    @param_scoped
+    def logits_moments(self, inputs, *args, **kwargs):
+        """
+        Mean and variance of the logits of a last layer redBNN, from the guide locations and scales in a single 
+        pass. The mean goes through the last layer with explanation arguments (`explain`, `rule`), the variance 
+        is x^2 w_scale^2 + b_scale^2 on the features x.
+        """
+        if not self.has_gaussian_logits():
+            raise ValueError("Logits are Gaussian only when the Bayesian layer is the last linear layer.")
+
+        w, b, w_name, b_name = self._bayesian_layer(self.layer_idx)
+        layers = list(self.basenet.model.children())
+
+        features = inputs
+        if len(layers) > 1:
+            features = lrp.Sequential(*layers[:-1]).forward(inputs, *args, **kwargs)
+
+        last_layer = lrp.Sequential(layers[-1])
+        params = {"0.weight":pyro.param(w_name+"_loc"), "0.bias":pyro.param(b_name+"_loc")}
+        with swapped_parameters(last_layer, params):
+            mean = last_layer.forward(features, *args, **kwargs)
+        var = nnf.linear(features.detach()**2, pyro.param(w_name+"_scale")**2, pyro.param(b_name+"_scale")**2)
+        return mean, var
+
+    def closed_form_forward(self, inputs, softmax=False, *args, **kwargs):
+        """
+        Sample-free predictive: the expected logits are exact, the expected softmax uses the probit approximation
+        E[softmax(z)] ~ softmax(mean / sqrt(1 + pi/8 * var)).
+        """
+        mean, var = self.logits_moments(inputs, *args, **kwargs)
+
+        if softmax:
+            return nnf.softmax(mean/torch.sqrt(1+np.pi/8*var), dim=-1)
+
+        return mean
+
+    @param_scoped
     def forward(self, inputs, n_samples=10, avg_posterior=False, sample_idxs=None, training=False,
-                expected_out=True, layer_idx=-1, *args, **kwargs):
+                expected_out=True, layer_idx=-1, softmax=False, closed_form=False, moments=False, entropy=False, 
+                tolerance=None, min_samples=10, *args, **kwargs):
+        """
+        Layers before the Bayesian layer are deterministic, so their activations are computed once on the inputs 
+        and only the Bayesian layer and the following ones are evaluated for each posterior sample. 
+        `layer_idx` truncates the network as in `baseNN.forward`.
+        With `closed_form` the expected output of a last layer redBNN is computed without sampling (see 
+        `closed_form_forward`).
+        With `moments` the sample outputs are reduced one at a time to their mean and variance, and with a 
+        `tolerance` samples are drawn adaptively for each input, as in `BNN.forward`.
+        """
 
         if sample_idxs:
             if len(sample_idxs) != n_samples:
@@ -205,60 +316,51 @@ class redBNN(PyroModule):
         else:
             sample_idxs = list(range(n_samples))
 
-        if self.inference == "svi":
+        if self.inference == "hmc" and n_samples>len(self.posterior_samples):
+            raise ValueError("Too many samples. Max available samples =", len(self.posterior_samples))
 
-            if DEBUG:
-                print("\nguide_trace =", 
-                    list(poutine.trace(self.guide).get_trace(inputs).nodes.keys()))
+        layers = list(self.basenet.model.children())[:self.basenet._set_correct_layer_idx(layer_idx)]
+        bayesian_idx = self._bayesian_layer_position()
 
-            preds = []  
+        if closed_form and bayesian_idx < len(layers):
 
-            if training:
-                for _ in range(n_samples):
-                    guide_trace = poutine.trace(self.guide).get_trace(inputs)   
-                    preds.append(guide_trace.nodes['_RETURN']['value'])
+            if not expected_out or moments or tolerance is not None:
+                raise ValueError("The closed form predictive only gives expected outputs.")
 
-            else:
-                
-                w, b, w_name, b_name = self._bayesian_layer(self.layer_idx)
+            return self.closed_form_forward(inputs, softmax, *args, **kwargs)
 
-                for seed in sample_idxs:
-                    pyro.set_rng_seed(seed)
-                    guide_trace = poutine.trace(self.guide).get_trace(inputs)  
+        if bayesian_idx >= len(layers):
+            out = lrp.Sequential(*layers).forward(inputs, *args, **kwargs)
 
-                    weights = {}
-                    for key, value in self.basenet.model.state_dict().items():
-                        weights.update({str(key):value})
+            def sample_output(rows, sample_idx):
+                return out[rows]
 
-                        if key in [w_name, b_name]:
-                            w = guide_trace.nodes[str(f"module$$${key}")]["value"]
-                            weights.update({str(key):w})
-                    
-                    basenet_copy = copy.deepcopy(self.basenet)
-                    basenet_copy.model.load_state_dict(weights)
-                    preds.append(basenet_copy.forward(inputs, layer_idx=layer_idx, *args, **kwargs))
+        else:
+            activations = inputs
+            if bayesian_idx > 0:
+                activations = lrp.Sequential(*layers[:bayesian_idx]).forward(inputs, *args, **kwargs)
 
+            bayesian_net = lrp.Sequential(*layers[bayesian_idx:])
 
-        elif self.inference == "hmc":
+            def sample_output(rows, sample_idx):
+                w, b = next(self._bayesian_layer_samples([sample_idx], training=training))
+                with swapped_parameters(bayesian_net, {"0.weight":w, "0.bias":b}):
+                    return bayesian_net.forward(activations[rows], *args, **kwargs)
 
-            if n_samples>len(self.posterior_samples):
-                raise ValueError("Too many samples. Max available samples =", len(self.posterior_samples))
-
-            if explain:
-                preds = []
-                posterior_predictive = self.posterior_samples
-                for seed in sample_idxs:
-                    net = posterior_predictive[seed]
-                    preds.append(net.forward(inputs, explain=explain, rule=rule))
-
-            else:
-                preds = []
-                posterior_predictive = self.posterior_samples
-                for seed in sample_idxs:
-                    net = posterior_predictive[seed]
-                    preds.append(net.forward(inputs))
-        
-        logits = torch.stack(preds)
+        def sample_outputs(rows, sample_idx):
+            out = sample_output(rows, sample_idx)
+            return nnf.softmax(out, dim=-1) if softmax else out
+
+        if tolerance is not None:
+            return adaptive_moments(sample_outputs, len(inputs), sample_idxs, tolerance, min_samples, 
+                                    entropy=entropy, softmax=softmax, device=inputs.device)
+
+        preds = (sample_outputs(slice(None), sample_idx) for sample_idx in sample_idxs)
+
+        if moments:
+            return PredictiveMoments(entropy=entropy, softmax=softmax).reduce(preds)
+
+        logits = torch.stack(list(preds))
         return logits.mean(0) if expected_out else logits
 
     def _train_hmc(self, train_loader, savedir, device): # todo: refactor + check inferred weights 
@@ -347,6 +449,7 @@ class redBNN(PyroModule):
         plot_loss_accuracy(dict={'loss':loss_list, 'accuracy':accuracy_list},
                            path=os.path.join(savedir, self.name+"_training.png"))
 
+    @param_scoped
     def train(self, train_loader, savedir, device):
         self.to(device)
         self.basenet.to(device)
@@ -358,6 +461,7 @@ class redBNN(PyroModule):
         elif self.inference == "hmc":
             self._train_hmc(train_loader, savedir, device)
 
+    @param_scoped
     def evaluate(self, test_loader, device, n_samples):
         self.to(device)
         self.basenet.to(device)
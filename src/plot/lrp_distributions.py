@@ -15,25 +15,56 @@ from utils.savedir import *
 from utils.seeding import set_seed
 from utils.lrp import *
 
-def stripplot_lrp_values(lrp_heatmaps_list, n_samples_list, savedir, filename, layer_idx=-1):
+
+def _to_numpy(array):
+    if isinstance(array, torch.Tensor):
+        return array.detach().cpu().numpy()
+    return np.asarray(array)
+
+def _long_format(values, value_name, columns={}):
+    """
+    Long-format dataframe with one row per entry of the n-dimensional array `values`. 
+    `columns` maps each column name to an (axis, labels) pair, labels being the column values along that 
+    axis, or to a single value shared by all rows.
+    """
+    values = _to_numpy(values)
+    data = {value_name: values.reshape(-1)}
+
+    for name, column in columns.items():
+
+        if isinstance(column, tuple):
+            axis, labels = column
+            inner_size = int(np.prod(values.shape[axis+1:]))
+            outer_size = int(np.prod(values.shape[:axis]))
+            data[name] = np.tile(np.repeat(_to_numpy(labels), inner_size), outer_size)
+
+        else:
+            data[name] = np.repeat(column, values.size)
+
+    return pd.DataFrame(data=data)
+
+def _downsample(df, max_points):
+    """ Random subset of `max_points` rows, used to keep strip plots fast on large dataframes. """
+    if max_points is None or len(df) <= max_points:
+        return df
+    return df.sample(n=max_points, random_state=0)
+
+def stripplot_lrp_values(lrp_heatmaps_list, n_samples_list, savedir, filename, layer_idx=-1, max_points=None):
 
     matplotlib.rc('font', **{'weight': 'bold', 'size': 12})
     fig, ax = plt.subplots(1, 1, figsize=(10, 5), dpi=150, facecolor='w', edgecolor='k')    
     sns.set_style("darkgrid")
 
-    lrp_heatmaps_components = []
-    plot_samples = []
+    df = []
     for samples_idx, n_samples in enumerate(n_samples_list):
         
         print("\nsamples = ", n_samples, end="\t")
         print(f"min = {lrp_heatmaps_list[samples_idx].min():.4f}", end="\t")
         print(f"max = {lrp_heatmaps_list[samples_idx].max():.4f}")
 
-        flat_lrp_heatmap = np.array(lrp_heatmaps_list[samples_idx]).flatten()
-        lrp_heatmaps_components.extend(flat_lrp_heatmap)
-        plot_samples.extend(np.repeat(n_samples, len(flat_lrp_heatmap)))
+        df.append(_long_format(lrp_heatmaps_list[samples_idx], "lrp_heatmaps", {"samples":n_samples}))
 
-    df = pd.DataFrame(data={"lrp_heatmaps": lrp_heatmaps_components, "samples": plot_samples})
+    df = _downsample(pd.concat(df, ignore_index=True), max_points)
 
     sns.stripplot(x="samples", y="lrp_heatmaps", data=df, linewidth=-0.1, ax=ax, 
                   jitter=0.2, alpha=0.4, palette="gist_heat")
@@ -63,24 +94,13 @@ def lrp_labels_distributions(lrp_heatmaps, labels, num_classes, n_samples_list,
 
     ### dataframe
 
-    lrp_list = []
-    labels_list = []
-    samples_list = []
-
     for samples_idx, n_samples in enumerate(n_samples_list):
         
         print("\nsamples = ", n_samples, end="\t")
         print(f"min = {flat_lrp_heatmaps[samples_idx].min():.4f}", end="\t")
         print(f"max = {flat_lrp_heatmaps[samples_idx].max():.4f}")
-        
-        for im_idx, label in enumerate(labels):
 
-            lrp_heatmap = flat_lrp_heatmaps[samples_idx, im_idx, :]
-            lrp_list.extend(lrp_heatmap)
-            samples_list.extend(np.repeat(n_samples, len(lrp_heatmap)))
-            labels_list.extend(np.repeat(label, len(lrp_heatmap)))
-
-    df = pd.DataFrame(data={"lrp": lrp_list, "samples": samples_list, "label":labels_list})
+    df = _long_format(flat_lrp_heatmaps, "lrp", {"samples":(0, n_samples_list), "label":(1, labels)})
     print(df.head())
 
     ### plot
@@ -115,25 +135,13 @@ def lrp_samples_distributions(lrp_heatmaps, labels, num_classes, n_samples_list,
 
     ### dataframe
 
-    lrp_list=[]
-    labels_list=[]
-    samples_list=[]
-
     for samples_idx, n_samples in enumerate(n_samples_list):
 
         print("\nsamples =", n_samples, end="\t")
         print(f"min = {flat_lrp_heatmaps[samples_idx].min():.4f}", end=" \t")
         print(f"max = {flat_lrp_heatmaps[samples_idx].max():.4f}")
 
-        for pixel_idx in range(flat_lrp_heatmaps.shape[-1]):
-            pixel_lrp = flat_lrp_heatmaps[samples_idx, :, pixel_idx]
-
-            lrp_list.extend(pixel_lrp)
-            samples_list.extend(np.repeat(n_samples, len(pixel_lrp)))
-            labels_list.extend(labels)
-
-        df = pd.DataFrame(data={"lrp": lrp_list, "samples": samples_list,
-                               "label":labels_list})
+    df = _long_format(flat_lrp_heatmaps, "lrp", {"samples":(0, n_samples_list), "label":(1, labels)})
 
     ### plot 
 
@@ -161,47 +169,26 @@ def lrp_pixels_distributions(lrp_heatmaps, labels, num_classes, n_samples, saved
     savedir = os.path.join(savedir, lrp_savedir(layer_idx), "pixels_distributions")
     os.makedirs(savedir, exist_ok=True) 
 
-    ### dataframe
-
-    lrp_list=[]
-    labels_list=[]
-    samples_list=[]
-    pixel_idxs_list=[]
-
     for im_idx in range(len(lrp_heatmaps)):
 
+        ### dataframe
+
         image_lrp_heatmaps = np.expand_dims(lrp_heatmaps[im_idx,:], axis=1)
-        image_label = labels[im_idx]
         flat_lrp_heatmaps, chosen_pxl_idxs = select_informative_pixels(image_lrp_heatmaps, topk)
 
-        for samples_idx in range(n_samples):
-            for array_idx, pixel_idx in enumerate(chosen_pxl_idxs):
-
-                pixel_lrp = flat_lrp_heatmaps[samples_idx, array_idx][0]
-
-                lrp_list.append(pixel_lrp)
-                samples_list.append(n_samples)
-                pixel_idxs_list.append(pixel_idx)
-                labels_list.append(image_label)
-
-        df = pd.DataFrame(data={"lrp":lrp_list, "samples":samples_list,
-                               "label":labels_list, "pixel_idx":pixel_idxs_list})
+        # (samples, 1, topk) -> one row per (sample, chosen pixel)
+        df = _long_format(flat_lrp_heatmaps[:n_samples, 0], "lrp", 
+                          {"pixel_idx":(1, chosen_pxl_idxs), "samples":n_samples, "label":_to_numpy(labels[im_idx])})
 
         ### plot 
 
-        for array_idx, pixel_idx in enumerate(chosen_pxl_idxs):
-
-            sns.set_style("darkgrid")
-            matplotlib.rc('font', **{'weight': 'bold', 'size': 12})
-            fig, ax = plt.subplots(1, 1, figsize=(10, 5), dpi=150, facecolor='w', edgecolor='k')    
-
-            pxl_df = df.loc[df['pixel_idx'] == pixel_idx]
-
-            for samples_idx in range(n_samples):
+        sns.set_style("darkgrid")
+        matplotlib.rc('font', **{'weight': 'bold', 'size': 12})
+        fig, ax = plt.subplots(1, 1, figsize=(10, 5), dpi=150, facecolor='w', edgecolor='k')    
 
-                samp_df = pxl_df.loc[pxl_df['samples'] == n_samples]
-                sns.distplot(samp_df["lrp"], ax=ax, kde=False)
-                ax.set_yscale('log')
+        for pixel_idx, pxl_df in df.groupby("pixel_idx"):
+            sns.distplot(pxl_df["lrp"], ax=ax, kde=False)
+            ax.set_yscale('log')
 
         fig.savefig(os.path.join(savedir, filename+"_im_idx="+str(im_idx)+".png"))
         plt.close(fig)
@@ -639,53 +626,18 @@ def lrp_layers_mode_robustness(det_lrp_robustness, bay_lrp_robustness, mode_lrp_
 
     ### dataframe
 
-    df_lrp_robustness= []
-    df_layer_idx = []
-    df_model_type = []
-    df_atk_type = []
-    df_n_samples = []
-    df_topk = []
-
-    for topk_idx, topk in enumerate(topk_list):
-        for layer_idx, layer in enumerate(learnable_layers_idxs):
-
-            subset_lrp_rob = det_lrp_robustness[topk_idx, layer_idx]
-            df_lrp_robustness.extend(subset_lrp_rob)
-            df_layer_idx.extend(np.repeat(layer, len(subset_lrp_rob)))
-            df_model_type.extend(np.repeat("deterministic", len(subset_lrp_rob)))
-            df_atk_type.extend(np.repeat("deterministic", len(subset_lrp_rob)))
-            df_n_samples.extend(np.repeat(None, len(subset_lrp_rob)))
-            df_topk.extend(np.repeat(topk, len(subset_lrp_rob)))
-
-            subset_lrp_rob = mode_lrp_robustness[topk_idx, layer_idx, -1]
-            df_lrp_robustness.extend(subset_lrp_rob)
-            df_layer_idx.extend(np.repeat(layer, len(subset_lrp_rob)))
-            df_model_type.extend(np.repeat("mode", len(subset_lrp_rob)))
-            df_atk_type.extend(np.repeat("mode", len(subset_lrp_rob)))
-            df_n_samples.extend(np.repeat(None, len(subset_lrp_rob)))
-            df_topk.extend(np.repeat(topk, len(subset_lrp_rob)))
-
-            for samp_idx, n_samples in enumerate(n_samples_list):
-
-                subset_lrp_rob = bay_lrp_robustness[topk_idx, layer_idx, samp_idx]
-                df_lrp_robustness.extend(subset_lrp_rob)
-                df_layer_idx.extend(np.repeat(layer, len(subset_lrp_rob)))
-                df_model_type.extend(np.repeat("bayesian", len(subset_lrp_rob)))
-                df_atk_type.extend(np.repeat("bayesian", len(subset_lrp_rob)))
-                df_n_samples.extend(np.repeat(None, len(subset_lrp_rob)))
-                df_topk.extend(np.repeat(topk, len(subset_lrp_rob)))
-
-                subset_lrp_rob = mode_lrp_robustness[topk_idx, layer_idx, samp_idx]
-                df_lrp_robustness.extend(subset_lrp_rob)
-                df_layer_idx.extend(np.repeat(layer, len(subset_lrp_rob)))
-                df_model_type.extend(np.repeat("bayesian", len(subset_lrp_rob)))
-                df_atk_type.extend(np.repeat("mode", len(subset_lrp_rob)))
-                df_n_samples.extend(np.repeat(None, len(subset_lrp_rob)))
-                df_topk.extend(np.repeat(topk, len(subset_lrp_rob)))
-
-
-    df = pd.DataFrame(data={"LRP Rob.":df_lrp_robustness, "Layer idx":df_layer_idx,
-                            "Net.":df_model_type, "Atk.":df_atk_type, "Samp.":df_n_samples, "topk":df_topk})
+    topk_layers_columns = {"topk":(0, topk_list), "Layer idx":(1, learnable_layers_idxs), "Samp.":None}
+
+    df = pd.concat([
+        _long_format(det_lrp_robustness, "LRP Rob.", 
+                     {**topk_layers_columns, "Net.":"deterministic", "Atk.":"deterministic"}),
+        _long_format(np.asarray(mode_lrp_robustness)[:, :, -1], "LRP Rob.", 
+                     {**topk_layers_columns, "Net.":"mode", "Atk.":"mode"}),
+        _long_format(np.asarray(bay_lrp_robustness)[:, :, :len(n_samples_list)], "LRP Rob.", 
+                     {**topk_layers_columns, "Net.":"bayesian", "Atk.":"bayesian"}),
+        _long_format(np.asarray(mode_lrp_robustness)[:, :, :len(n_samples_list)], "LRP Rob.", 
+                     {**topk_layers_columns, "Net.":"bayesian", "Atk.":"mode"}),
+        ], ignore_index=True)
 
     ### plot
 
@@ -58,19 +58,16 @@ def relevant_subset(images, pxl_idxs, lrp_rob_method):
 
     print("relevant pixels=", pxl_idxs)
 
-    if lrp_rob_method=="imagewise":
-
-        # different selection of pixels for each image
-        for image_idx, im_pxl_idxs in enumerate(pxl_idxs):
-            images_rel[image_idx,im_pxl_idxs] = flat_images[image_idx,im_pxl_idxs]
-
-    elif lrp_rob_method=="pixelwise":
+    if lrp_rob_method=="pixelwise":
 
         # same pxls for all the images
         images_rel[:,pxl_idxs] = flat_images[:,pxl_idxs]
 
     else:
-        raise NotImplementedError
+
+        # different selection of pixels for each image
+        for image_idx, im_pxl_idxs in enumerate(pxl_idxs):
+            images_rel[image_idx,im_pxl_idxs] = flat_images[image_idx,im_pxl_idxs]
     
     images_rel = images_rel.reshape(images.shape)
     return images_rel
@@ -0,0 +1,166 @@
+"""
+Headless plot rendering.
+Figure jobs (a plotting function and its keyword arguments) are rendered with the Agg backend in a pool of
+worker processes, so that compute scripts can enqueue figures instead of drawing them inline.
+Jobs are cached by a hash of their inputs and only re-rendered when the inputs change or their figures are
+missing.
+"""
+
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import numpy as np
+
+from utils.savedir import TESTS
+
+RENDER_CACHE = os.path.join(TESTS, "render_cache/")
+DEBUG=False
+
+
+def _to_cpu(obj):
+    """ Detaches tensors and moves them to cpu, so that jobs can be pickled and drawn without a GPU. """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu()
+    elif isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+def _update_hash(hasher, obj):
+
+    if isinstance(obj, torch.Tensor):
+        obj = obj.numpy()
+
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        hasher.update(str((obj.shape, str(obj.dtype))).encode())
+        hasher.update(np.ascontiguousarray(obj).tobytes())
+
+    elif isinstance(obj, dict):
+        for key in sorted(obj.keys()):
+            hasher.update(str(key).encode())
+            _update_hash(hasher, obj[key])
+
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        hasher.update(str(len(obj)).encode())
+        for value in obj:
+            _update_hash(hasher, value)
+
+    else:
+        hasher.update(repr(obj).encode())
+
+def job_hash(plot_fn, kwargs):
+    hasher = hashlib.sha1()
+    hasher.update((plot_fn.__module__+"."+plot_fn.__qualname__).encode())
+    _update_hash(hasher, kwargs)
+    return hasher.hexdigest()
+
+def _init_backend():
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+
+def _init_worker():
+    _init_backend()
+
+    # scripts may set cuda as default, figures are always drawn on cpu
+    torch.set_default_tensor_type('torch.FloatTensor')
+    torch.set_num_threads(1)
+
+def _render(plot_fn, kwargs, stamp_path):
+    """ Draws the figures of a job and stamps it with the paths of the saved figures. """
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+
+    figures = []
+    savefig = Figure.savefig
+
+    def recorded_savefig(fig, fname, *args, **savefig_kwargs):
+        figures.append(os.path.abspath(os.fspath(fname)))
+        return savefig(fig, fname, *args, **savefig_kwargs)
+
+    Figure.savefig = recorded_savefig
+    try:
+        plot_fn(**kwargs)
+    finally:
+        Figure.savefig = savefig
+        plt.close('all')
+
+    with open(stamp_path, "w") as f:
+        json.dump({"plot_fn":plot_fn.__module__+"."+plot_fn.__qualname__, "figures":figures}, f)
+
+    return stamp_path
+
+def _up_to_date(stamp_path):
+    """ Whether the job was rendered and its figures still exist. """
+    try:
+        with open(stamp_path) as f:
+            figures = json.load(f)["figures"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    return all(os.path.exists(figure) for figure in figures)
+
+
+class PlotRenderer:
+    """
+    Renders figure jobs in `n_workers` processes (all cpu cores by default). With `n_workers=0` figures are
+    drawn in the current process, still using the Agg backend and the cache.
+    Figures already rendered from the same inputs are skipped, unless a figure file was deleted; delete `cache_dir`
+    to force re-rendering.
+    """
+
+    def __init__(self, n_workers=None, cache_dir=RENDER_CACHE):
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.cache_dir = cache_dir
+        self.futures = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if self.n_workers > 0:
+            # fork, since the scripts submitting jobs are not import-safe
+            self.pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                            mp_context=multiprocessing.get_context("fork"))
+        else:
+            self.pool = None
+            # the current process keeps its default tensor type and threads
+            _init_backend()
+
+    def submit(self, plot_fn, **kwargs):
+        """ Enqueues `plot_fn(**kwargs)`. Returns the job future, or None if the figure is up to date. """
+        kwargs = _to_cpu(kwargs)
+        stamp_path = os.path.join(self.cache_dir, job_hash(plot_fn, kwargs))
+
+        if _up_to_date(stamp_path):
+            print(f"\n{plot_fn.__name__}: inputs unchanged, skipping.")
+            return None
+
+        if DEBUG:
+            print(f"\nRendering {plot_fn.__name__}")
+
+        if self.pool is None:
+            _render(plot_fn, kwargs, stamp_path)
+            return None
+
+        future = self.pool.submit(_render, plot_fn, kwargs, stamp_path)
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        """ Blocks until all submitted figures are rendered, raising the first rendering error. """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -18,6 +18,10 @@ parser.add_argument("--model", default="baseNN", type=str, help="baseNN, fullBNN
 parser.add_argument("--model_idx", default=0, type=int, help="Choose model idx from pre defined settings.")
 parser.add_argument("--load", default=False, type=eval, help="Load saved computations and evaluate them.")
 parser.add_argument("--redBNN_layer_idx", default=-1, type=int, help="Index for the Bayesian layer in redBNN.")
+parser.add_argument("--num_particles", default=1, type=int, help="Number of ELBO particles in fullBNN SVI training.")
+parser.add_argument("--vectorize_particles", default=False, type=eval, help="Batch ELBO particles in fullBNN SVI training.")
+parser.add_argument("--local_reparameterization", default=False, type=eval, help="Sample fullBNN SVI pre-activations.")
+parser.add_argument("--hmc_chains", default=None, type=eval, help="Parallel fullBNN HMC chains, None uses all CPU cores, 1 runs a single chain.")
 parser.add_argument("--debug", default=False, type=eval, help="Run script in debugging mode.")
 parser.add_argument("--device", default='cuda', type=str, help="cpu, cuda")  
 args = parser.parse_args()
@@ -63,7 +67,8 @@ else:
         savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
                               debug=args.debug, model_idx=args.model_idx)
 
-        net = BNN(m["dataset"], *list(m.values())[1:], inp_shape, out_size)
+        net = BNN(m["dataset"], *list(m.values())[1:], inp_shape, out_size, 
+                  local_reparameterization=args.local_reparameterization)
 
     elif args.model=="redBNN":
         
@@ -82,7 +87,7 @@ else:
         hyp = get_hyperparams(m)
         layer_idx=args.redBNN_layer_idx+basenet.n_learnable_layers+1 if args.redBNN_layer_idx<0 else args.redBNN_layer_idx
         net = redBNN(dataset_name=m["dataset"], inference=m["inference"], base_net=basenet, hyperparams=hyp,
-                     layer_idx=args.redBNN_layer_idx)
+                     layer_idx=layer_idx)
         savedir = get_model_savedir(model=args.model, dataset=m["dataset"], architecture=m["architecture"], 
                               debug=args.debug, model_idx=args.model_idx, layer_idx=layer_idx)
 
@@ -95,12 +100,17 @@ else:
         if m["inference"]=="svi":
             bayesian_attack_samples=[5,10,50]
 
-        elif m["inference"]=="hmc":
+        elif m["inference"] in ["hmc", "sgld", "sghmc"]:
             bayesian_attack_samples=[5,10,50]
 
     if args.load:
         net.load(savedir=savedir, device=args.device)
 
+    elif args.model=="fullBNN":
+        net.train(train_loader=train_loader, savedir=savedir, device=args.device, 
+                  num_particles=args.num_particles, vectorize_particles=args.vectorize_particles, 
+                  num_chains=args.hmc_chains)
+
     else:
         net.train(train_loader=train_loader, savedir=savedir, device=args.device)
 
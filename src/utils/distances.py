@@ -0,0 +1,149 @@
+"""
+Batched distances between LRP heatmaps.
+Every measure compares two sets of heatmaps with shape (n. images, image shape) image by image, on the device
+of the inputs and without looping over the images.
+"""
+
+import torch
+
+
+def flatten_heatmaps(heatmaps):
+    """ Returns heatmaps with shape (n. images, n. pixels). """
+    heatmaps = torch.as_tensor(heatmaps)
+    return heatmaps.reshape(heatmaps.shape[0], -1)
+
+def _flatten_pair(original_heatmaps, adversarial_heatmaps):
+
+    original_heatmaps = flatten_heatmaps(original_heatmaps)
+    adversarial_heatmaps = flatten_heatmaps(adversarial_heatmaps).to(original_heatmaps.device)
+
+    if original_heatmaps.shape != adversarial_heatmaps.shape:
+        raise ValueError("Heatmaps should have the same shape.")
+
+    return original_heatmaps, adversarial_heatmaps
+
+def wasserstein_distance(original_heatmaps, adversarial_heatmaps):
+    """
+    1-D Wasserstein distance between the empirical distributions of pixel relevances in each pair of images.
+    Both distributions have one atom per pixel, so the area between the CDFs is the mean absolute difference
+    of the sorted relevances (same values as `scipy.stats.wasserstein_distance`).
+    """
+    original_heatmaps, adversarial_heatmaps = _flatten_pair(original_heatmaps, adversarial_heatmaps)
+
+    original_cdf = original_heatmaps.sort(dim=-1)[0]
+    adversarial_cdf = adversarial_heatmaps.sort(dim=-1)[0]
+    return (original_cdf-adversarial_cdf).abs().mean(dim=-1)
+
+def heatmaps_distribution(heatmaps, eps=1e-10):
+    """ Normalizes absolute relevances to a probability distribution over the pixels of each image. """
+    heatmaps = flatten_heatmaps(heatmaps).abs()+eps
+    return heatmaps/heatmaps.sum(dim=-1, keepdim=True)
+
+def _kl(p, q):
+    return (p*(p.log()-q.log())).sum(dim=-1)
+
+def kl_divergence(original_heatmaps, adversarial_heatmaps, eps=1e-10):
+    """ KL(original || adversarial) between the normalized heatmaps. """
+    original_heatmaps, adversarial_heatmaps = _flatten_pair(original_heatmaps, adversarial_heatmaps)
+    return _kl(heatmaps_distribution(original_heatmaps, eps), heatmaps_distribution(adversarial_heatmaps, eps))
+
+def js_divergence(original_heatmaps, adversarial_heatmaps, eps=1e-10):
+    """ Jensen-Shannon divergence between the normalized heatmaps, bounded by log(2). """
+    original_heatmaps, adversarial_heatmaps = _flatten_pair(original_heatmaps, adversarial_heatmaps)
+
+    p = heatmaps_distribution(original_heatmaps, eps)
+    q = heatmaps_distribution(adversarial_heatmaps, eps)
+    m = (p+q)/2
+    return (_kl(p, m)+_kl(q, m))/2
+
+def rankdata(heatmaps):
+    """
+    Ranks (from 1 to n. pixels) of the relevances in each image. Tied pixels get the average of their ordinal
+    ranks, as in `scipy.stats.rankdata`, which matters for the many null relevances in LRP heatmaps.
+    """
+    heatmaps = flatten_heatmaps(heatmaps)
+    sorted_heatmaps, order = heatmaps.sort(dim=-1)
+
+    new_value = torch.ones(sorted_heatmaps.shape, dtype=torch.bool, device=heatmaps.device)
+    new_value[:, 1:] = sorted_heatmaps[:, 1:] != sorted_heatmaps[:, :-1]
+    tie_groups = new_value.long().cumsum(dim=-1)-1
+
+    # float64 keeps the sums of ranks exact on large images
+    positions = torch.arange(1, heatmaps.shape[1]+1, dtype=torch.float64, device=heatmaps.device)
+    positions = positions.expand(sorted_heatmaps.shape)
+
+    ranks_sum = torch.zeros(positions.shape, dtype=torch.float64, device=heatmaps.device)
+    ranks_sum.scatter_add_(-1, tie_groups, positions)
+    ties_count = torch.zeros(positions.shape, dtype=torch.float64, device=heatmaps.device)
+    ties_count.scatter_add_(-1, tie_groups, torch.ones_like(positions))
+
+    sorted_ranks = (ranks_sum/ties_count.clamp(min=1)).gather(-1, tie_groups)
+    return torch.empty_like(sorted_ranks).scatter_(-1, order, sorted_ranks)
+
+def _pearson(x, y):
+    x = x-x.mean(dim=-1, keepdim=True)
+    y = y-y.mean(dim=-1, keepdim=True)
+    return (x*y).sum(dim=-1)/torch.sqrt((x**2).sum(dim=-1)*(y**2).sum(dim=-1))
+
+def _constant_correlations(correlations, original_constant, adversarial_constant):
+    """
+    Constant heatmaps (e.g. all null relevances) rank no pixel above another, so their correlation is undefined.
+    It is set to 1 when both heatmaps are constant, since no ranking changed, and to 0 when only one of them is.
+    """
+    constant = original_constant | adversarial_constant
+    both_constant = (original_constant & adversarial_constant).to(correlations.dtype)
+    return torch.where(constant, both_constant, correlations)
+
+def spearman_correlation(original_heatmaps, adversarial_heatmaps):
+    """
+    Spearman rank correlation between each pair of heatmaps. Ranks come from a single sort per image, whose 
+    permutation is inverted by scattering (i.e. argsort of argsort). Constant heatmaps are handled as in 
+    `_constant_correlations`.
+    """
+    original_heatmaps, adversarial_heatmaps = _flatten_pair(original_heatmaps, adversarial_heatmaps)
+    rho = _pearson(rankdata(original_heatmaps), rankdata(adversarial_heatmaps))
+    rho = _constant_correlations(rho, (original_heatmaps == original_heatmaps[:, :1]).all(dim=-1),
+                                 (adversarial_heatmaps == adversarial_heatmaps[:, :1]).all(dim=-1))
+    return rho.to(original_heatmaps.dtype)
+
+def kendall_tau(original_heatmaps, adversarial_heatmaps, n_pairs=10000, seed=0, chunk_size=2**14):
+    """
+    Kendall tau-b between each pair of heatmaps, estimated on `n_pairs` random pixel pairs shared by all the
+    images. With `n_pairs=None` all the pixel pairs are used, which is exact but quadratic in the number of
+    pixels. Pairs are processed in chunks of `chunk_size` to bound memory. Heatmaps without untied pairs are
+    handled as constant ones in `_constant_correlations`.
+    """
+    original_heatmaps, adversarial_heatmaps = _flatten_pair(original_heatmaps, adversarial_heatmaps)
+    n_pixels = original_heatmaps.shape[1]
+    device = original_heatmaps.device
+
+    if n_pairs is None:
+        first_pxls, second_pxls = torch.triu_indices(n_pixels, n_pixels, offset=1, device=device)
+
+    else:
+        generator = torch.Generator(device="cpu").manual_seed(seed)
+        first_pxls = torch.randint(n_pixels, (n_pairs,), generator=generator, device="cpu")
+        shifts = torch.randint(1, n_pixels, (n_pairs,), generator=generator, device="cpu")
+        second_pxls = (first_pxls+shifts) % n_pixels
+        first_pxls, second_pxls = first_pxls.to(device), second_pxls.to(device)
+
+    concordance = torch.zeros(original_heatmaps.shape[0], dtype=torch.float64, device=device)
+    original_untied = torch.zeros_like(concordance)
+    adversarial_untied = torch.zeros_like(concordance)
+
+    for start in range(0, len(first_pxls), chunk_size):
+        first, second = first_pxls[start:start+chunk_size], second_pxls[start:start+chunk_size]
+        original_sign = torch.sign(original_heatmaps[:, first]-original_heatmaps[:, second])
+        adversarial_sign = torch.sign(adversarial_heatmaps[:, first]-adversarial_heatmaps[:, second])
+
+        concordance += (original_sign*adversarial_sign).sum(dim=-1)
+        original_untied += (original_sign != 0).sum(dim=-1)
+        adversarial_untied += (adversarial_sign != 0).sum(dim=-1)
+
+    tau = concordance/torch.sqrt(original_untied*adversarial_untied)
+    tau = _constant_correlations(tau, original_untied == 0, adversarial_untied == 0)
+    return tau.to(original_heatmaps.dtype)
+
+
+heatmaps_distances = {"wasserstein":wasserstein_distance, "kl":kl_divergence, "js":js_divergence}
+heatmaps_correlations = {"spearman":spearman_correlation, "kendall":kendall_tau}
@@ -7,11 +7,14 @@ from torch import nn
 from tqdm import tqdm
 import torch.nn.functional as nnf
 from torchvision import transforms
-from scipy.stats import wasserstein_distance
 
 from utils.savedir import *
 from utils.seeding import set_seed
 from utils.data import load_from_pickle, save_to_pickle
+from utils.lrp_cache import explanations_key
+from utils.lrp_statistics import Welford
+from utils.precision import autocast
+from utils.distances import heatmaps_distances, heatmaps_correlations
 
 cmap_name="RdBu_r"
 DEBUG=False
@@ -64,7 +67,36 @@ def select_informative_pixels(lrp_heatmaps, topk):
 	return chosen_pxls_lrp, chosen_pxl_idxs
 
 
-def compute_explanations(x_test, network, rule, method, n_samples=None, layer_idx=-1, avg_posterior=False):
+def compute_explanations(x_test, network, rule, method, n_samples=None, layer_idx=-1, avg_posterior=False,
+						 cache=None, closed_form=False, precision="float32", statistics=None, tolerance=None, 
+						 min_samples=10):
+	"""
+	When an `ExplanationsCache` is given, explanations are looked up by content and only computed on a miss.
+	With `closed_form` the avg_prediction method explains the exact expected logits of redBNNs with a Bayesian 
+	last layer, without sampling. This is the Monte Carlo limit for the gradient rule, while rules dividing by 
+	the pre-activations (e.g. epsilon) normalize each sample separately in the Monte Carlo average.
+	With `precision` bfloat16 or float16 the forward passes run under autocast and relevances are propagated 
+	in float32.
+	A `HeatmapsStatistics` collector given as `statistics` receives the per-sample heatmaps of the avg_heatmap 
+	method, which are otherwise discarded after averaging, and explanations are then never loaded from the cache.
+	With a `tolerance` Bayesian explanations draw at most `n_samples` samples for each image, stopping when the 
+	mean prediction (avg_prediction) or the mean heatmap (avg_heatmap) converges (see 
+	`utils.uncertainty.standard_error_converged`), and the samples used by each image are returned last.
+	"""
+	if precision == "int8":
+		raise ValueError("Quantized layers have no LRP rules.")
+
+	if statistics is not None and (n_samples is None or avg_posterior or method!="avg_heatmap"):
+		raise ValueError("Heatmaps statistics are only available for the avg_heatmap method.")
+
+	if cache is not None:
+		key = explanations_key(network, x_test, rule, method, n_samples, layer_idx, avg_posterior, closed_form,
+							   precision, tolerance, min_samples)
+		explanations = None if statistics is not None else cache.get(key, device=x_test.device)
+
+		if explanations is not None:
+			print("\nLoaded cached explanations.")
+			return explanations
 
 	print("\nLRP layer idx =", layer_idx)
 
@@ -76,6 +108,9 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 	else:
 		print(nn.Sequential(*list(network.model.children())[:layer_idx]))
 
+	adaptive = tolerance is not None and n_samples is not None and not avg_posterior and \
+			   not (method=="avg_prediction" and closed_form)
+
 	if n_samples is None or avg_posterior is True:
 
 		explanations = []
@@ -84,8 +119,9 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 			x = x.detach()
 			x.requires_grad=True
 			# Forward pass
-			y_hat = network.forward(x.unsqueeze(0), explain=True, rule=rule, layer_idx=layer_idx,
-									avg_posterior=avg_posterior)
+			with autocast(precision, x.device):
+				y_hat = network.forward(x.unsqueeze(0), explain=True, rule=rule, layer_idx=layer_idx,
+										avg_posterior=avg_posterior)
 
 			# Choose argmax
 			y_hat = y_hat[torch.arange(x.shape[0]), y_hat.max(1)[1]].sum()
@@ -97,6 +133,8 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 
 	else:
 
+		used_samples = []
+
 		if method=="avg_prediction":
 
 			explanations = []
@@ -105,7 +143,17 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 				# Forward pass
 				x_copy = copy.deepcopy(x.detach()).unsqueeze(0)
 				x_copy.requires_grad = True	
-				y_hat = network.forward(inputs=x_copy, n_samples=n_samples, explain=True, rule=rule, layer_idx=layer_idx)
+				forward_kwargs = {"closed_form":True} if closed_form else {}
+				if adaptive:
+					forward_kwargs.update({"tolerance":tolerance, "min_samples":min_samples})
+
+				with autocast(precision, x_copy.device):
+					y_hat = network.forward(inputs=x_copy, n_samples=n_samples, explain=True, rule=rule, 
+											layer_idx=layer_idx, **forward_kwargs)
+
+				if isinstance(y_hat, dict):
+					used_samples.append(y_hat["n_samples"].item())
+					y_hat = y_hat["mean"]
 
 				# Choose argmax
 				y_hat = y_hat[torch.arange(x_copy.shape[0]), y_hat.max(1)[1]]
@@ -121,14 +169,21 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 			explanations = []
 			for x in tqdm(x_test):
 
-				post_explanations = []
+				# sample heatmaps are reduced to their running mean, shared with the statistics collector
+				if statistics is not None:
+					statistics.new_image()
+					welford = statistics.welford
+				else:
+					welford = Welford()
+
 				for j in range(n_samples):
 
 					# Forward pass
 					x_copy = copy.deepcopy(x.detach()).unsqueeze(0)
 					x_copy.requires_grad = True
-					y_hat = network.forward(inputs=x_copy, n_samples=1, sample_idxs=[j], 
-											explain=True, rule=rule, layer_idx=layer_idx)
+					with autocast(precision, x_copy.device):
+						y_hat = network.forward(inputs=x_copy, n_samples=1, sample_idxs=[j], 
+												explain=True, rule=rule, layer_idx=layer_idx)
 					
 					# Choose argmax
 					y_hat = y_hat[torch.arange(x_copy.shape[0]), y_hat.max(1)[1]]
@@ -137,75 +192,84 @@ def compute_explanations(x_test, network, rule, method, n_samples=None, layer_id
 					# Backward pass (compute explanation)
 					y_hat.backward()
 					lrp = x_copy.grad.squeeze(1)
-					post_explanations.append(lrp)
 
-				explanations.append(torch.stack(post_explanations).mean(0))
+					if statistics is not None:
+						statistics.update(lrp)
+					else:
+						welford.update(lrp)
+
+					if adaptive and welford.converged(tolerance, min_samples):
+						break
+
+				explanations.append(welford.mean)
+				used_samples.append(welford.count)
+
+				if statistics is not None:
+					statistics.end_image()
+
+			if statistics is not None:
+				statistics.close()
 
 	explanations = torch.stack(explanations) 
+
+	if adaptive:
+		used_samples = torch.tensor(used_samples)
+		print(f"\nAvg. samples = {used_samples.float().mean().item():.2f}")
+		explanations = (explanations, used_samples)
+
+	if cache is not None:
+		cache.put(key, explanations)
+
 	return explanations
 
 def normalize(lrp):
 	return 2*(lrp-lrp.min())/(lrp.max()-lrp.min())-1
 
 def compute_vanishing_norm_idxs(inputs, n_samples_list, norm="linfty"):
+	"""
+	Vectorized over images and sample counts: `inputs` has shape (len(n_samples_list), n. images, ...) and 
+	can be either a numpy array or a torch tensor, whose norms are computed on its own device.
+	An image has vanishing norms when its norm never increases along `n_samples_list`.
+	"""
 
 	if inputs.shape[0] != len(n_samples_list):
 		raise ValueError("First dimension should equal the length of `n_samples_list`")
 
-	inputs=np.transpose(inputs, (1, 0, 2, 3, 4))
-	vanishing_norm_idxs = []
-	non_null_idxs = []
+	if isinstance(inputs, torch.Tensor):
+		flat_inputs = inputs.detach().reshape(*inputs.shape[:2], -1)
 
-	print("\nvanishing norms:\n")
-	count_van_images = 0
-	count_incr_images = 0
-	count_null_images = 0
+		if norm == "linfty":
+			norms = flat_inputs.abs().max(-1)[0]
+		elif norm == "l2":
+			norms = torch.norm(flat_inputs, dim=-1)
+		else:
+			raise ValueError("Wrong norm name")
+
+		norms = norms.cpu().numpy()
 
-	for idx, image in enumerate(inputs):
+	else:
+		flat_inputs = np.asarray(inputs).reshape(*inputs.shape[:2], -1)
 
 		if norm == "linfty":
-			inputs_norm = np.max(np.abs(image[0]))
+			norms = np.max(np.abs(flat_inputs), axis=-1)
 		elif norm == "l2":
-			inputs_norm = np.linalg.norm(image[0])  
+			norms = np.linalg.norm(flat_inputs, axis=-1)
 		else:
 			raise ValueError("Wrong norm name")
-		
-		if inputs_norm != 0.0:
-			if DEBUG:
-				print("idx =",idx, end="\t")
-			count_samples_idx = 0
-			for samples_idx, n_samples in enumerate(n_samples_list):
-
-				if norm == "linfty":
-					new_inputs_norm = np.max(np.abs(image[samples_idx]))
-				elif norm == "l2":
-					new_inputs_norm = np.linalg.norm(image[samples_idx])
-
-				if new_inputs_norm <= inputs_norm:
-					if DEBUG:
-						print(new_inputs_norm, end="\t")
-					inputs_norm = copy.deepcopy(new_inputs_norm)
-					count_samples_idx += 1
-
-			if count_samples_idx == len(n_samples_list):
-				vanishing_norm_idxs.append(idx)
-				non_null_idxs.append(idx)
-				if DEBUG:
-					print("\tcount=", count_van_images)
-				count_van_images += 1
-			else: 
-				non_null_idxs.append(idx)
-				count_incr_images += 1
-
-			if DEBUG:
-				print("\n")
 
-		else:
-			count_null_images += 1
+	# norms shape = (len(n_samples_list), n. images)
+	null_norms = norms[0] == 0.0
+	vanishing_norms = np.all(np.diff(norms, axis=0) <= 0, axis=0) & ~null_norms
+	increasing_norms = ~vanishing_norms & ~null_norms
+
+	vanishing_norm_idxs = np.where(vanishing_norms)[0].tolist()
+	non_null_idxs = np.where(~null_norms)[0].tolist()
+	n_images = norms.shape[1]
 
-	print(f"vanishing norms = {100*count_van_images/len(inputs)} %")
-	print(f"increasing norms = {100*count_incr_images/len(inputs)} %")
-	print(f"null norms = {100*count_null_images/len(inputs)} %")
+	print("\nvanishing norms:\n")
+	print(f"vanishing norms = {100*vanishing_norms.sum()/n_images} %")
+	print(f"increasing norms = {100*increasing_norms.sum()/n_images} %")
+	print(f"null norms = {100*null_norms.sum()/n_images} %")
 	print("\nvanishing norms idxs = ", vanishing_norm_idxs)
 	return vanishing_norm_idxs, non_null_idxs
 
@@ -224,44 +288,110 @@ def lrp_distances(original_heatmaps, adversarial_heatmaps, pxl_idxs=None, axis_n
 	distances = torch.norm(original_heatmaps-adversarial_heatmaps, dim=axis_norm)
 	return distances
 
+def _topk_intersections(original_heatmaps, adversarial_heatmaps, topk):
+	""" 
+	Common topk relevant pixels of each original and adversarial heatmap, as sorted arrays. Heatmaps are 
+	flattened as in `select_informative_pixels` and the topk pixels of all the images are selected at once.
+	"""
+
+	n_images = len(original_heatmaps)
+	if n_images==0:
+		return []
+
+	def _topk_pxl_idxs(heatmaps):
+		flat_heatmaps = heatmaps.reshape(n_images, -1)
+		return torch.topk(flat_heatmaps, k=min(topk, flat_heatmaps.shape[1]), dim=1)[1]
+
+	orig_pxl_idxs = _topk_pxl_idxs(original_heatmaps)
+	adv_pxl_idxs = torch.sort(_topk_pxl_idxs(adversarial_heatmaps), dim=1)[0]
+
+	positions = torch.searchsorted(adv_pxl_idxs, orig_pxl_idxs.contiguous()).clamp(max=adv_pxl_idxs.shape[1]-1)
+	common = adv_pxl_idxs.gather(1, positions)==orig_pxl_idxs
+
+	n_pixels = original_heatmaps[0].numel()
+	pxl_idxs = torch.sort(torch.where(common, orig_pxl_idxs, n_pixels), dim=1)[0].detach().cpu().numpy()
+	n_common = common.sum(1).cpu().numpy()
+	return [im_pxl_idxs[:n] for im_pxl_idxs, n in zip(pxl_idxs, n_common)]
+
+def _imagewise_pxl_idxs(chosen_pxl_idxs):
+
+	if len(set(len(pxl_idxs) for pxl_idxs in chosen_pxl_idxs))>1:
+		# imagewise intersections have different sizes
+		ragged_pxl_idxs = np.empty(len(chosen_pxl_idxs), dtype=object)
+		ragged_pxl_idxs[:] = chosen_pxl_idxs
+		return ragged_pxl_idxs
+
+	return np.array(chosen_pxl_idxs)
+
+def _pixelwise_robustness(original_heatmaps, adversarial_heatmaps, chosen_pxl_idxs):
+	chosen_pxl_idxs = [pxl_idx for pxl_idxs in chosen_pxl_idxs for pxl_idx in pxl_idxs]
+	distances = lrp_distances(original_heatmaps, adversarial_heatmaps, chosen_pxl_idxs)
+	return -np.array(distances.detach().cpu().numpy()), np.array(chosen_pxl_idxs)
+
 def lrp_robustness(original_heatmaps, adversarial_heatmaps, topk, method):
 	"""
 	Point-wise robustness measure. Computes the fraction of common topk relevant pixels between each original
 	image and adversarial image.
+	Distribution methods (wasserstein, kl, js) return minus the distance between the full heatmaps and 
+	rank correlation methods (spearman, kendall) return the correlation, so that higher values are always more robust. 
+	Constant heatmaps have a correlation of 1 with constant heatmaps and of 0 with any other one.
+	They are batched over the images and keep the imagewise topk pixels as chosen pixels.
 	"""
 
-	robustness = []
-	chosen_pxl_idxs=[]
-
-	# print(original_heatmaps.shape, adversarial_heatmaps.shape)
+	if method=="imagewise" or method in heatmaps_distances or method in heatmaps_correlations:
 
-	if method=="imagewise":
+		chosen_pxl_idxs = _topk_intersections(original_heatmaps, adversarial_heatmaps, topk)
 
-		for im_idx in range(len(original_heatmaps)):
-			orig_pxl_idxs = select_informative_pixels(original_heatmaps[im_idx], topk=topk)[1]
-			adv_pxl_idxs = select_informative_pixels(adversarial_heatmaps[im_idx], topk=topk)[1]
+		if method in heatmaps_distances and len(original_heatmaps)>0:
+			robustness = -heatmaps_distances[method](original_heatmaps, adversarial_heatmaps).detach().cpu().numpy()
 
-			pxl_idxs = np.intersect1d(orig_pxl_idxs.detach().cpu().numpy(), adv_pxl_idxs.detach().cpu().numpy())
+		elif method in heatmaps_correlations and len(original_heatmaps)>0:
+			robustness = heatmaps_correlations[method](original_heatmaps, adversarial_heatmaps).detach().cpu().numpy()
 
-			robustness.append(len(pxl_idxs)/topk)
-			chosen_pxl_idxs.append(pxl_idxs)
+		else:
+			robustness = [len(pxl_idxs)/topk for pxl_idxs in chosen_pxl_idxs]
 
 	elif method=="pixelwise":
 
-		for im_idx in range(len(original_heatmaps)):
-			orig_pxl_idxs = select_informative_pixels(original_heatmaps[im_idx], topk=topk)[1]
-			adv_pxl_idxs = select_informative_pixels(adversarial_heatmaps[im_idx], topk=topk)[1]
-			pxl_idxs = np.intersect1d(orig_pxl_idxs.detach().cpu().numpy(), adv_pxl_idxs.detach().cpu().numpy())
-			chosen_pxl_idxs.extend(pxl_idxs)
-
-		distances = lrp_distances(original_heatmaps, adversarial_heatmaps, chosen_pxl_idxs)
-		robustness = -np.array(distances.detach().cpu().numpy())
+		chosen_pxl_idxs = _topk_intersections(original_heatmaps, adversarial_heatmaps, topk)
+		return _pixelwise_robustness(original_heatmaps, adversarial_heatmaps, chosen_pxl_idxs)
 
 	else:
 		raise NotImplementedError
 
 	if DEBUG:
-		print("\n", pxl_idxs.shape, np.array(chosen_pxl_idxs).shape, np.array(robustness).shape)
+		print("\n", np.array(robustness).shape)
+
+	return np.array(robustness), _imagewise_pxl_idxs(chosen_pxl_idxs)
+
+def grouped_lrp_robustness(original_heatmaps, adversarial_heatmaps, topk, method, groups):
+	"""
+	`lrp_robustness` of each group of images in `groups` ({name: image idxs}, None for all the images), e.g. all,
+	successful and failed attacks. Heatmaps are sorted and compared once, and each group selects its images.
+	Imagewise methods index the robustness of all the images, while the pixelwise method computes the distances 
+	of each group on the union of its images topk pixels.
+	"""
+
+	if method=="pixelwise":
+		chosen_pxl_idxs = _topk_intersections(original_heatmaps, adversarial_heatmaps, topk)
+
+		grouped_robustness = {}
+		for group, idxs in groups.items():
+			idxs = np.arange(len(original_heatmaps)) if idxs is None else np.asarray(idxs, dtype=int)
+			grouped_robustness[group] = _pixelwise_robustness(original_heatmaps[idxs], adversarial_heatmaps[idxs],
+															  [chosen_pxl_idxs[idx] for idx in idxs])
+		return grouped_robustness
+
+	robustness, chosen_pxl_idxs = lrp_robustness(original_heatmaps, adversarial_heatmaps, topk=topk, method=method)
+
+	grouped_robustness = {}
+	for group, idxs in groups.items():
+		idxs = np.arange(len(original_heatmaps)) if idxs is None else np.asarray(idxs, dtype=int)
+		grouped_robustness[group] = (robustness[idxs], _imagewise_pxl_idxs([chosen_pxl_idxs[idx] for idx in idxs]))
+
+	return grouped_robustness
 
-	return np.array(robustness), np.array(chosen_pxl_idxs)
+def attack_groups(successful_idxs, failed_idxs):
+	""" All the images, successful and failed attacks, for `grouped_lrp_robustness`. """
+	return {"all":None, "successful":successful_idxs, "failed":failed_idxs}
 
@@ -0,0 +1,183 @@
+"""
+Content-addressed cache for LRP explanations.
+Heatmaps are stored under a hash of (model weights, inputs, rule, layer_idx, lrp_method, n_samples,
+avg_posterior), so that any script can fetch them without knowing the savedir naming conventions.
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+from utils.savedir import TESTS
+from utils.lrp_storage import load_heatmaps
+
+LRP_CACHE = os.path.join(TESTS, "lrp_cache/")
+DEBUG=False
+
+
+def _update_hash(hasher, tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    hasher.update(str((tuple(tensor.shape), str(tensor.dtype))).encode())
+    hasher.update(tensor.numpy().tobytes())
+
+def tensor_hash(tensor):
+    hasher = hashlib.sha1()
+    _update_hash(hasher, tensor)
+    return hasher.hexdigest()
+
+def model_hash(network):
+    """
+    Hash of the weights defining the network predictions: the state dict for deterministic nets,
+    the posterior samples for HMC and SG-MCMC nets and the learned variational parameters for SVI nets.
+    The basenet weights of fullBNNs are an unused initialization, so they only enter the hash of redBNNs, whose
+    layers outside the Bayesian one are deterministic.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(str(getattr(network, "name", type(network).__name__)).encode())
+
+    if hasattr(network, "basenet"):
+
+        if hasattr(network, "_bayesian_layer"):
+            for key, value in network.basenet.state_dict().items():
+                hasher.update(key.encode())
+                _update_hash(hasher, value)
+
+        if network.inference == "svi":
+            with network.param_store as param_store:
+                for key in sorted(param_store.keys()):
+                    hasher.update(key.encode())
+                    _update_hash(hasher, param_store[key])
+
+        else:
+            for net in network.posterior_samples:
+                for value in net.state_dict().values():
+                    _update_hash(hasher, value)
+
+    else:
+        for key, value in network.state_dict().items():
+            hasher.update(key.encode())
+            _update_hash(hasher, value)
+
+    return hasher.hexdigest()
+
+def explanations_key(network, x_test, rule, method, n_samples=None, layer_idx=-1, avg_posterior=False,
+                     closed_form=False, precision="float32", tolerance=None, min_samples=10):
+    """
+    Arguments not affecting `compute_explanations` outputs are dropped from the key, so that equivalent
+    calls share the same entry.
+    """
+    if avg_posterior is True:
+        n_samples = None
+
+    if n_samples is None:
+        method = None
+
+    fields = [model_hash(network), tensor_hash(x_test), rule, method, n_samples, layer_idx, avg_posterior]
+
+    if closed_form and method == "avg_prediction":
+        fields[4] = "closed_form"
+
+    if precision != "float32":
+        fields.append(precision)
+
+    if tolerance is not None and n_samples is not None and fields[4] != "closed_form":
+        fields.extend(["relative_tolerance", tolerance, min_samples])
+
+    hasher = hashlib.sha1()
+    for field in fields:
+        hasher.update(str(field).encode())
+
+    return hasher.hexdigest()
+
+def load_explanations(cache, key, path, filename, device="cpu", **kwargs):
+    """
+    Looks up the explanations of `key` in `cache`, falling back to the heatmaps saved by `compute_lrp.py` in
+    `path` when they were not cached. `kwargs` are passed to `load_heatmaps`.
+    """
+    explanations = None if cache is None else cache.get(key, device=device)
+
+    if explanations is None:
+        return load_heatmaps(path=path, filename=filename, **kwargs).to(device)
+
+    if DEBUG:
+        print("\nLoaded cached explanations:", filename)
+
+    return explanations
+
+
+class ExplanationsCache:
+    """
+    Disk cache of LRP heatmaps, one file per key. Least recently used entries are evicted when the total
+    size exceeds `max_size` (in bytes).
+    """
+
+    def __init__(self, cache_dir=LRP_CACHE, max_size=10*1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+        entries = [(filename[:-3], os.path.join(cache_dir, filename)) for filename in os.listdir(cache_dir)
+                   if filename.endswith(".pt")]
+        entries = sorted(entries, key=lambda entry: os.path.getmtime(entry[1]))
+
+        self.index = OrderedDict([(key, os.path.getsize(path)) for key, path in entries])
+        self.size = sum(self.index.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+".pt")
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key, device="cpu"):
+
+        if key not in self.index:
+            return None
+
+        path = self._path(key)
+        os.utime(path)
+        self.index.move_to_end(key)
+
+        if DEBUG:
+            print("\nLoading cached explanations:", path)
+
+        return torch.load(path, map_location=device)
+
+    def put(self, key, explanations):
+
+        path = self._path(key)
+        if isinstance(explanations, tuple):
+            torch.save(tuple(tensor.detach().cpu() for tensor in explanations), path)
+        else:
+            torch.save(explanations.detach().cpu(), path)
+
+        if key in self.index:
+            self.size -= self.index[key]
+
+        self.index[key] = os.path.getsize(path)
+        self.index.move_to_end(key)
+        self.size += self.index[key]
+        self._evict()
+
+    def _evict(self):
+
+        while self.size > self.max_size and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            os.remove(self._path(key))
+            self.size -= size
+
+            if DEBUG:
+                print("\nEvicted cached explanations:", key)
+
+    def clear(self):
+
+        for key in list(self.index.keys()):
+            os.remove(self._path(key))
+
+        self.index = OrderedDict()
+        self.size = 0
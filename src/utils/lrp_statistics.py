@@ -0,0 +1,211 @@
+"""
+Streaming statistics of the per-sample heatmaps of Bayesian explanations.
+`compute_explanations` with method="avg_heatmap" feeds each posterior sample heatmap to a `HeatmapsStatistics`
+collector, which keeps pixelwise running means and variances (Welford) and quantiles (P^2 algorithm, Jain and
+Chlamtac 1985) in constant memory with respect to the number of samples. Raw per-sample heatmaps can also be
+written to a `ChunkedHeatmapsStore`, with shape (n. images, n. samples, image shape) as in
+`plot.lrp_distributions.lrp_pixels_distributions`.
+"""
+
+import os
+import glob
+
+import torch
+
+from utils.uncertainty import standard_error_converged
+
+DEBUG=False
+
+
+class Welford:
+    """ Elementwise running mean and (unbiased) variance, differentiable with respect to the observations. """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        self.count += 1
+
+        if self.count == 1:
+            self.mean = x
+            self.m2 = torch.zeros_like(x)
+        else:
+            delta = x-self.mean
+            self.mean = self.mean+delta/self.count
+            self.m2 = self.m2+delta*(x-self.mean)
+
+    @property
+    def var(self):
+        if self.count < 2:
+            return torch.zeros_like(self.mean)
+        return self.m2/(self.count-1)
+
+    def converged(self, tolerance, min_samples):
+        """ Whether the mean has converged, as a single input of `standard_error_converged`. """
+        return bool(standard_error_converged(self.mean.unsqueeze(0), self.var.unsqueeze(0), self.count, tolerance,
+                                             min_samples))
+
+
+class P2Quantile:
+    """ Elementwise P^2 estimate of the `p` quantile, exact on the first five observations. """
+
+    def __init__(self, p):
+        if not 0 < p < 1:
+            raise ValueError("Quantile should be in (0, 1).")
+
+        self.p = p
+        self.count = 0
+        self.observations = []
+
+    def _desired_positions(self):
+        """ Desired marker positions, shared by all the elements. """
+        p, steps = self.p, self.count-5
+        return [0., 2*p+steps*p/2, 4*p+steps*p, 2+2*p+steps*(1+p)/2, 4.+steps]
+
+    def update(self, x):
+        x = x.detach()
+        self.count += 1
+
+        if self.count <= 5:
+            self.observations.append(x.clone())
+
+            if self.count == 5:
+                self.heights = torch.sort(torch.stack(self.observations), dim=0)[0]
+                self.positions = torch.arange(5., device=x.device, dtype=x.dtype).reshape(5, *[1]*x.dim()).repeat(1, *x.shape)
+                self.observations = []
+            return
+
+        q, n = self.heights, self.positions
+
+        cell = (x.unsqueeze(0) >= q[1:4]).sum(0)
+        q[0] = torch.minimum(q[0], x)
+        q[4] = torch.maximum(q[4], x)
+
+        markers = torch.arange(5, device=x.device).reshape(5, *[1]*x.dim())
+        n += (markers > cell.unsqueeze(0)).to(n.dtype)
+        desired = self._desired_positions()
+
+        for i in range(1, 4):
+            d = desired[i]-n[i]
+            move = ((d >= 1) & (n[i+1]-n[i] > 1)) | ((d <= -1) & (n[i-1]-n[i] < -1))
+            d = torch.sign(d)
+
+            parabolic = q[i] + d/(n[i+1]-n[i-1]) * ((n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i]) +
+                                                     (n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+            q_neighbour = torch.where(d > 0, q[i+1], q[i-1])
+            n_neighbour = torch.where(d > 0, n[i+1], n[i-1])
+            linear = q[i] + d*(q_neighbour-q[i])/(n_neighbour-n[i])
+
+            inside = (q[i-1] < parabolic) & (parabolic < q[i+1])
+            q[i] = torch.where(move, torch.where(inside, parabolic, linear), q[i])
+            n[i] = torch.where(move, n[i]+d, n[i])
+
+    @property
+    def value(self):
+        if self.count < 5:
+            return torch.quantile(torch.stack(self.observations), self.p, dim=0)
+        return self.heights[2].clone()
+
+
+class ChunkedHeatmapsStore:
+    """ Writes the per-sample heatmaps of `chunk_size` images to each file of `savedir`. """
+
+    def __init__(self, savedir, filename, chunk_size=100, dtype=torch.float32):
+        self.savedir = savedir
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.buffer = []
+        self.n_chunks = 0
+        os.makedirs(savedir, exist_ok=True)
+
+    def append(self, sample_heatmaps):
+        self.buffer.append(sample_heatmaps.detach().cpu().to(self.dtype))
+        if len(self.buffer) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        path = os.path.join(self.savedir, self.filename+"_chunk="+str(self.n_chunks)+".pt")
+        torch.save(torch.stack(self.buffer), path)
+        self.buffer = []
+        self.n_chunks += 1
+
+        if DEBUG:
+            print("\nSaved heatmaps chunk:", path)
+
+    @staticmethod
+    def load(savedir, filename, chunk_idxs=None):
+        """ Per-sample heatmaps of all the chunks (or of `chunk_idxs`), in float32. """
+        paths = glob.glob(os.path.join(glob.escape(savedir), glob.escape(filename)+"_chunk=*.pt"))
+        paths = sorted(paths, key=lambda path: int(path.split("_chunk=")[-1][:-3]))
+
+        if chunk_idxs is not None:
+            paths = [paths[idx] for idx in chunk_idxs]
+
+        return torch.cat([torch.load(path).float() for path in paths])
+
+
+class HeatmapsStatistics:
+    """
+    Pixelwise mean, variance and `quantiles` of the sample heatmaps of each image, stacked over the images
+    after `compute_explanations`. With a `store` the sample heatmaps are also persisted.
+    """
+
+    def __init__(self, quantiles=(0.05, 0.5, 0.95), store=None):
+        self.quantile_levels = quantiles
+        self.store = store
+        self.images_mean, self.images_var, self.images_quantiles = [], [], []
+        self.images_n_samples = []
+
+    def new_image(self):
+        self.welford = Welford()
+        self.estimators = [P2Quantile(p) for p in self.quantile_levels]
+        self.samples = []
+
+    def update(self, heatmap):
+        self.welford.update(heatmap.detach())
+        for estimator in self.estimators:
+            estimator.update(heatmap)
+        if self.store is not None:
+            self.samples.append(heatmap.detach())
+
+    def end_image(self):
+        self.images_mean.append(self.welford.mean)
+        self.images_var.append(self.welford.var)
+        self.images_n_samples.append(self.welford.count)
+        self.images_quantiles.append(torch.stack([estimator.value for estimator in self.estimators]))
+
+        if self.store is not None:
+            self.store.append(torch.stack(self.samples))
+            self.samples = []
+
+    def close(self):
+        if self.store is not None:
+            self.store.flush()
+
+    @property
+    def mean(self):
+        return torch.stack(self.images_mean)
+
+    @property
+    def var(self):
+        return torch.stack(self.images_var)
+
+    @property
+    def n_samples(self):
+        return torch.tensor(self.images_n_samples)
+
+    @property
+    def quantiles(self):
+        """ {quantile level: heatmaps} """
+        quantiles = torch.stack(self.images_quantiles, 1)
+        return {p:quantiles[idx] for idx, p in enumerate(self.quantile_levels)}
+
+    def summary(self):
+        return {"mean":self.mean.cpu(), "var":self.var.cpu(), "n_samples":self.n_samples,
+                "quantiles":{p:value.cpu() for p, value in self.quantiles.items()}}
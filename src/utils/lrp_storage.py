@@ -0,0 +1,82 @@
+"""
+Compressed storage of LRP heatmaps, in the same pickle files as `save_to_pickle`.
+"float32" keeps the dense tensors as they are, "float16" halves their size and "topk" only keeps the `topk` most
+relevant pixels of each image, as (indices, float16 values) pairs. `load_heatmaps` reads any of them, together with
+the plain float32 pickles, and returns dense float32 heatmaps.
+Pixels dropped by "topk" are filled with a value just below the smallest kept one, so that the top k <= `topk`
+pixels chosen by `select_informative_pixels` (and the imagewise `lrp_robustness`) are those of the original
+heatmaps, up to float16 ties. Anything else (larger k, pixelwise, distance and rank robustness, norms and plots of
+the heatmaps) needs a dense format, and `load_heatmaps` refuses "topk" heatmaps for it.
+"""
+
+import torch
+
+from utils.data import save_to_pickle, load_from_pickle
+
+STORAGE_FORMATS = ["float32", "float16", "topk"]
+
+
+def compress_heatmaps(heatmaps, storage="float32", topk=None):
+
+    if storage == "float32":
+        return heatmaps
+
+    elif storage == "float16":
+        return {"format":"float16", "heatmaps":heatmaps.detach().cpu().half()}
+
+    elif storage == "topk":
+
+        if topk is None:
+            raise ValueError("topk storage needs the number of pixels.")
+
+        flat_heatmaps = heatmaps.detach().cpu().reshape(len(heatmaps), -1)
+        values, indices = torch.topk(flat_heatmaps, k=min(topk, flat_heatmaps.shape[1]), dim=1)
+        index_dtype = torch.int16 if flat_heatmaps.shape[1] <= torch.iinfo(torch.int16).max else torch.int32
+
+        return {"format":"topk", "shape":tuple(heatmaps.shape), "topk":topk,
+                "indices":indices.to(index_dtype), "values":values.half()}
+
+    else:
+        raise ValueError(f"Storage should be one of {STORAGE_FORMATS}.")
+
+def decompress_heatmaps(data):
+
+    if torch.is_tensor(data):
+        return data
+
+    if data["format"] == "float16":
+        return data["heatmaps"].float()
+
+    elif data["format"] == "topk":
+        values = data["values"].float()
+        fill = torch.nextafter(values[:, -1:], torch.tensor(-float("inf"))).clamp(max=0.)
+
+        flat_heatmaps = fill.repeat(1, int(torch.tensor(data["shape"][1:]).prod()))
+        flat_heatmaps.scatter_(1, data["indices"].long(), values)
+        return flat_heatmaps.reshape(data["shape"])
+
+    else:
+        raise ValueError(f"Unknown heatmaps format {data['format']}.")
+
+def save_heatmaps(heatmaps, path, filename, storage="float32", topk=None):
+    save_to_pickle(compress_heatmaps(heatmaps, storage=storage, topk=topk), path=path, filename=filename)
+
+def load_heatmaps(path, filename, topk=None, method="imagewise"):
+    """
+    Callers only using the top `topk` pixels of the heatmaps through the `lrp_robustness` `method` pass them, 
+    by default the full heatmaps are needed. Heatmaps stored in the "topk" format raise a ValueError unless 
+    `topk` is within the stored one and `method` is "imagewise".
+    """
+    data = load_from_pickle(path=path, filename=filename)
+
+    if isinstance(data, dict) and data["format"] == "topk":
+
+        if topk is None or method != "imagewise":
+            raise ValueError(f"{filename} only stores the top {data['topk']} pixels of each heatmap, "
+                             "which are exact for the imagewise robustness only.")
+
+        if topk > data["topk"]:
+            raise ValueError(f"{filename} only stores the top {data['topk']} pixels of each heatmap, "
+                             f"top {topk} were requested.")
+
+    return decompress_heatmaps(data)
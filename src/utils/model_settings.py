@@ -25,4 +25,10 @@ fullBNN_settings = {"model_0":{"dataset":"mnist", "hidden_size":512, "activation
                     "model_3":{"dataset":"fashion_mnist", "hidden_size":1024, "activation":"leaky",
                            "architecture":"fc2", "inference":"hmc", "epochs":None,
                            "lr":None, "hmc_samples":100, "warmup":100},
+                    "model_4":{"dataset":"mnist", "hidden_size":512, "activation":"leaky",
+                           "architecture":"conv", "inference":"sgld", "epochs":20,
+                           "lr":1e-6, "hmc_samples":100, "warmup":5},
+                    "model_5":{"dataset":"mnist", "hidden_size":512, "activation":"leaky",
+                           "architecture":"conv", "inference":"sghmc", "epochs":20,
+                           "lr":1e-7, "hmc_samples":100, "warmup":5},
                     }  
@@ -1,8 +1,14 @@
+from collections import OrderedDict
+
 from utils.data import * 
+from utils.savedir import *
+from utils.model_settings import baseNN_settings, fullBNN_settings
 from networks.baseNN import *
 from networks.fullBNN import *
 from networks.redBNN import *
 
+DEBUG=False
+
 
 def load_test_net(model_idx, model_type, n_inputs, device, load_dir, return_data_loader=True):
 
@@ -49,4 +55,119 @@ def load_test_net(model_idx, model_type, n_inputs, device, load_dir, return_data
         return test_loader, net
 
     else:
-        return (x_test, y_test), net
\ No newline at end of file
+        return (x_test, y_test), net
+
+class ModelRegistry:
+    """
+    In-process cache of trained models, keyed by (model type, model idx, layer idx, device, debug). Models are 
+    built from the predefined settings and loaded from their savedirs on the first request, then shared by all 
+    the callers. redBNNs reuse the cached deterministic baseNN of their settings. Least recently used models 
+    are dropped when the total size of their weights exceeds `max_memory` (in bytes).
+    """
+
+    def __init__(self, max_memory=4*1024**3):
+        self.max_memory = max_memory
+        self.models = OrderedDict()
+        self.memory = 0
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    def get(self, model_type, model_idx, inp_shape, num_classes, layer_idx=None, device="cpu", debug=False):
+        """
+        Returns the loaded network and its savedir. `layer_idx` is the Bayesian layer of redBNNs, negative 
+        indexes count from the last learnable layer.
+        """
+        if model_type=="redBNN":
+            # the baseNN is only needed to load a redBNN, its n. of learnable layers follows from the settings
+            m = redBNN_settings["model_"+str(model_idx)]
+            architecture = baseNN_settings["model_"+str(m["baseNN_idx"])]["architecture"]
+            n_learnable_layers = len(LEARNABLE_LAYERS_IDXS[architecture])
+            layer_idx = -1 if layer_idx is None else layer_idx
+            layer_idx = layer_idx+n_learnable_layers+1 if layer_idx<0 else layer_idx
+        else:
+            layer_idx = None
+
+        key = (model_type, model_idx, layer_idx, device, debug)
+
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key][:2]
+
+        net, savedir = self._load(model_type, model_idx, inp_shape, num_classes, layer_idx, device, debug)
+
+        size = model_nbytes(net, exclude=[net.basenet] if model_type=="redBNN" else [])
+        self.models[key] = (net, savedir, size)
+        self.memory += size
+        self._evict()
+
+        return net, savedir
+
+    def _load(self, model_type, model_idx, inp_shape, num_classes, layer_idx, device, debug):
+
+        if model_type=="baseNN":
+
+            m = baseNN_settings["model_"+str(model_idx)]
+            savedir = get_model_savedir(model="baseNN", dataset=m["dataset"], architecture=m["architecture"], 
+                                        debug=debug, model_idx=model_idx)
+            net = baseNN(inp_shape, num_classes, *list(m.values()))
+
+        elif model_type=="fullBNN":
+
+            m = fullBNN_settings["model_"+str(model_idx)]
+            savedir = get_model_savedir(model="fullBNN", dataset=m["dataset"], architecture=m["architecture"], 
+                                        debug=debug, model_idx=model_idx)
+            net = BNN(m["dataset"], *list(m.values())[1:], inp_shape, num_classes)
+
+        elif model_type=="redBNN":
+
+            m = redBNN_settings["model_"+str(model_idx)]
+            basenet = self.get("baseNN", m["baseNN_idx"], inp_shape, num_classes, device=device, debug=debug)[0]
+            savedir = get_model_savedir(model="redBNN", dataset=m["dataset"], architecture=m["architecture"], 
+                                        debug=debug, model_idx=model_idx, layer_idx=layer_idx)
+            net = redBNN(dataset_name=m["dataset"], inference=m["inference"], base_net=basenet, 
+                         hyperparams=get_hyperparams(m), layer_idx=layer_idx)
+
+        else:
+            raise NotImplementedError
+
+        net.load(savedir=savedir, device=device)
+        return net, savedir
+
+    def _evict(self):
+
+        while self.memory > self.max_memory and len(self.models) > 1:
+            key, (net, savedir, size) = self.models.popitem(last=False)
+            self.memory -= size
+
+            if DEBUG:
+                print("\nEvicted model:", key)
+
+    def clear(self):
+        self.models = OrderedDict()
+        self.memory = 0
+
+
+def model_nbytes(net, exclude=()):
+    """ Size of the weights, posterior samples and variational parameters of `net`, except those of the 
+    `exclude` modules. """
+    tensors = list(net.state_dict().values())
+    tensors += [value for sample in getattr(net, "posterior_samples", []) for value in sample.state_dict().values()]
+    if hasattr(net, "param_store"):
+        tensors += list(net.param_store._params.values())
+
+    excluded = {value.data_ptr() for module in exclude for value in module.state_dict().values()}
+    storages = {tensor.data_ptr():tensor.numel()*tensor.element_size() for tensor in tensors 
+                if tensor.data_ptr() not in excluded}
+    return sum(storages.values())
+
+
+registry = ModelRegistry()
+
+def load_model(model_type, model_idx, inp_shape, num_classes, layer_idx=None, device="cpu", debug=False):
+    """ Loads a network from the default `registry`. Returns the network and its savedir. """
+    return registry.get(model_type, model_idx, inp_shape, num_classes, layer_idx=layer_idx, device=device, 
+                        debug=debug)
@@ -0,0 +1,58 @@
+"""
+Per-model scoping of the pyro param store.
+Pyro primitives always read and write the global param store, so BNNs sharing a process would overwrite each
+other's variational parameters (e.g. two redBNNs with the same layer names). Each model owns a `ParamStoreScope`
+holding its own parameters: `with scope:` (or methods decorated with `param_scoped`) swaps them into the global
+store and restores the previous content on exit, without copying any tensor. Scopes can be nested and are
+entered by one thread at a time, so that several models can be served by the same worker.
+"""
+
+import threading
+import functools
+
+import pyro
+
+_SCOPE_LOCK = threading.RLock()
+
+
+class ParamStoreScope:
+
+    def __init__(self):
+        self._params, self._param_to_name, self._constraints = {}, {}, {}
+        self._outer_stores = []
+
+    def __enter__(self):
+        _SCOPE_LOCK.acquire()
+        param_store = pyro.get_param_store()
+        self._outer_stores.append((param_store._params, param_store._param_to_name, param_store._constraints))
+        param_store._params, param_store._param_to_name, param_store._constraints = \
+            self._params, self._param_to_name, self._constraints
+        return param_store
+
+    def __exit__(self, *exc_info):
+        param_store = pyro.get_param_store()
+
+        # `clear()` replaces the dictionaries of the store
+        self._params, self._param_to_name, self._constraints = \
+            param_store._params, param_store._param_to_name, param_store._constraints
+        param_store._params, param_store._param_to_name, param_store._constraints = self._outer_stores.pop()
+        _SCOPE_LOCK.release()
+
+    def __len__(self):
+        return len(self._params)
+
+    def __getstate__(self):
+        # scopes are entered again in subprocesses
+        state = self.__dict__.copy()
+        state["_outer_stores"] = []
+        return state
+
+
+def param_scoped(method):
+    """ Runs a model method inside the model param store (`self.param_store`). """
+    @functools.wraps(method)
+    def scoped_method(self, *args, **kwargs):
+        with self.param_store:
+            return method(self, *args, **kwargs)
+
+    return scoped_method
@@ -0,0 +1,76 @@
+"""
+Reduced precision policy for inference-only stages.
+"bfloat16" and "float16" run the network forward passes under autocast, so that linear and convolutional
+layers compute in half precision, while the LRP relevance backward passes stay in float32 (see
+`TorchLRP.lrp.functional.utils.float32_backward`). "int8" evaluates deterministic networks with dynamically
+quantized linear layers on the CPU, and has no LRP rules.
+Reduced precision APIs are only looked up in their branches, so "float32" runs on any torch version. Before
+torch 1.10 autocast is only available for "float16" on cuda.
+"""
+
+import copy
+import contextlib
+
+import torch
+
+from TorchLRP import lrp
+
+PRECISIONS = ["float32", "bfloat16", "float16", "int8"]
+
+
+def autocast(precision, device):
+    """ Context for the forward passes in the given precision. """
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision should be one of {PRECISIONS}.")
+
+    if precision in ["bfloat16", "float16"]:
+        device_type = torch.device(device).type
+
+        if hasattr(torch, "autocast"):
+            return torch.autocast(device_type=device_type, dtype=getattr(torch, precision))
+
+        if precision == "float16" and device_type == "cuda":
+            return torch.cuda.amp.autocast()
+
+        raise ValueError(f"{precision} autocast on {device_type} needs torch >= 1.10.")
+
+    return contextlib.nullcontext()
+
+def quantize_network(net):
+    """
+    CPU copy of a deterministic network with int8 dynamically quantized `lrp.Linear` layers, which quantize
+    the activations at each call. Convolutions are left in float32.
+    """
+    if hasattr(net, "basenet"):
+        raise ValueError("Only deterministic networks can be quantized.")
+
+    try:
+        from torch.ao.nn.quantized.dynamic import Linear as QuantizedLinear
+        from torch.ao.quantization import default_dynamic_qconfig
+    except ImportError:
+        # torch < 1.13
+        from torch.nn.quantized.dynamic import Linear as QuantizedLinear
+        from torch.quantization import default_dynamic_qconfig
+
+    qnet = copy.deepcopy(net).to("cpu")
+
+    layers = []
+    for layer in qnet.model.children():
+        if isinstance(layer, lrp.Linear):
+            linear = torch.nn.Linear(layer.in_features, layer.out_features, bias=layer.bias is not None)
+            linear.load_state_dict(layer.state_dict())
+            linear.qconfig = default_dynamic_qconfig
+            layer = QuantizedLinear.from_float(linear)
+        layers.append(layer)
+
+    qnet.model = torch.nn.Sequential(*layers)
+    return qnet
+
+def precision_forward(net, precision, device):
+    """ Network to evaluate in the given precision, and its device. """
+
+    if precision == "int8":
+        return quantize_network(net), "cpu"
+
+    return net, device
@@ -0,0 +1,178 @@
+"""
+Per-stage instrumentation of the scripts.
+`stage(name)` (context manager) and `profile_stage(name)` (decorator) record wall time, cpu time, peak RSS and
+cuda allocations of a named stage, nested stages are recorded as "outer/inner". `save_report()` writes all
+the records of the run to a JSON file.
+Setting the env variable PROFILE=cprofile or PROFILE=torch also captures a cProfile or torch.profiler trace of
+each outermost stage, saved next to the report, and counts the live tensors created by each stage (which scans
+the whole heap on every stage entry and exit).
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import resource
+import warnings
+import cProfile
+import functools
+from contextlib import contextmanager
+
+import torch
+
+from utils.savedir import TESTS
+
+PROFILING_DIR = os.path.join(TESTS, "profiling/")
+DEBUG=False
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the process (ru_maxrss is in KB on linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def live_tensors():
+
+    # isinstance checks on deprecated torch objects raise warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return sum(1 for obj in gc.get_objects() if torch.is_tensor(obj))
+
+
+class StageProfiler:
+
+    def __init__(self, run_name=None, profile=os.environ.get("PROFILE"), savedir=PROFILING_DIR):
+
+        if profile not in [None, "", "cprofile", "torch"]:
+            raise ValueError("PROFILE should be cprofile or torch.")
+
+        script_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+        self.run_name = script_name+"_"+time.strftime("%Y%m%d-%H%M%S") if run_name is None else run_name
+        self.profile = profile
+        self.savedir = savedir
+        self.records = []
+        self._stages = []
+        self._start = time.time()
+
+    def _snapshot(self):
+
+        snapshot = {"wall_time":time.perf_counter(), "cpu_time":time.process_time(), "peak_rss_mb":peak_rss_mb()}
+
+        if self.profile:
+            snapshot["live_tensors"] = live_tensors()
+
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+            snapshot["cuda_allocations"] = torch.cuda.memory_stats().get("allocation.all.allocated", 0)
+
+        return snapshot
+
+    def _start_trace(self):
+
+        if self.profile == "cprofile":
+            trace = cProfile.Profile()
+            trace.enable()
+
+        elif self.profile == "torch":
+            if hasattr(torch, "profiler"):
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                trace = torch.profiler.profile(activities=activities, profile_memory=True)
+
+            else:
+                # torch < 1.8 only has the autograd profiler
+                cuda = {"use_cuda":True} if torch.cuda.is_available() else {}
+                trace = torch.autograd.profiler.profile(profile_memory=True, **cuda)
+
+            trace.__enter__()
+
+        return trace
+
+    def _stop_trace(self, trace, stage_name):
+
+        os.makedirs(self.savedir, exist_ok=True)
+        path = os.path.join(self.savedir, self.run_name+"_"+stage_name.replace("/", "_"))
+
+        if self.profile == "cprofile":
+            trace.disable()
+            trace.dump_stats(path+".prof")
+
+        elif self.profile == "torch":
+            trace.__exit__(None, None, None)
+            trace.export_chrome_trace(path+".json")
+
+    @contextmanager
+    def stage(self, name):
+
+        self._stages.append(str(name))
+        stage_name = "/".join(self._stages)
+
+        # records are listed in starting order
+        record = {"stage":stage_name, "depth":len(self._stages)-1}
+        self.records.append(record)
+
+        # only outermost stages are traced, profilers cannot be nested
+        trace = self._start_trace() if self.profile and len(self._stages)==1 else None
+        before = self._snapshot()
+
+        try:
+            yield
+
+        finally:
+            after = self._snapshot()
+            if trace is not None:
+                self._stop_trace(trace, stage_name)
+
+            record.update({"wall_time":after["wall_time"]-before["wall_time"],
+                           "cpu_time":after["cpu_time"]-before["cpu_time"],
+                           "peak_rss_mb":after["peak_rss_mb"],
+                           "rss_growth_mb":after["peak_rss_mb"]-before["peak_rss_mb"]})
+
+            if "live_tensors" in after:
+                record["new_live_tensors"] = after["live_tensors"]-before["live_tensors"]
+
+            if "cuda_allocations" in after:
+                record["cuda_allocations"] = after["cuda_allocations"]-before.get("cuda_allocations", 0)
+
+            self._stages.pop()
+
+            if DEBUG:
+                print(f"\n{stage_name}: wall time = {record['wall_time']:.2f}s\tcpu time = {record['cpu_time']:.2f}s")
+
+    def profile_stage(self, name=None):
+
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(function.__name__ if name is None else name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def save_report(self, path=None):
+
+        report = {"run":self.run_name, "argv":sys.argv, "profile":self.profile,
+                  "total_wall_time":time.time()-self._start, "stages":self.records}
+
+        path = os.path.join(self.savedir, self.run_name+"_report.json") if path is None else path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+        print("\nStage\twall time (s)\tcpu time (s)\tpeak rss (MB)")
+        for record in self.records:
+            print(f"{'  '*record['depth']}{record['stage']}\t{record['wall_time']:.2f}\t{record['cpu_time']:.2f}"
+                  f"\t{record['peak_rss_mb']:.1f}")
+
+        print("\nSaving profiling report:", path)
+        return report
+
+
+profiler = StageProfiler()
+stage = profiler.stage
+profile_stage = profiler.profile_stage
+save_report = profiler.save_report
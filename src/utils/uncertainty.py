@@ -0,0 +1,164 @@
+"""
+Uncertainty of the posterior predictive distribution of Bayesian networks.
+`PredictiveMoments` reduces the stream of posterior sample outputs of `BNN.forward` and `redBNN.forward` (with
+`moments=True`) to their running mean and variance, so that memory does not grow with the number of samples.
+With `entropy=True` it also returns the predictive entropy, the expected entropy and their difference, the mutual
+information between predictions and weights, computed on the softmax probabilities of the outputs, and the
+variation ratio of the predicted classes.
+The same measures are computed in batch by `uncertainty_measures` from the softmax outputs of all the samples,
+stacked on the first dimension (e.g. `forward(..., softmax=True, expected_out=False)`).
+`adaptive_moments` stops drawing samples for each input as soon as its mean output converges, with the stopping
+rule `standard_error_converged` shared by all the adaptive sampling paths.
+"""
+
+import torch
+import torch.nn.functional as nnf
+
+UNCERTAINTY_MEASURES = ["predictive_entropy", "expected_entropy", "mutual_information", "variation_ratio"]
+
+
+def entropy(probs, dim=-1):
+    return -(probs*torch.log(probs.clamp(min=torch.finfo(probs.dtype).tiny))).sum(dim)
+
+def predictive_entropy(probs):
+    """ Entropy of the posterior predictive, from sample probabilities of shape (n_samples, ..., n_classes). """
+    return entropy(probs.mean(0))
+
+def expected_entropy(probs):
+    """ Posterior expectation of the entropy of each sample prediction. """
+    return entropy(probs).mean(0)
+
+def mutual_information(probs):
+    """ Mutual information between predictions and weights (BALD). """
+    return predictive_entropy(probs)-expected_entropy(probs)
+
+def variation_ratio(probs):
+    """ Fraction of samples which do not predict the most voted class. """
+    votes = nnf.one_hot(probs.argmax(-1), probs.shape[-1]).sum(0)
+    return 1.-votes.max(-1)[0]/len(probs)
+
+def uncertainty_measures(probs):
+    """ All the `UNCERTAINTY_MEASURES` of the sample probabilities, in a single pass over the samples. """
+    mean_probs = probs.mean(0)
+    entropies = entropy(probs)
+    votes = nnf.one_hot(probs.argmax(-1), probs.shape[-1]).sum(0)
+
+    measures = {"predictive_entropy":entropy(mean_probs), "expected_entropy":entropies.mean(0)}
+    measures["mutual_information"] = measures["predictive_entropy"]-measures["expected_entropy"]
+    measures["variation_ratio"] = 1.-votes.max(-1)[0]/len(probs)
+    return measures
+
+
+def standard_error_converged(mean, var, count, tolerance, min_samples):
+    """
+    Stopping rule of adaptive sampling, for each input on the first dimension of the running `mean` and `var`: 
+    at least `min_samples` samples and a standard error of the mean whose norm is within `tolerance` times the 
+    norm of the mean, i.e. `tolerance` is relative.
+    """
+    count = torch.as_tensor(count, device=mean.device).reshape(-1)
+    standard_error = (var.detach().flatten(1)/count.unsqueeze(1)).sqrt().norm(dim=1)
+    return (count >= min_samples) & (standard_error <= tolerance*mean.detach().flatten(1).norm(dim=1))
+
+
+class RowwiseWelford:
+    """ Running mean and variance of each row (input) of the observations, with its own number of samples. """
+
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, rows, x):
+        if self.mean is None:
+            self.count = torch.zeros(len(x), dtype=torch.long, device=x.device)
+            self.mean = torch.zeros_like(x)
+            self.m2 = torch.zeros_like(x)
+
+        self.count[rows] += 1
+        count = self.count[rows].reshape(-1, *[1]*(x.dim()-1)).to(x.dtype)
+
+        # out of place updates keep the mean differentiable
+        delta = x-self.mean[rows]
+        mean = self.mean[rows]+delta/count
+        self.m2 = self.m2.index_put((rows,), self.m2[rows]+delta*(x-mean))
+        self.mean = self.mean.index_put((rows,), mean)
+
+    @property
+    def var(self):
+        count = self.count.reshape(-1, *[1]*(self.m2.dim()-1))
+        return self.m2/(count-1).clamp(min=1)
+
+
+class PredictiveMoments:
+
+    def __init__(self, entropy=False, softmax=False):
+        """ `softmax` tells whether the outputs are already probabilities. """
+        self.entropy = entropy
+        self.softmax = softmax
+        self.outputs = RowwiseWelford()
+
+        if entropy:
+            self.probs = RowwiseWelford()
+            self.entropies = RowwiseWelford()
+            self.votes = None
+
+    def update(self, out, rows=None):
+        """ Adds the outputs of a posterior sample on the inputs `rows` (all the inputs by default). """
+        if rows is None:
+            rows = torch.arange(len(out), device=out.device)
+
+        self.outputs.update(rows, out)
+
+        if self.entropy:
+            probs = out if self.softmax else nnf.softmax(out, dim=-1)
+            self.probs.update(rows, probs)
+            self.entropies.update(rows, entropy(probs.detach()))
+
+            if self.votes is None:
+                self.votes = torch.zeros(len(out), probs.shape[-1], dtype=torch.long, device=out.device)
+            self.votes[rows] += nnf.one_hot(probs.detach().argmax(-1), probs.shape[-1])
+
+    def reduce(self, outputs):
+        for out in outputs:
+            self.update(out)
+        return self.summary()
+
+    def converged(self, rows, tolerance, min_samples):
+        """ Whether the mean outputs of `rows` have converged, see `standard_error_converged`. """
+        outputs = self.outputs
+        return standard_error_converged(outputs.mean[rows], outputs.var[rows], outputs.count[rows], tolerance,
+                                        min_samples)
+
+    @property
+    def n_samples(self):
+        return self.outputs.count
+
+    def summary(self):
+        moments = {"mean":self.outputs.mean, "var":self.outputs.var, "n_samples":self.n_samples}
+
+        if self.entropy:
+            predictive_entropy = entropy(self.probs.mean)
+            moments.update({"predictive_entropy":predictive_entropy, "expected_entropy":self.entropies.mean,
+                            "mutual_information":predictive_entropy-self.entropies.mean,
+                            "variation_ratio":1.-self.votes.max(-1)[0]/self.n_samples})
+        return moments
+
+
+def adaptive_moments(sample_outputs, n_inputs, sample_idxs, tolerance, min_samples, entropy=False, softmax=False, 
+                     device="cpu"):
+    """
+    Draws the posterior samples `sample_idxs` in order, only on the inputs whose mean output has not converged yet
+    (see `standard_error_converged`), and returns the moments with the samples used by each input.
+    `sample_outputs(rows, sample_idx)` gives the outputs of a posterior sample on the inputs `rows`.
+    """
+    predictive = PredictiveMoments(entropy=entropy, softmax=softmax)
+    rows = torch.arange(n_inputs, device=device)
+
+    for sample_idx in sample_idxs:
+        predictive.update(sample_outputs(rows, sample_idx), rows)
+        rows = rows[~predictive.converged(rows, tolerance, min_samples)]
+
+        if len(rows) == 0:
+            break
+
+    return predictive.summary()